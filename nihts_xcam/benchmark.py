@@ -0,0 +1,258 @@
+"""
+Acquisition benchmarks for XenicsCamera.go(), run against the simulated camera.
+
+For each (exptime, coadds, nexp) case reports the time spent in each stage of the acquisition loop
+(temperature polling, capture, coadd, header building, filename lookup, FITS write), frames/sec,
+MB/s written to disk and peak memory, and writes everything to a JSON file so that releases can be
+compared.
+
+    python -m nihts_xcam.benchmark --exptime 0.005 0.05 --coadds 1 10 --nexp 20 -o bench.json
+
+nexp=-1 (video mode) cases are run for --video-sec seconds and then stopped with abort().
+
+--window 64x64 32x32 ... repeats every case with a window of interest of that size centred on the
+detector ('full' for the whole frame), reporting frames/sec and the USB data rate for each, e.g.
+
+    python -m nihts_xcam.benchmark --exptime 0.001 --coadds 1 --nexp 200 --mode pipelined \\
+        --output-mode cube --window full 160x128 64x64 32x32
+
+--coadd-mode ramp runs the coadds as nondestructive reads of an up-the-ramp fit instead (the 'ramp'
+stage is the fit's time per read), for comparing its throughput and memory with the coadd modes:
+
+    python -m nihts_xcam.benchmark --exptime 0.005 --coadds 50 --nexp 5 --mode serial \\
+        --coadd-mode stack stream ramp
+
+Ramp fits are only written one per file, so ramp cases with --output-mode cube or spool are skipped
+(and listed under 'skipped' in the JSON).
+
+--quicklook turns on the quick-look stage with a region around the simulated star, and also reports
+how long after each frame's capture its quick-look results were ready (quicklook_latency_ms).
+"""
+from __future__ import print_function, division
+import argparse
+import contextlib
+import datetime as dt
+import json
+import os
+import platform
+import sys
+import threading
+import time
+
+import numpy as np
+
+try:
+    import tracemalloc
+except ImportError:  # python 2
+    tracemalloc = None
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+from .simulated_xenics import simulated_camera
+
+
+def _dir_size_bytes(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        # not the .spool working directory
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        for f in files:
+            total += os.path.getsize(os.path.join(root, f))
+    return total
+
+
+def _max_rss_mb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on mac
+    return rss / (1024. * 1024.) if sys.platform == 'darwin' else rss / 1024.
+
+
+@contextlib.contextmanager
+def _quiet(enabled=True):
+    """The per-frame prints in go() would otherwise dominate short-exposure benchmarks."""
+    if not enabled:
+        yield
+        return
+    saved = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = saved
+
+
+def _drain(q):
+    items = []
+    while not q.empty():
+        items.append(q.get())
+    return items
+
+
+def parse_window(size, max_width=320, max_height=256):
+    """'WxH' -> a (x0, y0, W, H) window centred on the detector; 'full' -> 'full'."""
+    if size == 'full':
+        return 'full'
+    width, height = [int(v) for v in size.lower().split('x')]
+    return ((max_width - width) // 2, (max_height - height) // 2, width, height)
+
+
+def run_case(camera, exptime, coadds, nexp, pipelined=False, video_sec=5., quiet=True, coadd_mode='stack',
+             output='frames', quicklook=False, window='full'):
+    """
+    Run one go() sequence on camera and return a dict of timings.
+    """
+    camera.window(parse_window(window, camera._max_width, camera._max_height) if window is not None else None)
+    camera.coadd_mode(coadd_mode)
+    camera.output_mode(output)
+    camera.quicklook(quicklook, regions=[('star', camera._max_height // 2, camera._max_width // 2, 10)])
+    if quicklook:
+        _drain(camera.quicklook_results)
+    camera.timer.reset()
+    bytes_before = _dir_size_bytes(camera.obsdatadir)
+    if tracemalloc is not None:
+        tracemalloc.start()
+    timer = None
+    if nexp == -1:
+        timer = threading.Timer(video_sec, camera.abort)
+        timer.start()
+    t0 = time.time()
+    with _quiet(quiet):
+        camera.go(exptime, coadds, nexp, pipelined=pipelined)
+    elapsed = time.time() - t0
+    if timer is not None:
+        timer.cancel()
+    spool_wait_sec = None
+    if camera._spool is not None:
+        camera._spool.wait()
+        spool_wait_sec = time.time() - t0 - elapsed
+    peak_traced_mb = None
+    if tracemalloc is not None:
+        peak_traced_mb = tracemalloc.get_traced_memory()[1] / (1024. * 1024.)
+        tracemalloc.stop()
+    quicklook_latency_ms = None
+    if quicklook:
+        latencies = [1000. * r['latency_sec'] for r in _drain(camera.quicklook_results)]
+        if latencies:
+            quicklook_latency_ms = {'median': float(np.median(latencies)), 'max': float(np.max(latencies))}
+    stages = camera.timer.summary()
+    nframes = stages.get('write', {}).get('count', 0)
+    bytes_written = _dir_size_bytes(camera.obsdatadir) - bytes_before
+    # what came over USB: every coadd of every frame, 2 bytes per pixel
+    usb_bytes = nframes * coadds * camera._frame_shape[0] * camera._frame_shape[1] * 2
+    return {'exptime': exptime, 'coadds': coadds, 'nexp': nexp, 'pipelined': pipelined, 'coadd_mode': coadd_mode,
+            'output': output, 'spool_wait_sec': spool_wait_sec,
+            'window': window, 'frame_shape': list(camera._frame_shape),
+            'quicklook': quicklook, 'quicklook_latency_ms': quicklook_latency_ms,
+            'elapsed_sec': elapsed,
+            'frames_written': nframes,
+            'frames_per_sec': nframes / elapsed if elapsed > 0 else None,
+            'coadds_per_sec': nframes * coadds / elapsed if elapsed > 0 else None,
+            'expected_sec': nframes * coadds * exptime,
+            'efficiency': nframes * coadds * exptime / elapsed if elapsed > 0 else None,
+            'mb_written': bytes_written / 1e6,
+            'mb_per_sec': bytes_written / 1e6 / elapsed if elapsed > 0 else None,
+            'usb_mb_per_sec': usb_bytes / 1e6 / elapsed if elapsed > 0 else None,
+            'peak_traced_mb': peak_traced_mb,
+            'max_rss_mb': _max_rss_mb(),
+            'stages': stages}
+
+
+def run_benchmarks(exptimes=(0.005, 0.05), coadds=(1, 10), nexps=(20,), pipelined=(False, True),
+                   video_sec=5., output=None, quiet=True, coadd_modes=('stack',), output_modes=('frames',),
+                   quicklook=False, windows=('full',), **sim_kwargs):
+    """
+    Sweep every combination of exptimes x coadds x nexps x pipelined x coadd_modes x output_modes x
+    windows ('full' or 'WxH') on a simulated camera.
+
+    sim_kwargs are passed on to SimulatedXenics (e.g. realtime=False, readout_sec=...).
+    Returns the results dict, also written as JSON to `output` if given.  Combinations go() doesn't
+    support (coadd mode 'ramp' with 'cube' or 'spool' output) are listed under 'skipped' instead.
+    """
+    try:
+        from .__about__ import __version__
+    except ImportError:  # __about__ needs astropy_helpers
+        __version__ = None
+    with _quiet(quiet):
+        camera = simulated_camera(**sim_kwargs)
+    results = {'version': __version__,
+               'date': dt.datetime.utcnow().isoformat(),
+               'python': platform.python_version(),
+               'numpy': np.__version__,
+               'platform': platform.platform(),
+               'simulator': dict((k, v) for k, v in sim_kwargs.items()),
+               'cases': [],
+               'skipped': []}
+    for exptime in exptimes:
+        for ncoadds in coadds:
+            for nexp in nexps:
+                for pipe in pipelined:
+                    for coadd_mode in coadd_modes:
+                        for output_mode in output_modes:
+                            for window in windows:
+                                if coadd_mode == 'ramp' and output_mode != 'frames':
+                                    skipped = {'exptime': exptime, 'coadds': ncoadds, 'nexp': nexp,
+                                               'pipelined': pipe, 'coadd_mode': coadd_mode,
+                                               'output': output_mode, 'window': window,
+                                               'reason': "coadd mode 'ramp' needs output 'frames'"}
+                                    results['skipped'].append(skipped)
+                                    print("skipped {coadd_mode}/{output}: {reason}".format(**skipped))
+                                    continue
+                                case = run_case(camera, exptime, ncoadds, nexp, pipelined=pipe,
+                                                video_sec=video_sec, quiet=quiet, coadd_mode=coadd_mode,
+                                                output=output_mode, quicklook=quicklook, window=window)
+                                results['cases'].append(case)
+                                print(format_case(case))
+    camera.window('full')
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print("wrote {}".format(output))
+    return results
+
+
+def format_case(case):
+    stages = case['stages']
+    per_frame = ' '.join('{}={:.2f}ms'.format(name, 1000. * stages[name]['mean_sec'])
+                         for name in ['temperature', 'capture', 'ramp', 'coadd', 'quicklook', 'header',
+                                      'filename', 'write']
+                         if name in stages)
+    if case.get('quicklook_latency_ms'):
+        per_frame += ' quicklook_latency={median:.2f}ms (max {max:.2f}ms)'.format(**case['quicklook_latency_ms'])
+    return ("exptime={exptime:<6} coadds={coadds:<4} nexp={nexp:<4} pipelined={pipelined!s:<5} "
+            "coadd={coadd_mode:<6} output={output:<6} window={window:<7} "
+            "{frames_per_sec:7.1f} frames/s {mb_per_sec:6.1f} MB/s usb={usb_mb_per_sec:5.1f} MB/s "
+            "efficiency={efficiency:.2f}  ".format(**case) +
+            per_frame)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Benchmark XenicsCamera.go() on a simulated camera")
+    parser.add_argument('--exptime', type=float, nargs='+', default=[0.005, 0.05])
+    parser.add_argument('--coadds', type=int, nargs='+', default=[1, 10])
+    parser.add_argument('--nexp', type=int, nargs='+', default=[20])
+    parser.add_argument('--mode', choices=['serial', 'pipelined', 'both'], default='both')
+    parser.add_argument('--coadd-mode', choices=['stack', 'stream', 'ramp'], nargs='+', default=['stack'])
+    parser.add_argument('--output-mode', choices=['frames', 'cube', 'spool'], nargs='+', default=['frames'])
+    parser.add_argument('--window', nargs='+', default=['full'],
+                        help="window of interest sizes to sweep, 'full' or WxH (centred on the detector)")
+    parser.add_argument('--quicklook', action='store_true', help="run the quick-look stage on every frame")
+    parser.add_argument('--video-sec', type=float, default=5.)
+    parser.add_argument('--readout-sec', type=float, default=0.0055)
+    parser.add_argument('--no-realtime', action='store_true',
+                        help="don't model exposure/readout time, measure software overhead only")
+    parser.add_argument('-o', '--output', default='xcam_benchmark.json')
+    args = parser.parse_args(args)
+    pipelined = {'serial': (False,), 'pipelined': (True,), 'both': (False, True)}[args.mode]
+    run_benchmarks(exptimes=args.exptime, coadds=args.coadds, nexps=args.nexp, pipelined=pipelined,
+                   video_sec=args.video_sec, output=args.output, coadd_modes=args.coadd_mode,
+                   output_modes=args.output_mode, quicklook=args.quicklook, windows=args.window,
+                   realtime=not args.no_realtime, readout_sec=args.readout_sec)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+from __future__ import division
+import mmap
+import threading
+import time
+
+import numpy as np
+
+
+def aligned_empty(shape, dtype, align=mmap.PAGESIZE):
+    """
+    np.empty(shape, dtype), but with the data starting on an `align` byte boundary.
+    """
+    dtype = np.dtype(dtype)
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    raw = np.empty(nbytes + align, dtype=np.uint8)
+    offset = (-raw.ctypes.data) % align
+    return raw[offset:offset + nbytes].view(dtype).reshape(shape)
+
+
+class FramePool():
+    """
+    Reusable, preallocated frame buffers keyed by (shape, dtype), e.g. the [coadds, height, width]
+    uint16 capture stacks and the [height, width] int32 sum images used by go().
+
+        buf = pool.acquire((coadds, 256, 320), np.uint16, limit=3)
+        ...  capture into buf, coadd, write ...
+        pool.release(buf)
+
+    acquire() hands out an idle buffer of that geometry, allocating a new (page aligned) one only if
+    there is none idle.  With `limit`, no more than `limit` buffers of that geometry are ever allocated,
+    and acquire() waits for one to be released (returning None if `timeout` runs out).  A buffer is
+    only handed out again after release(), so the holder must not release it until e.g. the FITS write
+    that reads it has finished.
+
+    Buffers are not cleared between uses.
+    """
+    def __init__(self, align=mmap.PAGESIZE):
+        self.align = align
+        self._cond = threading.Condition()
+        self._idle = {}
+        self._allocated = {}
+        self._owner = {}
+        self.allocations = 0
+
+    @staticmethod
+    def _key(shape, dtype):
+        return tuple(int(n) for n in shape), np.dtype(dtype).str
+
+    def acquire(self, shape, dtype, limit=None, timeout=None):
+        key = self._key(shape, dtype)
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while True:
+                idle = self._idle.setdefault(key, [])
+                if idle:
+                    return idle.pop()
+                if limit is None or self._allocated.get(key, 0) < limit:
+                    break
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+            self._allocated[key] = self._allocated.get(key, 0) + 1
+            self.allocations += 1
+        buf = aligned_empty(key[0], key[1], self.align)
+        with self._cond:
+            self._owner[id(buf)] = (key, buf)
+        return buf
+
+    def release(self, buf):
+        with self._cond:
+            key, pooled = self._owner.get(id(buf), (None, None))
+            if pooled is not buf:
+                raise ValueError("buffer was not acquired from this pool")
+            self._idle[key].append(buf)
+            self._cond.notify_all()
+
+    def trim(self, keep=()):
+        """
+        Free the idle buffers of every geometry except those in `keep` ([(shape, dtype), ...]).
+        """
+        keep = set(self._key(shape, dtype) for shape, dtype in keep)
+        with self._cond:
+            for key, idle in self._idle.items():
+                if key in keep:
+                    continue
+                for buf in idle:
+                    del self._owner[id(buf)]
+                self._allocated[key] -= len(idle)
+                del idle[:]
+
+    def nbytes(self):
+        """Bytes held by the pool, in use or idle."""
+        with self._cond:
+            return sum(n * int(np.prod(key[0])) * np.dtype(key[1]).itemsize
+                       for key, n in self._allocated.items())
@@ -0,0 +1,174 @@
+"""
+Local command/status server for the sequence scheduler, so observatory software can queue and control
+sequences without going through an IPython session.  Python 3 only (asyncio).
+
+The protocol is JSON lines over TCP (localhost by default): one request object per line, answered by
+one response object per line, on a connection that can be kept open for low latency.
+
+    {"cmd": "submit", "exptime": 0.5, "coadds": 10, "nexp": 5, "target": "HD 12345"}
+    {"cmd": "submit", "sequences": [{"exptime": 0.01, "nexp": 100}, {"exptime": 1.0, "gain": true}]}
+    {"cmd": "status"}
+    {"cmd": "pause"}   {"cmd": "resume"}
+    {"cmd": "abort"}   {"cmd": "abort", "clear": true}
+    {"cmd": "remove", "id": 3}
+
+Responses are {"ok": true, ...} or {"ok": false, "error": "..."}.  submit answers with the new sequence
+"ids", abort with the ids aborted/dropped, and status with SequenceScheduler.status().
+
+    server = CommandServer(SequenceScheduler(camera), port=9109)
+    ...
+    server.stop()
+
+send_command() is a minimal (python 2 or 3) client.  To try it out without hardware:
+
+    python -m nihts_xcam.command_server --simulated
+"""
+import argparse
+import asyncio
+import json
+import socket
+import threading
+
+from .scheduler import SequenceScheduler
+
+default_port = 9109
+
+
+class CommandServer():
+    """
+    Serves the JSON lines protocol for scheduler on host:port from an asyncio event loop in a daemon
+    thread.  port=0 picks a free port (see .port).
+    """
+    def __init__(self, scheduler, port=default_port, host='127.0.0.1'):
+        self.scheduler = scheduler
+        self.host = host
+        self.port = port
+        self._loop = asyncio.new_event_loop()
+        self._server = None
+        started = threading.Event()
+        errors = []
+
+        def run():
+            asyncio.set_event_loop(self._loop)
+            try:
+                self._server = self._loop.run_until_complete(
+                    asyncio.start_server(self._handle, host, port))
+                self.port = self._server.sockets[0].getsockname()[1]
+            except Exception as e:
+                errors.append(e)
+                return
+            finally:
+                started.set()
+            self._loop.run_forever()
+            self._server.close()
+            self._loop.run_until_complete(self._server.wait_closed())
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, name='command-server')
+        self._thread.daemon = True
+        self._thread.start()
+        started.wait()
+        if errors:
+            raise errors[0]
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                writer.write(json.dumps(self.handle_line(line), default=str).encode('utf-8') + b'\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def handle_line(self, line):
+        """The response dict for one request line."""
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("request must be a JSON object")
+            cmd = request.pop('cmd', None)
+            handler = getattr(self, '_cmd_' + str(cmd), None)
+            if handler is None:
+                raise ValueError("unknown command {!r}".format(cmd))
+            response = handler(**request)
+        except (ValueError, TypeError) as e:
+            return {'ok': False, 'error': str(e)}
+        response['ok'] = True
+        return response
+
+    def _cmd_submit(self, sequences=None, **fields):
+        if sequences is None:
+            sequences = [fields]
+        elif fields:
+            raise ValueError("give either 'sequences' or the fields of one sequence, not both")
+        return {'ids': [self.scheduler.submit(spec) for spec in sequences]}
+
+    def _cmd_status(self):
+        return self.scheduler.status()
+
+    def _cmd_abort(self, clear=False):
+        return {'ids': self.scheduler.abort(clear=clear)}
+
+    def _cmd_pause(self):
+        self.scheduler.pause()
+        return {}
+
+    def _cmd_resume(self):
+        self.scheduler.resume()
+        return {}
+
+    def _cmd_remove(self, id):
+        return {'removed': self.scheduler.remove(id)}
+
+
+def send_command(request, port=default_port, host='127.0.0.1', timeout=10.):
+    """Send one request dict (e.g. {'cmd': 'status'}) and return the response dict."""
+    sock = socket.create_connection((host, port), timeout=timeout)
+    try:
+        sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        f = sock.makefile('rb')
+        try:
+            return json.loads(f.readline().decode('utf-8'))
+        finally:
+            f.close()
+    finally:
+        sock.close()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Run the XenicsCamera sequence scheduler with a command server")
+    parser.add_argument('--port', type=int, default=default_port)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--simulated', action='store_true', help="use the simulated camera")
+    args = parser.parse_args(args)
+    if args.simulated:
+        from .simulated_xenics import simulated_camera
+        camera = simulated_camera()
+    else:
+        from .nihts_xcam import XenicsCamera
+        camera = XenicsCamera()
+    scheduler = SequenceScheduler(camera)
+    server = CommandServer(scheduler, port=args.port, host=args.host)
+    print("listening on {}:{}; ctrl-c to stop".format(args.host, server.port))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+        scheduler.stop()
+        camera.close_camera()
+
+
+if __name__ == '__main__':
+    main()
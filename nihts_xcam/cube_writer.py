@@ -0,0 +1,253 @@
+"""
+Multi-frame FITS output for long sequences and video mode.
+
+Rather than one FITS file per frame, CubeWriter writes frames into chunk files of up to chunk_frames
+frames each:
+
+    primary HDU - [nframes, height, width] cube; the header is that of the first frame in the chunk
+    FRAMES      - binary table with one row per frame, holding the value for every frame of each
+                  header keyword that changes within the chunk (CURNEXP, DATE-OBS, temperatures,
+                  telescope pointing, ...)
+
+Each chunk file is created at its full size up front and frames are written straight into place, so
+adding a frame is a seek and a write with no header serialization or file creation.  A chunk that
+ends early (end of sequence, abort) has NAXIS3 rewritten and the file trimmed when it is closed.
+
+Full chunks are finished (FRAMES table appended) by background worker threads.  With compress=True
+each finished chunk is also written as a Rice tile-compressed copy (<name>.fz) and the uncompressed
+file removed.
+"""
+from __future__ import division, print_function
+import collections
+import os
+import threading
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+import numpy as np
+from astropy.io import fits
+
+FITS_BLOCK = 2880
+# always kept in the FRAMES table, even if they happen not to change
+PER_FRAME_KEYWORDS = ('CURNEXP', 'DATE-OBS', 'DATE-BEG', 'DATE-END')
+
+
+class FrameMetadata():
+    """
+    Stands in for a fits.Header when building the header of a frame that will go into a cube:
+    _fill_header's header[keyword] = value / (value, comment) and header.extend(cards) just record
+    the values, without the cost of building astropy Cards.
+
+    data - the frame's image
+    """
+    def __init__(self, data):
+        self.data = data
+        self.cards = collections.OrderedDict()
+
+    def __setitem__(self, keyword, value):
+        if isinstance(value, tuple):
+            value, comment = value
+        else:
+            comment = self.cards[keyword][1] if keyword in self.cards else ''
+        self.cards[keyword] = (value, comment)
+
+    def __getitem__(self, keyword):
+        return self.cards[keyword][0]
+
+    def __contains__(self, keyword):
+        return keyword in self.cards
+
+    def extend(self, cards):
+        for card in cards:
+            if isinstance(card, fits.Card):
+                self.cards[card.keyword] = (card.value, card.comment)
+            else:
+                self.cards[card[0]] = (card[1], card[2] if len(card) > 2 else '')
+
+    def header(self):
+        header = fits.Header()
+        for keyword, (value, comment) in self.cards.items():
+            header[keyword] = (value, comment)
+        return header
+
+
+def _column(keyword, values):
+    """A fits.Column holding values (one per frame) of a header keyword."""
+    name = keyword
+    if all(isinstance(v, (bool, np.bool_)) for v in values):
+        return fits.Column(name=name, format='L', array=np.array(values, dtype=bool))
+    if all(isinstance(v, (int, np.integer)) and not isinstance(v, bool) for v in values):
+        return fits.Column(name=name, format='K', array=np.array(values, dtype=np.int64))
+    if all(isinstance(v, (int, float, np.integer, np.floating)) and not isinstance(v, bool) for v in values):
+        return fits.Column(name=name, format='D', array=np.array(values, dtype=np.float64))
+    strings = ['' if v is None else str(v) for v in values]
+    width = max(1, max(len(s) for s in strings))
+    return fits.Column(name=name, format='{}A'.format(width), array=np.array(strings))
+
+
+def frames_table(rows):
+    """
+    FRAMES BinTableHDU for a list of per-frame {keyword: value} rows; a column for every keyword in
+    PER_FRAME_KEYWORDS or whose value differs from that in the first row.
+    """
+    first = rows[0]
+    keywords = []
+    for row in rows:
+        for keyword in row:
+            if keyword not in keywords and (keyword in PER_FRAME_KEYWORDS or row[keyword] != first.get(keyword)):
+                keywords.append(keyword)
+    for row in rows:
+        for keyword in first:
+            if keyword not in row and keyword not in keywords:
+                keywords.append(keyword)
+    columns = [_column(keyword, [row.get(keyword) for row in rows]) for keyword in keywords]
+    return fits.BinTableHDU.from_columns(columns, name='FRAMES')
+
+
+def compress_chunk(filename, keep_uncompressed=False):
+    """
+    Write filename (a chunk file) as a Rice tile-compressed <filename>.fz, then remove the original
+    unless keep_uncompressed.  Returns the compressed filename.
+    """
+    compressed_filename = filename + '.fz'
+    if os.path.exists(compressed_filename):
+        raise IOError("{} already exists".format(compressed_filename))
+    with fits.open(filename) as hdulist:
+        primary = hdulist[0]
+        header = primary.header.copy()
+        for keyword in ('SIMPLE', 'EXTEND'):
+            header.remove(keyword, ignore_missing=True)
+        out = fits.HDUList([fits.PrimaryHDU(),
+                            fits.CompImageHDU(primary.data, header=header, compression_type='RICE_1')] +
+                           [hdu.copy() for hdu in hdulist[1:]])
+        out.writeto(compressed_filename + '.tmp', output_verify='silentfix')
+    os.rename(compressed_filename + '.tmp', compressed_filename)
+    if not keep_uncompressed:
+        os.remove(filename)
+    return compressed_filename
+
+
+class _Chunk():
+    def __init__(self, filename, metadata, shape, dtype, nframes):
+        self.filename = filename
+        self.nframes = nframes
+        self.frame_bytes = int(np.prod(shape)) * dtype.itemsize
+        self.rows = []
+        header = fits.Header()
+        header['SIMPLE'] = True
+        header['BITPIX'] = dtype.itemsize * 8 if dtype.kind in 'iu' else -dtype.itemsize * 8
+        header['NAXIS'] = 3
+        header['NAXIS1'] = shape[1]
+        header['NAXIS2'] = shape[0]
+        header['NAXIS3'] = (nframes, 'frames in this file')
+        header['EXTEND'] = True
+        for keyword, (value, comment) in metadata.cards.items():
+            header[keyword] = (value, comment)
+        header['FILENAME'] = (os.path.basename(filename), 'original filename as written to disk')
+        header_bytes = header.tostring().encode('ascii')
+        self.naxis3_offset = header_bytes.index(b'NAXIS3  =')
+        self.naxis3_comment = header.comments['NAXIS3']
+        self.data_offset = len(header_bytes)
+        # filename has been claimed by creating it empty (see FileNumberAllocator)
+        fd = os.open(filename, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        self.f = os.fdopen(fd, 'r+b')
+        self.f.write(header_bytes)
+        self.f.truncate(self.data_offset + self._padded(nframes * self.frame_bytes))
+
+    @staticmethod
+    def _padded(nbytes):
+        return -(-nbytes // FITS_BLOCK) * FITS_BLOCK
+
+    def write(self, image):
+        self.f.seek(self.data_offset + len(self.rows) * self.frame_bytes)
+        self.f.write(image.data)
+
+    def close(self):
+        n = len(self.rows)
+        if n < self.nframes:
+            self.f.seek(self.naxis3_offset)
+            self.f.write(fits.Card('NAXIS3', n, self.naxis3_comment).image.encode('ascii'))
+            self.f.truncate(self.data_offset + self._padded(n * self.frame_bytes))
+        self.f.close()
+        table = frames_table(self.rows)
+        fits.append(self.filename, table.data, header=table.header)
+
+
+class CubeWriter():
+    """
+    Writes frames of one shape into chunk files of up to chunk_frames frames (see module docstring).
+
+        filename_factory - called with no arguments for the filename of each new chunk
+        nframes - total frames expected, if known, so the last chunk is only as big as needed
+        compress - also write each finished chunk as a Rice-compressed .fz file
+        workers - number of background threads finishing chunks
+
+    write(metadata) adds a frame (a FrameMetadata, with the image as metadata.data) and returns the
+    chunk filename it went to.  Full chunks are finished (FRAMES table appended, then compression)
+    by the background threads so that write() never waits on them; close() finishes the last chunk
+    and waits for the threads.
+    """
+    def __init__(self, shape, filename_factory, chunk_frames=100, nframes=None, dtype=np.int32,
+                 compress=False, workers=1):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype).newbyteorder('>')
+        self.filename_factory = filename_factory
+        self.chunk_frames = max(1, int(chunk_frames))
+        self.nframes_remaining = nframes
+        self.compress = compress
+        self.filenames = []
+        self.compressed_filenames = []
+        self.errors = []
+        self._chunk = None
+        # big-endian copy of the current frame, reused
+        self._frame = np.empty(self.shape, dtype=self.dtype)
+        self._finish_q = queue.Queue()
+        self._workers = []
+        for i in range(max(1, workers)):
+            t = threading.Thread(target=self._finish_worker)
+            t.daemon = True
+            t.start()
+            self._workers.append(t)
+
+    def write(self, metadata):
+        if self._chunk is None:
+            nframes = self.chunk_frames
+            if self.nframes_remaining is not None:
+                nframes = max(1, min(nframes, self.nframes_remaining))
+            self._chunk = _Chunk(self.filename_factory(), metadata, self.shape, self.dtype, nframes)
+            self.filenames.append(self._chunk.filename)
+        chunk = self._chunk
+        self._frame[...] = metadata.data
+        chunk.write(self._frame)
+        chunk.rows.append(dict((keyword, value) for keyword, (value, comment) in metadata.cards.items()))
+        if self.nframes_remaining is not None:
+            self.nframes_remaining -= 1
+        if len(chunk.rows) == chunk.nframes:
+            self._finish_q.put(chunk)
+            self._chunk = None
+        return chunk.filename
+
+    def _finish_worker(self):
+        while True:
+            chunk = self._finish_q.get()
+            if chunk is None:
+                return
+            try:
+                chunk.close()
+                if self.compress:
+                    self.compressed_filenames.append(compress_chunk(chunk.filename))
+            except Exception as e:
+                self.errors.append((chunk.filename, e))
+                print("CubeWriter: could not finish {}: {}".format(chunk.filename, e))
+
+    def close(self):
+        if self._chunk is not None:
+            self._finish_q.put(self._chunk)
+            self._chunk = None
+        for t in self._workers:
+            self._finish_q.put(None)
+        for t in self._workers:
+            t.join()
+        self._workers = []
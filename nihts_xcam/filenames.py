@@ -0,0 +1,75 @@
+from __future__ import division
+import errno
+import os
+import re
+import threading
+import time
+
+
+class FileNumberAllocator():
+    """
+    Hands out data filenames  <obsdatadir>/YYYY-MM-DD/YYYY-MM-DD_NNNN.fits  with YYYY-MM-DD the UT date.
+
+    The night directory is scanned once, when it is first used, for the highest number already taken
+    (including .fits.fz files from compressed cube chunks); after that each number costs one
+    exclusive create (O_CREAT | O_EXCL), which also means two processes writing to the same directory
+    can never be given the same name.  The claimed file is left empty for the caller to overwrite.
+
+    The UT date and the time of the next UT midnight are cached, so the date rollover is a float
+    comparison per call rather than a utcnow()/isdir() per frame.
+    """
+    def __init__(self, obsdatadir):
+        self.obsdatadir = obsdatadir
+        self._lock = threading.Lock()
+        self._date = None
+        self._datadir = None
+        self._next_midnight = 0.
+        self._next_num = 1
+
+    def _roll_date(self, now):
+        self._date = time.strftime('%Y-%m-%d', time.gmtime(now))
+        self._next_midnight = (now // 86400 + 1) * 86400
+        self._datadir = os.path.join(self.obsdatadir, self._date)
+        if not os.path.isdir(self._datadir):
+            os.mkdir(self._datadir)
+        self._next_num = self._scan()
+
+    def _scan(self):
+        pattern = re.compile(r'^' + re.escape(self._date) + r'_(\d+)\.fits(\.fz)?$')
+        last = 0
+        for name in os.listdir(self._datadir):
+            match = pattern.match(name)
+            if match:
+                last = max(last, int(match.group(1)))
+        return last + 1
+
+    def datadir(self, now=None):
+        """Directory for the current UT date, created if need be."""
+        now = time.time() if now is None else now
+        with self._lock:
+            if now >= self._next_midnight:
+                self._roll_date(now)
+            return self._datadir
+
+    def next_filename(self, now=None):
+        """
+        Claim and return the next free filename for the UT date at `now` (default: the current time).
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            if now >= self._next_midnight:
+                self._roll_date(now)
+            while True:
+                filename = os.path.join(self._datadir, "{0}_{1:04d}.fits".format(self._date, self._next_num))
+                self._next_num += 1
+                try:
+                    os.close(os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+                    continue
+                if os.path.exists(filename + '.fz'):
+                    # a compressed cube chunk already has this number (its .fits was removed)
+                    os.remove(filename)
+                    continue
+                return filename
@@ -0,0 +1,238 @@
+"""
+Live frames in shared memory, for viewers and guiding tools on the same machine.
+
+XenicsCamera publishes each coadded frame, with a few key header values, into a small ring of slots
+in a memory-mapped file (in /dev/shm where there is one).  Readers attach with LiveFrameClient and
+see new frames at the full frame rate without any disk I/O:
+
+    from nihts_xcam.live import LiveFrameClient
+    client = LiveFrameClient()            # same name as the camera's live_name, default 'xcam-live'
+    frame = client.wait(timeout=5.)       # next frame after the last one seen
+    frame.data, frame.header['CURNEXP'], frame.sequence
+
+Each slot is guarded by a sequence lock: the publisher makes the slot's sequence number odd while it
+writes, then even.  latest() copies the frame out and retries if the slot changed underneath it;
+view() returns a zero-copy view instead, whose is_valid() says whether it has since been overwritten
+(it stays good for nslots - 1 further frames).
+"""
+from __future__ import division
+import json
+import mmap
+import os
+import struct
+import tempfile
+import time
+
+import numpy as np
+
+MAGIC = b'XCAMLIV1'
+VERSION = 1
+HEADER_BYTES = 4096
+SLOT_HEADER_BYTES = 64
+_HEADER = struct.Struct('<8sIII8sII')
+LATEST_OFFSET = 64
+
+# header values published with each frame (if present)
+LIVE_KEYWORDS = ('OBJECT', 'DATE-OBS', 'DATE-BEG', 'DATE-END', 'EXPTIME', 'COADDS', 'CURNEXP', 'NEXP',
+                 'TK1', 'TK2', 'RA', 'DEC', 'AZ', 'EL', 'AIRMASS', 'TARGNAME')
+
+
+def default_directory():
+    return '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+
+def _path(name, directory):
+    return os.path.join(directory if directory is not None else default_directory(), name)
+
+
+class _Layout():
+    def __init__(self, height, width, dtype, nslots, meta_bytes):
+        self.shape = (height, width)
+        self.dtype = np.dtype(dtype)
+        self.nslots = nslots
+        self.meta_bytes = meta_bytes
+        frame_bytes = height * width * self.dtype.itemsize
+        self.slot_bytes = -(-(SLOT_HEADER_BYTES + meta_bytes + frame_bytes) // mmap.PAGESIZE) * mmap.PAGESIZE
+        self.file_bytes = HEADER_BYTES + nslots * self.slot_bytes
+
+    def pack(self):
+        return _HEADER.pack(MAGIC, VERSION, self.shape[0], self.shape[1], self.dtype.str.encode('ascii'),
+                            self.nslots, self.meta_bytes)
+
+    @classmethod
+    def unpack(cls, buf):
+        magic, version, height, width, dtype, nslots, meta_bytes = _HEADER.unpack_from(buf, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("not a version {} xcam live frame file".format(VERSION))
+        return cls(height, width, dtype.rstrip(b'\0').decode('ascii'), nslots, meta_bytes)
+
+    def __eq__(self, other):
+        return self.pack() == other.pack()
+
+    def __ne__(self, other):
+        return not self == other
+
+
+class _Mapped():
+    """numpy views of the shared file: latest sequence, per-slot sequence/metadata length, frames."""
+    def __init__(self, mm, layout):
+        self.mm = mm
+        self.layout = layout
+        self.latest = np.frombuffer(mm, dtype=np.uint64, count=1, offset=LATEST_OFFSET)
+        self.slot_seq = []
+        self.meta_len = []
+        self.frames = []
+        npix = layout.shape[0] * layout.shape[1]
+        for slot in range(layout.nslots):
+            offset = HEADER_BYTES + slot * layout.slot_bytes
+            self.slot_seq.append(np.frombuffer(mm, dtype=np.uint64, count=1, offset=offset))
+            self.meta_len.append(np.frombuffer(mm, dtype=np.uint32, count=1, offset=offset + 8))
+            self.frames.append(np.frombuffer(mm, dtype=layout.dtype, count=npix,
+                                             offset=offset + SLOT_HEADER_BYTES + layout.meta_bytes
+                                             ).reshape(layout.shape))
+
+    def meta_offset(self, slot):
+        return HEADER_BYTES + slot * self.layout.slot_bytes + SLOT_HEADER_BYTES
+
+    def release(self):
+        del self.latest, self.slot_seq, self.meta_len, self.frames
+
+
+class LiveFramePublisher():
+    """
+    Writer side.  publish(image, header) puts a frame and the LIVE_KEYWORDS values from header (a
+    fits.Header, FrameMetadata or dict) into the next slot.  An existing file of the same layout is
+    reused, so attached clients carry on across camera restarts.
+    """
+    def __init__(self, shape, dtype=np.int32, name='xcam-live', directory=None, nslots=4, meta_bytes=4096):
+        self.path = _path(name, directory)
+        layout = _Layout(shape[0], shape[1], dtype, nslots, meta_bytes)
+        existing = None
+        if os.path.exists(self.path) and os.path.getsize(self.path) == layout.file_bytes:
+            with open(self.path, 'rb') as f:
+                try:
+                    existing = _Layout.unpack(f.read(_HEADER.size))
+                except (ValueError, struct.error):
+                    existing = None
+        if existing is None or existing != layout:
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.truncate(layout.file_bytes)
+                f.write(layout.pack())
+            os.rename(tmp_path, self.path)
+        self._f = open(self.path, 'r+b')
+        self._mapped = _Mapped(mmap.mmap(self._f.fileno(), layout.file_bytes), layout)
+        self.layout = layout
+        self.sequence = int(self._mapped.latest[0])
+
+    def publish(self, image, header=None):
+        m = self._mapped
+        values = {}
+        if header is not None:
+            for keyword in LIVE_KEYWORDS:
+                if keyword in header:
+                    value = header[keyword]
+                    values[keyword] = value.item() if isinstance(value, np.generic) else value
+        meta = json.dumps(values, default=str).encode('utf-8')[:self.layout.meta_bytes]
+        sequence = self.sequence + 1
+        slot = sequence % self.layout.nslots
+        m.slot_seq[slot][0] = 2 * sequence - 1  # odd: being written
+        m.frames[slot][...] = image
+        offset = m.meta_offset(slot)
+        m.mm[offset:offset + len(meta)] = meta
+        m.meta_len[slot][0] = len(meta)
+        m.slot_seq[slot][0] = 2 * sequence
+        m.latest[0] = sequence
+        self.sequence = sequence
+        return sequence
+
+    def close(self, unlink=False):
+        self._mapped.release()
+        self._mapped.mm.close()
+        self._f.close()
+        if unlink:
+            os.remove(self.path)
+
+
+class LiveFrame():
+    """
+    A frame from LiveFrameClient.  data is a copy (latest(), wait()) or a view into shared memory
+    (view()); in the latter case check is_valid() after using it.
+    """
+    def __init__(self, client, sequence, data, header):
+        self._client = client
+        self.sequence = sequence
+        self.data = data
+        self.header = header
+
+    def is_valid(self):
+        return self._client._slot_sequence(self.sequence) == 2 * self.sequence
+
+
+class LiveFrameClient():
+    """
+    Reader side; see the module docstring.  Raises IOError if the camera hasn't created the file yet.
+    """
+    def __init__(self, name='xcam-live', directory=None):
+        self.path = _path(name, directory)
+        self._f = open(self.path, 'rb')
+        mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._mapped = _Mapped(mm, _Layout.unpack(mm))
+        self.last_sequence = 0
+
+    def latest_sequence(self):
+        return int(self._mapped.latest[0])
+
+    def _slot_sequence(self, sequence):
+        return int(self._mapped.slot_seq[sequence % self._mapped.layout.nslots][0])
+
+    def _read(self, copy, retries=10):
+        m = self._mapped
+        for i in range(retries):
+            sequence = int(m.latest[0])
+            if sequence == 0:
+                return None
+            slot = sequence % m.layout.nslots
+            if int(m.slot_seq[slot][0]) != 2 * sequence:
+                continue
+            offset = m.meta_offset(slot)
+            meta = bytes(m.mm[offset:offset + int(m.meta_len[slot][0])])
+            data = m.frames[slot].copy() if copy else m.frames[slot]
+            if int(m.slot_seq[slot][0]) != 2 * sequence:
+                continue
+            try:
+                header = json.loads(meta.decode('utf-8')) if meta else {}
+            except ValueError:
+                continue
+            self.last_sequence = sequence
+            return LiveFrame(self, sequence, data, header)
+        return None
+
+    def latest(self):
+        """The most recent frame (a copy), or None if nothing has been published."""
+        return self._read(copy=True)
+
+    def view(self):
+        """The most recent frame as a zero-copy view into shared memory, or None."""
+        return self._read(copy=False)
+
+    def wait(self, timeout=None, after=None, poll_sec=0.001, copy=True):
+        """
+        Wait for a frame newer than sequence `after` (default: the last one this client returned).
+        Returns None on timeout.
+        """
+        after = self.last_sequence if after is None else after
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            if int(self._mapped.latest[0]) > after:
+                frame = self._read(copy)
+                if frame is not None and frame.sequence > after:
+                    return frame
+            if deadline is not None and time.time() > deadline:
+                return None
+            time.sleep(poll_sec)
+
+    def close(self):
+        self._mapped.release()
+        self._mapped.mm.close()
+        self._f.close()
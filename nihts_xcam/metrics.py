@@ -0,0 +1,153 @@
+"""
+Always-on acquisition metrics for XenicsCamera.
+
+AcquisitionMetrics holds counters (frames written, dropped frames, USB timeouts/underruns/errors, ...),
+gauges (queue depths, detector temperature, ...) and the per-frame stage timings of the most recent
+frames.  Recording is a dict update under a lock, so it is cheap enough to leave on in the hot loop.
+
+The numbers can be read with snapshot(), or exported for the observatory monitoring with either
+
+    MetricsFileSink - rewrites a JSON file every few seconds (atomically, via rename)
+    MetricsHTTPServer - serves /metrics (prometheus text format) and /metrics.json on a local port
+"""
+from __future__ import division
+import collections
+import json
+import os
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:  # python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+
+class AcquisitionMetrics():
+    def __init__(self, nframes_kept=500):
+        self._lock = threading.Lock()
+        self._counters = collections.OrderedDict()
+        self._gauges = collections.OrderedDict()
+        self._frames = collections.deque(maxlen=nframes_kept)
+        self.started = time.time()
+
+    def increment(self, name, n=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def set_counter(self, name, value):
+        """For counters kept elsewhere (e.g. the driver's USB error counts)."""
+        with self._lock:
+            self._counters[name] = value
+
+    def set_gauge(self, name, value):
+        with self._lock:
+            self._gauges[name] = value
+
+    def record_frame(self, record):
+        """
+        record is a dict of per-frame values, e.g. {'cur_nexp': 3, 'timings': {'capture': 0.05, ...}}
+        """
+        with self._lock:
+            self._frames.append(record)
+            self._counters['frames_written'] = self._counters.get('frames_written', 0) + 1
+            self._gauges['last_frame_time'] = time.time()
+
+    def frames(self):
+        with self._lock:
+            return list(self._frames)
+
+    def snapshot(self):
+        with self._lock:
+            return {'time': time.time(),
+                    'uptime_sec': time.time() - self.started,
+                    'counters': dict(self._counters),
+                    'gauges': dict(self._gauges),
+                    'recent_frames': list(self._frames)[-10:]}
+
+    def to_prometheus(self, prefix='xcam_'):
+        lines = []
+        with self._lock:
+            for name, value in self._counters.items():
+                lines.append('# TYPE {0}{1} counter'.format(prefix, name))
+                lines.append('{0}{1} {2}'.format(prefix, name, value))
+            for name, value in self._gauges.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines.append('# TYPE {0}{1} gauge'.format(prefix, name))
+                    lines.append('{0}{1} {2}'.format(prefix, name, value))
+            if self._frames:
+                last = self._frames[-1]
+                for stage, sec in sorted(last.get('timings', {}).items()):
+                    lines.append('{0}last_frame_seconds{{stage="{1}"}} {2}'.format(prefix, stage, sec))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsFileSink():
+    """
+    Writes metrics.snapshot() as JSON to `path` every `interval_sec` in a daemon thread.
+    """
+    def __init__(self, metrics, path, interval_sec=5.):
+        self.metrics = metrics
+        self.path = path
+        self.interval_sec = interval_sec
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.metrics.snapshot(), f, default=str)
+        os.rename(tmp_path, self.path)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.write()
+            except (IOError, OSError) as e:
+                print("MetricsFileSink: could not write {}: {}".format(self.path, e))
+            self._stop.wait(self.interval_sec)
+
+    def stop(self):
+        self._stop.set()
+
+
+class MetricsHTTPServer():
+    """
+    Serves /metrics (prometheus text) and /metrics.json from a daemon thread.  Binds to localhost
+    unless told otherwise.
+    """
+    def __init__(self, metrics, port=9108, host='127.0.0.1'):
+        self.metrics = metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path.startswith('/metrics.json'):
+                    body = json.dumps(metrics.snapshot(), default=str)
+                    content_type = 'application/json'
+                elif handler.path.startswith('/metrics'):
+                    body = metrics.to_prometheus()
+                    content_type = 'text/plain; version=0.0.4'
+                else:
+                    handler.send_error(404)
+                    return
+                body = body.encode('utf-8')
+                handler.send_response(200)
+                handler.send_header('Content-Type', content_type)
+                handler.send_header('Content-Length', str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, *args):
+                pass
+
+        self.server = HTTPServer((host, port), Handler)
+        self.port = self.server.server_address[1]
+        self._thread = threading.Thread(target=self.server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
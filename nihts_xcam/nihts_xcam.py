@@ -1,139 +1,283 @@
 import numpy as np
 import ctypes
-import xenics
+try:
+    import xenics
+except ImportError:  # extension not built; only a simulated backend can be used
+    xenics = None
 from astropy.io import fits
 import time
 import os
 import subprocess
+import threading
+import collections
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
 
 
-# TODO: better ctrl-c handling to kill just current sequence
 # TODO: include a github tag stamp whatever in each FITS header
 
 
-import xmltodict
 import stomp
-from stomp.listener import ConnectionListener
 import sys
 import datetime as dt
 
+from .timing import StageTimer
+from .metrics import AcquisitionMetrics, MetricsFileSink, MetricsHTTPServer
+from .temperature import TemperatureMonitor
+from .buffers import FramePool
+from .cube_writer import CubeWriter, FrameMetadata
+from .filenames import FileNumberAllocator
+from .spool import SpoolWriter
+from .live import LiveFramePublisher
+from .quicklook import CalibrationLibrary, QuickLook, Region, header_cards
+from .ramp import RampAccumulator
+from .telemetry import TelemetryStore, TelemetryClient
+
 default_host = 'joe.lowell.edu'
 default_port = 61613
 
 
-class tcsStatus_subscriber(ConnectionListener):
-    def on_message(self, headers, body):
-        xml = xmltodict.parse(body)
-        getset_dct_status(tcsStatus=xml)
-                                      
-                                      
-class tcsTelemetry_subscriber(ConnectionListener):
-    def on_message(self, headers, body):
-        xml = xmltodict.parse(body)
-        getset_dct_status(tcsTelemetry=xml)
-                                      
-                                      
-class aos_subscriber(ConnectionListener):
-    def on_message(self, headers, body):
-        xml = xmltodict.parse(body)
-        getset_dct_status(aos=xml)
-
-
-def getset_dct_status(tcsStatus=None, tcsTelemetry=None, aos=None, save_status=[None, None, None]):
-    # is used for BOTH getting/setting TCS/AOS status
-    if tcsStatus is not None:
-        save_status[0] = tcsStatus
-    if tcsTelemetry is not None:
-        save_status[1] = tcsTelemetry
-    if aos is not None:
-        save_status[2] = aos
-    tcsStatus_xml = save_status[0]
-    tcsTelemetry_xml = save_status[1]
-    aos_xml = save_status[2]
-    if tcsStatus is None and tcsTelemetry is None and aos is None:
-        return tcsStatus_xml, tcsTelemetry_xml, aos_xml
+class PwrUsbSwitch():
+    """
+    Camera power via the `pwrusb` command line tool (outlet 1).
+    """
+    def __init__(self, outlet=1):
+        self.outlet = outlet
+
+    def _set(self, state):
+        cmd = "pwrusb setone {} {}".format(self.outlet, state)
+        print("Powering {} camera with `{}`".format("on" if state else "off", cmd))
+        p = subprocess.Popen(cmd, shell=True)
+        p.wait()
+
+    def on(self):
+        self._set(1)
+
+    def off(self):
+        self._set(0)
 
 
 class XenicsCamera():
-    def __init__(self):
+    """
+    Control of the Xenics camera.
+
+    By default this talks to real hardware: the compiled `xenics` extension, the `pwrusb` power switch
+    and the DCT STOMP broker.  Each of these can be swapped out, e.g. for the pieces in
+    nihts_xcam.simulated_xenics, to run without hardware:
+
+        backend - module/object with the same functions as the `xenics` extension
+        power_switch - object with on() and off()
+        stomp_connection_factory - called with [(host, port)], returns a stomp.Connection-like object
+        obsdatadir - top level data directory (default ~/xcam-data/)
+        power_on_timeout_sec - how long to keep looking for the camera on USB after powering it on
+        ready_timeout_sec - how long to wait, after opening it, for the camera to deliver a frame
+        live_name - name of the shared memory file each frame is published to for viewers (see
+                    nihts_xcam.live), or None not to publish
+    """
+    def __init__(self, backend=None, power_switch=None, stomp_connection_factory=None, obsdatadir=None,
+                 power_on_timeout_sec=10., ready_timeout_sec=10., live_name='xcam-live'):
+        if backend is None:
+            if xenics is None:
+                raise ImportError("xenics extension is not built; run `make` in nihts_xcam/ or pass a backend")
+            backend = xenics
+        self._xenics = backend
+        self._power_switch = power_switch if power_switch is not None else PwrUsbSwitch()
+        if stomp_connection_factory is None:
+            stomp_connection_factory = stomp.Connection
+        self._power_on_timeout_sec = power_on_timeout_sec
+        self._ready_timeout_sec = ready_timeout_sec
+        # seconds taken by each phase of the last camera start-up or reconnect (see _open_camera)
+        self.startup_timings = collections.OrderedDict()
         self._pwm = 3000  
         self._exptime_sec = 1.0
         self._gain = False  # not sure if True is what xenics calls low or high gain, but True -> deeper wells, more e- per ADU.
         self._fan = True
-        if self._open_camera():
-            self._coadds = 1
-            self._nexp = 1
-            self._target_name = "Default Object Name"
-            self._max_height = xenics.get_max_height()
-            self._max_width = xenics.get_max_width()
-            self._cur_file_num = 1
+        # exposure settings last confirmed written to the camera (see _apply_settings); empty = unknown
+        self._registers = {}
+        # held for register access from python, so the temperature monitor thread doesn't interleave
+        # its reads with other commands
+        self._usb_lock = threading.RLock()
+        self.metrics = AcquisitionMetrics()
+        self.telemetry = TelemetryStore()
+        # one broker connection for all the telemetry topics, connected in the background
+        self.telemetry_client = TelemetryClient(self.telemetry, stomp_connection_factory,
+                                                [(default_host, default_port)])
+        self.telemetry_client.start()
+        if not self._open_camera():
+            # don't leave the telemetry thread running, or the camera powered, behind a half-built object
+            self.telemetry_client.stop()
+            self._xenics.close_camera()
+            self._power_switch.off()
+            raise IOError("camera did not start up (see the messages above)")
+        self._report_startup()
+        self._coadds = 1
+        self._nexp = 1
+        self._target_name = "Default Object Name"
+        self._pipelined = False
+        self._pipeline_depth = 3
+        self._coadd_mode = 'stack'
+        self._coadd_stats = ()
+        self._ramp_settings = {'read_noise_adu': 15., 'e_per_adu': 1., 'saturation_adu': 60000.,
+                               'jump_nsigma': 6.}
+        self._ramp = None
+        self._output_mode = 'frames'
+        self._chunk_frames = 100
+        self._compress = False
+        self._cube_writer = None
+        self._spool = None
+        self._spool_slots = 256
+        self._spool_processes = 2
+        self._live_name = live_name
+        self._live = None
+        # master dark/flat/bad pixel maps for the quick-look stage, keyed by (exptime, gain)
+        self.calibrations = CalibrationLibrary()
+        self._quicklook = None
+        self.quicklook_results = None
+        # passed to capture_coadd for the stats that aren't being kept
+        self._no_sumsq = np.zeros(0, dtype=np.float64)
+        self._no_minmax = np.zeros(0, dtype=ctypes.c_ushort)
+        self._abort_requested = False
+        self.timer = StageTimer()
+        # capture stacks and sum images, reused from one frame/sequence to the next
+        self._frame_pool = FramePool()
+        self._temperature_monitor = TemperatureMonitor(self._xenics.get_temperature_ADU,
+                                                       self._xenics.get_temperature_ADCtype,
+                                                       cadence_sec=1., lock=self._usb_lock)
+        self._temperature_monitor.start()
+        self._max_height = self._xenics.get_max_height()
+        self._max_width = self._xenics.get_max_width()
+        # window of interest (x0, y0, width, height, xinc, yinc) and the [height, width] of the
+        # frames read out with it
+        self._window = (0, 0, self._max_width, self._max_height, 1, 1)
+        self._frame_shape = (self._max_height, self._max_width)
+        if obsdatadir is None:
             obsdatadir = os.path.expanduser('~/xcam-data/')
-            if not os.path.isdir(obsdatadir):
-                os.mkdir(obsdatadir)
-            self.obsdatadir = obsdatadir
-            self._last_datadir_used = self._get_current_datadir()
-        self.tcsStatus_conn = stomp.Connection([(default_host, default_port)])
-        self.tcsStatus_conn.set_listener('tcs-status-subscriber', tcsStatus_subscriber())
-        self.tcsStatus_conn.start()
-        self.tcsStatus_conn.connect()
-        self.tcsStatus_conn.subscribe('/topic/TCS.TCSSharedVariables.TCSHighLevelStatusSV.TCSTcsStatusSV', 123)
-        self.tcsTelemetry_conn = stomp.Connection([(default_host, default_port)])
-        self.tcsTelemetry_conn.set_listener('tcs-telemetry-subscriber', tcsTelemetry_subscriber())
-        self.tcsTelemetry_conn.start()
-        self.tcsTelemetry_conn.connect()
-        self.tcsTelemetry_conn.subscribe('/topic/tcs.loisTelemetry', 234)
-        self.aos_conn = stomp.Connection([(default_host, default_port)])
-        self.aos_conn.set_listener('aos-status-subscriber', aos_subscriber())
-        self.aos_conn.start()
-        self.aos_conn.connect()
-        self.aos_conn.subscribe('/topic/AOS.AOSPubDataSV.AOSDataPacket', 345)
+        if not os.path.isdir(obsdatadir):
+            os.mkdir(obsdatadir)
+        self.obsdatadir = obsdatadir
+        self._filenames = FileNumberAllocator(obsdatadir)
+        self._get_current_datadir()
+        self.spool_dir = os.path.join(obsdatadir, '.spool')
 
     def _get_current_datadir(self):
-        today_str = dt.datetime.utcnow().date().isoformat()
-        datadir = os.path.join(self.obsdatadir, today_str)
-        if not os.path.isdir(datadir):
-            os.mkdir(datadir)
-        return datadir
-    
+        return self._filenames.datadir()
+
     def _get_next_filename(self):
-        datadir = self._get_current_datadir()
-        if datadir != self._last_datadir_used:  # reset if UT date has changed
-            self._cur_file_num = 1
-        filename = os.path.join(datadir, 
-                                "{0}_{1:04n}.fits".format(dt.datetime.utcnow().date().isoformat(), 
-                                                          self._cur_file_num))
-        while os.path.exists(filename):
-            self._cur_file_num += 1
-            filename = os.path.join(datadir, 
-                                    "{0}_{1:04n}.fits".format(dt.datetime.utcnow().date().isoformat(), 
-                                                              self._cur_file_num))
-        self._last_datadir_used = datadir
-        return filename
+        return self._filenames.next_filename()
 
-    def _open_camera(self):
-        print("Powering on camera with `pwrusb setone 1 1`")
-        p = subprocess.Popen("pwrusb setone 1 1", shell=True)
-        p.wait()
+    def _poll(self, ready, timeout_sec, poll_sec=0.25):
+        """Call ready() every poll_sec until it returns True (-> True) or timeout_sec has passed (-> False)."""
+        deadline = time.time() + timeout_sec
+        while not ready():
+            if time.time() > deadline:
+                return False
+            time.sleep(poll_sec)
+        return True
+
+    def _open_camera(self, power_on=True):
+        """
+        Bring the camera up, timing each phase into self.startup_timings:
+            power_on - switch on the power (skipped for a warm reconnect)
+            usb - open_camera() retried until the camera has enumerated on USB
+            ready - check_frame_read() retried until a frame comes through
+            settings - integration time, gain, fan and PWM written (_apply_settings)
+        The telemetry connection comes up in the background meanwhile (see TelemetryClient).
+
+        Returns False, having printed why, if any phase fails.  The timings are reported by
+        _report_startup() once the caller has finished bringing the camera up.
+        """
+        timings = self.startup_timings
+        timings.clear()
+        t0 = t = time.time()
+        if power_on:
+            self._power_switch.on()
+            timings['power_on'] = time.time() - t
         self.serial_number = '3731'
         print("Assuming camera serial number is {}".format(self.serial_number))
-        time.sleep(3)
-        if xenics.open_camera() != 0:
-            print("Camera was not opened successfully.  Is it plugged in to USB and powered on?")
+        t = time.time()
+        if not self._poll(lambda: self._xenics.open_camera() == 0, self._power_on_timeout_sec):
+            print("Camera was not found on USB within {} sec.  Is it plugged in to USB and powered on?".format(
+                  self._power_on_timeout_sec))
             return False
-        print("waiting 5 sec after opening camera for connection to stabilize")
-        time.sleep(5)
-        self.set_pwm(self._pwm)
-        self.exptime(self._exptime_sec)
-        self.set_gain(self._gain)
-        self.set_fan(True)
+        timings['usb'] = time.time() - t
+        t = time.time()
+        if not self._poll(lambda: self._xenics.check_frame_read() == 0, self._ready_timeout_sec, poll_sec=0.05):
+            print("Camera was opened but sent no frames within {} sec.".format(self._ready_timeout_sec))
+            return False
+        timings['ready'] = time.time() - t
+        t = time.time()
+        self._fan = True
+        self._registers = {}
+        try:
+            self._apply_settings()
+        except IOError as e:
+            print("Camera was opened but its settings could not be written: {}".format(e))
+            return False
+        timings['settings'] = time.time() - t
+        timings['total'] = time.time() - t0
+        return True
+
+    def _report_startup(self):
+        """Publish self.startup_timings as the startup_*_sec gauges and print them."""
+        timings = self.startup_timings
+        for phase, sec in timings.items():
+            self.metrics.set_gauge('startup_{}_sec'.format(phase), sec)
+        print("camera ready in {:.2f} sec ({})".format(
+              timings['total'], ', '.join('{} {:.2f}'.format(phase, sec) for phase, sec in timings.items()
+                                          if phase != 'total')))
+
+    def reconnect(self, power_cycle=False):
+        """
+        Close and re-open the camera's USB connection, e.g. after a USB glitch, then restore its settings
+        and window of interest.  Without power_cycle the camera stays powered (a warm reconnect), which
+        skips the power-on and USB enumeration wait.  Timings, including the window's, are in
+        self.startup_timings.  Background temperature sampling stops meanwhile, and only starts again
+        once the camera is open.
+
+        Returns True if the camera came back.  If it didn't, it is left closed with temperature sampling
+        stopped; try again, e.g. with power_cycle=True.  Raises IOError if the camera came back but its
+        window couldn't be restored.
+        """
+        # stopped outside the USB lock, as its thread may be waiting for it
+        self._temperature_monitor.stop()
+        with self._usb_lock:
+            self._xenics.close_camera()
+            if power_cycle:
+                self._power_switch.off()
+                time.sleep(1)
+            if not self._open_camera(power_on=power_cycle):
+                return False
+            try:
+                if self._window_if_set() is not None:
+                    t = time.time()
+                    ret = self._xenics.set_window(*self._window)
+                    if ret != 0:
+                        raise IOError("camera reconnected, but error {} restoring window {}; set it again with "
+                                      "window()".format(ret, self._window))
+                    timings = self.startup_timings
+                    total = timings.pop('total')
+                    timings['window'] = time.time() - t
+                    timings['total'] = total + timings['window']
+            finally:
+                self._temperature_monitor.start()
+        self._report_startup()
         return True
 
     def close_camera(self):
-        xenics.close_camera()
+        self._temperature_monitor.stop()
+        if self._live is not None:
+            self._live.close()
+            self._live = None
+        if self._spool is not None:
+            print("waiting for {} spooled frames to be written as FITS".format(self._spool.pending()))
+            self._spool.close()
+            self._spool = None
+        self.telemetry_client.stop()
+        self._xenics.close_camera()
         time.sleep(1)
-        print("Powering off camera with `pwrusb setone 1 0`")
-        p = subprocess.Popen("pwrusb setone 1 0", shell=True)
-        p.wait()
+        self._power_switch.off()
 
     def set_pwm(self, new_pwm):
         """
@@ -143,9 +287,8 @@ class XenicsCamera():
         
         It is not recommended to run the camera at max power for long periods of time.
         """
-        new_pwm = min(max(0, new_pwm), 4095)
-        xenics.set_pwm(new_pwm)
-        self._pwm = new_pwm
+        self._pwm = min(max(0, new_pwm), 4095)
+        self._apply_settings()
     
     def set_fan(self, new_fan):
         """
@@ -153,8 +296,8 @@ class XenicsCamera():
         
         Currently there is no reason to ever turn off the cooling fan.
         """
-        xenics.set_fan(new_fan)
         self._fan = new_fan
+        self._apply_settings()
         
     def set_gain(self, new_gain):
         """
@@ -162,9 +305,10 @@ class XenicsCamera():
         True - deeper wells w/ more electrons per ADU      (longer exposure times, but more quantization noise)
         False - shallower wells w/ fewer electons per ADU  (shorter exposure times)
         """
-        xenics.set_gain(new_gain)
-        self.set_fan(self._fan)  # added 2015-06-19 because changing gain was turning off fan
+        # (changing gain was turning off the fan, 2015-06-19; the driver now re-sends the fan state
+        # after every command word write)
         self._gain = new_gain
+        self._apply_settings()
     
     def get_pwm(self):
         return self._pwm
@@ -182,14 +326,68 @@ class XenicsCamera():
         if no input is given, just returns the current exptime in seconds.
         """
         if exptime_sec is not None:
-            min_exptime_sec = 0.005
-            if exptime_sec <= min_exptime_sec: # force a minimum 5 msec exposure, is arbitrary limit
-                exptime_sec = min_exptime_sec
-                print("Exposure time was shorter than minimum " +
-                      "({} sec), resetting to minimum".format(min_exptime_sec))
-            xenics.set_integration_time_millisec(np.int(np.round(exptime_sec * 1000.)))
-            self._exptime_sec = exptime_sec
+            self._set_exptime(exptime_sec)
+            self._apply_settings()
         return self._exptime_sec
+
+    def configure(self, exptime_sec=None, gain=None):
+        """
+        Set exposure time and/or gain together, with a single write of whatever changed.
+
+        A sequence still finishing its headers and writes is unaffected (each frame's header values are
+        recorded when it is captured), so the next sequence's settings can go to the camera while the
+        current one drains; see nihts_xcam.scheduler.
+        """
+        if exptime_sec is not None:
+            self._set_exptime(exptime_sec)
+        if gain is not None:
+            self._gain = gain
+        return self._apply_settings()
+
+    def _set_exptime(self, exptime_sec):
+        min_exptime_sec = 0.005
+        if exptime_sec <= min_exptime_sec: # force a minimum 5 msec exposure, is arbitrary limit
+            exptime_sec = min_exptime_sec
+            print("Exposure time was shorter than minimum " +
+                  "({} sec), resetting to minimum".format(min_exptime_sec))
+        self._exptime_sec = exptime_sec
+
+    def _apply_settings(self):
+        """
+        Bring the camera's integration time, gain, fan and PWM in line with the current settings, in one
+        driver call (apply_settings) that sends only what changed and takes dummy frames only if the
+        integration time or gain changed.  Does nothing at all if the last confirmed write already
+        matches.  Returns True if anything was written, False if nothing needed to be.
+
+        Raises IOError if the driver reports an error; the camera's settings are then unknown, so they
+        are all written again on the next call.
+        """
+        wanted = {'integration_time_millisec': int(round(self._exptime_sec * 1000.)),
+                  'gain': bool(self._gain), 'fan': bool(self._fan), 'pwm': self._pwm}
+        if wanted == self._registers:
+            self.metrics.increment('settings_unchanged')
+            return False
+        with self._usb_lock:
+            ret = self._xenics.apply_settings(wanted['integration_time_millisec'], wanted['gain'],
+                                              wanted['fan'], wanted['pwm'])
+            self.metrics.set_counter('register_writes_skipped', self._xenics.get_register_writes_skipped())
+            self.metrics.set_counter('dummy_frames', self._xenics.get_dummy_frames_taken())
+        if ret not in (0, -1):  # XCC error bits; negative if they include XCC_E
+            self._registers = {}
+            raise IOError("error {} writing camera settings {}; they will all be written again next time".format(
+                          ret, wanted))
+        self._registers = wanted
+        return ret == 0
+
+    def resync(self):
+        """
+        Forget what the camera is believed to be set to and write every setting again, for when it
+        seems to have lost one (there have been occasional hints that it can 'forget' its PWM).
+        """
+        with self._usb_lock:
+            self._xenics.invalidate_register_cache()
+        self._registers = {}
+        self._apply_settings()
         
     def coadds(self, input=None):
         """
@@ -221,25 +419,251 @@ class XenicsCamera():
             self._target_name = input
         return self._target_name
             
+    def abort(self):
+        """
+        Stop the current sequence.
+
+        The frame being captured is abandoned between coadds and not written; frames already
+        captured are still written to disk.  Safe to call from any thread.
+        """
+        self._abort_requested = True
+        self._xenics.request_capture_abort()
+
+    def start_metrics_file(self, path, interval_sec=5.):
+        """
+        Rewrite `path` with a JSON snapshot of self.metrics every interval_sec.  Returns the sink (call .stop()).
+        """
+        return MetricsFileSink(self.metrics, path, interval_sec=interval_sec)
+
+    def start_metrics_server(self, port=9108, host='127.0.0.1'):
+        """
+        Serve self.metrics at http://host:port/metrics (prometheus) and /metrics.json.  Returns the server.
+        """
+        return MetricsHTTPServer(self.metrics, port=port, host=host)
+
+    def _update_capture_counts(self):
+        timeouts = self._xenics.get_usb_timeout_count()
+        underruns = self._xenics.get_usb_underrun_count()
+        errors = self._xenics.get_usb_error_count()
+        self.metrics.set_counter('usb_timeouts', timeouts)
+        self.metrics.set_counter('usb_underruns', underruns)
+        self.metrics.set_counter('usb_errors', errors)
+        self.metrics.set_counter('frames_dropped', timeouts + underruns + errors)
+        self.metrics.set_counter('frames_read', self._xenics.get_frames_ok_count())
+
+    def pipelined(self, input=None, depth=None):
+        """
+        True/False selects pipelined acquisition in go().
+
+        In pipelined mode a capture thread fills up to `depth` pooled coadd stacks while separate
+        threads do the coadd sum, header building and FITS writing, connected by bounded queues.
+        If the writer falls behind, capture blocks until a stack is free again.
+        
+        If no input is given, just returns the current setting.
+        """
+        if input is not None:
+            self._pipelined = input
+        if depth is not None:
+            self._pipeline_depth = max(1, int(depth))
+        return self._pipelined
+
+    def coadd_mode(self, input=None, stats=None):
+        """
+        How go() sums coadds:
+            'stack' - capture all coadds into a [coadds, 256, 320] uint16 stack, then sum it (default)
+            'stream' - the driver adds each frame into an int32 sum as it is read (capture_coadd), so
+                       memory use doesn't grow with the number of coadds and the sum is ready as soon
+                       as the last frame lands
+            'ramp' - up the ramp: the detector is reset at the start of each frame and the coadds are
+                     nondestructive reads of it, exptime_sec apart.  Each read is folded into a
+                     per-pixel least squares slope fit as it arrives (nihts_xcam.ramp), with saturated
+                     reads left out and jumps (cosmic rays) splitting the fit, so memory doesn't grow
+                     with the number of reads.  The image written is the rate in ADU/s (float32), with
+                     VARIANCE and DQ (flags, see nihts_xcam.ramp) extensions; 'frames' output only, and
+                     no quick-look or live frames.  Fit parameters are set with ramp_settings()
+
+        stats is a list of extra per-pixel images to keep over the coadds and write as extensions:
+            'variance' - VARIANCE extension, (sumsq - sum**2/n) / (n - 1)
+            'minmax' - MIN and MAX extensions, e.g. for rejecting cosmic rays (sum - max)
+        In 'stream' mode frames whose USB read failed are left out of the stats (and the sum); the
+        number kept is in the COADDOK header card.
+
+        If no input is given, just returns the current mode.
+        """
+        if input is not None:
+            if input not in ('stack', 'stream', 'ramp'):
+                raise ValueError("coadd mode must be 'stack', 'stream' or 'ramp', not {!r}".format(input))
+            self._coadd_mode = input
+        if stats is not None:
+            for stat in stats:
+                if stat not in ('variance', 'minmax'):
+                    raise ValueError("unknown coadd stat {!r}; choose from 'variance', 'minmax'".format(stat))
+            self._coadd_stats = tuple(stats)
+        return self._coadd_mode
+
+    def ramp_settings(self, **kwargs):
+        """
+        Parameters of the up-the-ramp fit in coadd_mode('ramp') (see nihts_xcam.ramp.RampAccumulator):
+            read_noise_adu, e_per_adu - detector read noise and gain, for the variance and jump threshold
+            saturation_adu - reads at or above this are left out of the fit
+            jump_nsigma - a read this many sigma off the pixel's ramp starts a new segment of the fit
+
+        Returns the current settings.
+        """
+        for name, value in kwargs.items():
+            if name not in self._ramp_settings:
+                raise ValueError("unknown ramp setting {!r}; choose from {}".format(
+                                 name, ', '.join(sorted(self._ramp_settings))))
+            self._ramp_settings[name] = float(value)
+        return dict(self._ramp_settings)
+
+    def output_mode(self, input=None, chunk_frames=None, compress=None):
+        """
+        How go() writes frames to disk:
+            'frames' - one FITS file per frame (default)
+            'cube' - frames go into chunk files of up to chunk_frames frames each, a [n, 256, 320] cube
+                     plus a FRAMES binary table of the per-frame header values (see nihts_xcam.cube_writer)
+            'spool' - frames are copied into a memory-mapped spool file in self.spool_dir and turned into
+                      the usual one-per-frame FITS files by worker processes in the background (see
+                      nihts_xcam.spool); close_camera() waits for them to finish
+
+                      NOTE: the workers are started with multiprocessing's 'spawn' method (a fork of a
+                      process holding the camera's USB handle and threads isn't safe), and each worker
+                      re-imports the __main__ module.  A script that uses 'spool' must therefore keep its
+                      camera code under `if __name__ == '__main__':`, or every worker will run it too
+                      (opening the camera again, etc.).  IPython sessions and `python -m` are fine.
+
+        compress=True also writes each finished chunk as a Rice tile-compressed .fz file in a background
+        thread, and removes the uncompressed chunk.  The coadd stats extensions (coadd_mode) are only
+        available with 'frames'.
+
+        If no input is given, just returns the current mode.
+        """
+        if input is not None:
+            if input not in ('frames', 'cube', 'spool'):
+                raise ValueError("output mode must be 'frames', 'cube' or 'spool', not {!r}".format(input))
+            self._output_mode = input
+        if chunk_frames is not None:
+            self._chunk_frames = max(1, int(chunk_frames))
+        if compress is not None:
+            self._compress = compress
+        return self._output_mode
+
+    def window(self, input=None, increment=None):
+        """
+        Window of interest read out by the camera: (x0, y0, width, height) in full-frame pixels, x0/y0
+        0-based, or 'full' for the whole 320x256 detector.  Smaller windows read out (and go over USB)
+        proportionally faster, for fast guiding or occultation work.
+
+        increment (n or (xinc, yinc), 1-15) reads out only every n'th column/row of the window.  This
+        is subsampling done by the camera, not binning.
+
+        Frames, cubes, the spool and the live frames all take the window's size.  Each header records
+        where the frame came from: DETSEC, and LTV1/LTV2/LTM1_1/LTM2_2 (the IRAF convention, giving
+        full-frame pixel = (frame pixel - LTV) / LTM).  Quick-look regions and calibrations stay in
+        full-frame pixels.  Changing the window closes the live frame file and spool, which are reopened
+        at the new size by the next go(); live frame clients need to reattach.
+
+        Returns the current (x0, y0, width, height, xinc, yinc).
+        """
+        if input is not None or increment is not None:
+            x0, y0, width, height, xinc, yinc = self._window
+            if isinstance(input, str):
+                if input != 'full':
+                    raise ValueError("window must be (x0, y0, width, height) or 'full', not {!r}".format(input))
+                x0, y0, width, height = 0, 0, self._max_width, self._max_height
+            elif input is not None:
+                x0, y0, width, height = [int(v) for v in input]
+            if increment is not None:
+                xinc, yinc = (increment, increment) if np.isscalar(increment) else increment
+            with self._usb_lock:
+                ret = self._xenics.set_window(x0, y0, width, height, int(xinc), int(yinc))
+                if ret == -1:
+                    raise ValueError("window {} with increment {} doesn't fit on the {}x{} detector".format(
+                                     (x0, y0, width, height), (xinc, yinc), self._max_width, self._max_height))
+                if ret != 0:
+                    raise IOError("error {} setting window {} with increment {}; the camera's window is now "
+                                  "unknown, set it again".format(ret, (x0, y0, width, height), (xinc, yinc)))
+                frame_shape = (self._xenics.get_frame_height(), self._xenics.get_frame_width())
+            self._window = (x0, y0, width, height, int(xinc), int(yinc))
+            if frame_shape != self._frame_shape:
+                self._frame_shape = frame_shape
+                if self._live is not None:
+                    self._live.close()
+                    self._live = None
+                if self._spool is not None:
+                    self._spool.close()
+                    self._spool = None
+        return self._window
+
+    def quicklook(self, input=None, regions=None):
+        """
+        True/False turns on/off the quick-look stage: each coadded frame is calibrated with the master
+        dark/flat/bad pixel maps in self.calibrations for the current exptime and gain, and the background,
+        flux, centroid and FWHM measured in each region (see nihts_xcam.quicklook).  The results go into the
+        header as QL<n>X, QL<n>Y, QL<n>FWHM, QL<n>FLUX, QL<n>BKG for the n'th region, and onto the
+        self.quicklook_results queue.
+
+        regions is a list of quicklook.Region, or of (name, y, x, half_size) boxes around a position, e.g.
+            camera.quicklook(True, regions=[('slit', 128, 160, 10)])
+
+        If no input is given, just returns whether the stage is on.
+        """
+        if regions is not None:
+            regions = [region if isinstance(region, Region) else Region.around(*region) for region in regions]
+        if input is not None:
+            if input and self._quicklook is None:
+                self._quicklook = QuickLook(self.calibrations, regions if regions is not None else ())
+                self.quicklook_results = self._quicklook.results
+            elif not input:
+                self._quicklook = None
+        if regions is not None and self._quicklook is not None:
+            self._quicklook.regions = regions
+        return self._quicklook is not None
+
+    def temperature_cadence(self, input=None):
+        """
+        Seconds between background temperature samples (see TemperatureMonitor).
+        
+        If no input is given, just returns the current cadence.
+        """
+        if input is not None:
+            self._temperature_monitor.cadence_sec = input
+        return self._temperature_monitor.cadence_sec
+
     def _get_ADU_temperature(self, nreads=5):
         adu = np.zeros([nreads])
-        for i in np.arange(nreads):
-            adu[i] = xenics.get_temperature_ADU()
+        with self._usb_lock:
+            for i in np.arange(nreads):
+                adu[i] = self._xenics.get_temperature_ADU()
         return np.median(adu)
 
     def _get_ADCtype_temperature(self, nreads=5):
         adc = np.zeros([nreads])
-        for i in np.arange(nreads):
-            adc[i] = xenics.get_temperature_ADCtype()
+        with self._usb_lock:
+            for i in np.arange(nreads):
+                adc[i] = self._xenics.get_temperature_ADCtype()
         return np.median(adc)
 
+    def _lookup_temperatures(self, times):
+        """
+        Background-sampled (adu, adctype) temperatures nearest each of `times` (seconds since epoch).
+        Only touches the camera if the monitor hasn't taken its first sample yet.
+        """
+        result = self._temperature_monitor.lookup(times)
+        if result is None:
+            self._temperature_monitor.sample()
+            result = self._temperature_monitor.lookup(times)
+        return result
+
     def _convert_adu_to_kelvin(self, adu_value):
         offset_temperature = 55  # TODO: 2012-08-23: am not yet convinced this is right value,
                                  #                   though no strong evidence it's wrong
         return offset_temperature + (50. + ((1133. - (((((adu_value * 2500. ) / 65536.) +
                                                         2866.) * 10.) / 46.)) * (250.)) / (400.))
 
-    def go(self, exptime_sec=None, coadds=None, nexp=None):
+    def go(self, exptime_sec=None, coadds=None, nexp=None, pipelined=None, output=None, on_capture_done=None,
+           aborted=None):
         """
         Take an exposure sequence.
         
@@ -250,169 +674,606 @@ class XenicsCamera():
         Each frame is saved to disk to an automatically generated filename, e.g.:
             ~/xcam-data/YYYY-MM-DD/YYYY_MM-DD-NNNN.fits
         where YYYY-MM-DD is the UT date at the end of the exposure sequence
+
+        pipelined=True overlaps capture of the next frame with the coadd, header building and
+        FITS writing of the previous ones (see pipelined()).  If not given, the current setting is kept.
+        output='frames' or 'cube' likewise chooses between one file per frame and multi-frame chunk
+        files (see output_mode()).  How coadds are summed is set by coadd_mode().
+        on_capture_done, if given, is called with no arguments once the last frame has been read from
+        the camera (or the sequence aborted), before that frame (and, pipelined, earlier ones still in
+        the pipeline) has been coadded and written.
+        aborted, if given, is called with no arguments once go() has cleared any earlier abort(); if it
+        returns True the sequence is aborted there, so that an abort() made (by another thread) just
+        before go() got going isn't lost.
         """
-        self.exptime(exptime_sec)
+        if exptime_sec is not None:
+            self._set_exptime(exptime_sec)
         self.coadds(coadds)
         self.nexp(nexp)
-        # reset PWM start of each sequence; there's been occasional hints that camera can 'forget' its PWM setting
-        self.set_pwm(self._pwm)
-        single_exp_ims = np.zeros([self._coadds, self._max_height, self._max_width], dtype=ctypes.c_ushort)
-        single_exp_ims_1d = single_exp_ims.view().reshape(-1)
-        im = np.zeros([self._max_height, self._max_width], dtype=np.int32)
-        cur_nexp = 0
-        while (cur_nexp < self._nexp) or (self._nexp == -1):
-            cur_nexp += 1
-            tk_adu1 = self._get_ADU_temperature(nreads=5)
-            tk_adc1 = self._get_ADCtype_temperature(nreads=5)
-            start_datetime = dt.datetime.utcnow()
-            start_date_str = start_datetime.isoformat()
-            single_exp_ims_1d[:] = 0
-            xenics.capture_frames(single_exp_ims_1d)
-            # note that numpy automatically upgrades the type to uint64 when doing the sum
-            im[:, :] = single_exp_ims.sum(axis=0)
-            end_datetime = dt.datetime.utcnow()
-            end_date_str = end_datetime.isoformat()
-            print("exp of {} coadds of {} seconds: took {} sec, expected ~ {} sec".format(
-                   self.coadds(), self.exptime(), 
-                   (end_datetime - start_datetime).total_seconds(), 
-                   self.coadds()*self.exptime()))
-            tk_adu2 = self._get_ADU_temperature(nreads=5)
-            tk_adc2 = self._get_ADCtype_temperature(nreads=5)
-            hdu = fits.PrimaryHDU(im)
-            hdulist = fits.HDUList([hdu])
-            hdu.header['OBJECT'] = self._target_name
-            hdu.header['DATE-OBS'] = dt.datetime.utcnow().isoformat()
-            hdu.header['EXPTIME'] = (self._exptime_sec, "exposure time in seconds")
-            hdu.header['COADDS'] = (self._coadds, "number of coadds per frame written to disk")
-            hdu.header['CURNEXP'] = (self._nexp, "current frame number in sequence")
-            hdu.header['NEXP'] = (self._nexp, "total number of frames in current sequence")
-            hdu.header['DATE-BEG'] = (start_date_str, "UT date time at sequence start")
-            hdu.header['DATE-END'] = (end_date_str, "UT date time at sequence end")
-            hdu.header['FILENAME'] = "current.fits"
-            hdu.header['INSTRUME'] = "Xenics serial number {}".format(self.serial_number)
-            hdu.header['PWM'] = (self._pwm, "xenics cooling power setting")
-            hdu.header['FAN'] = (self._fan, "xenics fan setting")
-            hdu.header['TK_ADU1'] = (tk_adu1, 'get_temperature_ADU at sequence start')
-            hdu.header['TK1'] = (self._convert_adu_to_kelvin(tk_adu1), 'T(K) at sequence start')
-            hdu.header['TK_ADC1'] = (tk_adc1, 'get_temperature_ADCtype at sequence start')
-            hdu.header['TK_ADU2'] = (tk_adu2, 'get_temperature_ADU at sequence end')
-            hdu.header['TK2'] = (self._convert_adu_to_kelvin(tk_adu2), 'T(K) at sequence end')
-            hdu.header['TK_ADC2'] = (tk_adc2, 'get_temperature_ADCtype at sequence end')
-            tcsStatus,tcsTelemetry,aos = getset_dct_status()
-            if tcsStatus is not None:
-    #             print(tcs)
-    #             print(aos)
-    # 
-    # TCS Packet:  (rotator fixed)
-    # OrderedDict([(u'tcsTCSStatus', OrderedDict([(u'accessMode', u'Operator'), (u'azCurrentWrap', u'1'), (u'heartbeat', u'8098'), (u'inPositionIsTrue', u'true'), (u'm1CoverState', u'Open'), (u'mountGuideMode', u'OpenLoop'), (u'rotCurrentWrap', u'-1'), (u'tcsHealth', u'GOOD'), (u'tcsState', u'ENABLED'), (u'currentTimes', OrderedDict([(u'lst', OrderedDict([(u'hours', u'9'), (u'minutesTime', u'45'), (u'secondsTime', u'23')])), (u'time', u'2016-04-20T03:16:30.528+00:00')])), (u'limits', OrderedDict([(u'moonProximity', OrderedDict([(u'distance_deg', u'83.382785373422'), (u'proximityFlag', u'false')])), (u'sunProximity', OrderedDict([(u'distance_deg', u'76.564887381463'), (u'proximityFlag', u'false')])), (u'zenith', OrderedDict([(u'currentZD_deg', u'50.837381'), (u'elZenithLimit_deg', u'89.3'), (u'inBlindSpotIsTrue', u'false'), (u'timeToBlindSpot_min', u'-1'), (u'timeToBlindSpotExit_min', u'-1')])), (u'airmass', u'1.580980523677'), (u'currentTimeToObservable_min', u'-1'), (u'currentTimeToUnobservable_min', u'175'), (u'timeToRotLimit_min', u'-1'), (u'timeToAzLimit_min', u'925')])), (u'pointingPositions', OrderedDict([(u'azElError', OrderedDict([(u'azError', u'-0.0252'), (u'elError', u'0.0108')])), (u'currentAzEl', OrderedDict([(u'azimuth', OrderedDict([(u'degreesArc', u'238'), (u'minutesArc', u'5'), (u'secondsArc', u'48.7')])), (u'elevation', OrderedDict([(u'degreesAlt', u'39'), (u'minutesArc', u'9'), (u'secondsArc', u'45.4')]))])), (u'currentHA', OrderedDict([(u'hours', u'2'), (u'minutesTime', u'45'), (u'secondsTime', u'36.11')])), (u'currentRADec', OrderedDict([(u'declination', OrderedDict([(u'degreesDec', u'1'), (u'minutesArc', u'28'), (u'secondsArc', u'47')])), (u'equinoxPrefix', u'J'), (u'equinoxYear', u'2000'), (u'frame', u'FK5'), (u'ra', OrderedDict([(u'hours', u'6'), (u'minutesTime', u'58'), (u'secondsTime', u'54.88')]))])), (u'currentRotatorPositions', OrderedDict([(u'rotPA', u'175.059382'), (u'iaa', u'4.95'), (u'rotIPA', u'180')])), (u'demandAzEl', OrderedDict([(u'azimuth', OrderedDict([(u'degreesArc', u'238'), (u'minutesArc', u'5'), (u'secondsArc', u'49.93')])), (u'elevation', OrderedDict([(u'degreesAlt', u'39'), (u'minutesArc', u'9'), (u'secondsArc', u'45.07')]))])), (u'demandRADec', OrderedDict([(u'declination', OrderedDict([(u'degreesDec', u'1'), (u'minutesArc', u'28'), (u'secondsArc', u'47.4')])), (u'equinoxPrefix', u'J'), (u'equinoxYear', u'2000'), (u'frame', u'FK5'), (u'ra', OrderedDict([(u'hours', u'6'), (u'minutesTime', u'58'), (u'secondsTime', u'54.82')]))])), (u'demandRotatorPositions', OrderedDict([(u'rotPA', u'175.059372')])), (u'targetName', u'0914-0119451'), (u'currentParAngle', u'44.569672815492')])), (u'axesTrackMode', u'All'), (u'inPositionAzIsTrue', u'true'), (u'inPositionElIsTrue', u'true'), (u'inPositionRotIsTrue', u'true'), (u'externalTargetCfgCmdPreviewIsTrue', u'false')]))])
-                hdu.header['TELESCOP'] = ('DCT', 'Telescope name')
-                hdu.header['TCS-TIME'] = (tcsStatus['tcsTCSStatus']['currentTimes']['time'], 'TCS Packet UTC time')
-                hdu.header['TCS-OK'] = (tcsStatus['tcsTCSStatus']['inPositionIsTrue'] == 'true', 'TCS inPositionIsTrue')
-                rah = np.int(tcsStatus['tcsTCSStatus']['pointingPositions']['currentRADec']['ra']['hours'])
-                ram = np.int(tcsStatus['tcsTCSStatus']['pointingPositions']['currentRADec']['ra']['minutesTime'])
-                ras = np.float(tcsStatus['tcsTCSStatus']['pointingPositions']['currentRADec']['ra']['secondsTime'])
-                decd = np.int(tcsStatus['tcsTCSStatus']['pointingPositions']['currentRADec']['declination']['degreesDec'])
-                decm = np.int(tcsStatus['tcsTCSStatus']['pointingPositions']['currentRADec']['declination']['minutesArc'])
-                decs = np.float(tcsStatus['tcsTCSStatus']['pointingPositions']['currentRADec']['declination']['secondsArc'])
-                hdu.header['RA'] = ('{0:2n}:{1:02n}:{2:05.2f}'.format(rah, ram, ras), 'RA HH:MM:SS.SS')
-                hdu.header['DEC'] = ('{0:+3n}:{1:02n}:{2:04.1f}'.format(decd, decm, decs), 'DEC DDD:MM:SS.SS')
-                az = (np.float(tcsStatus['tcsTCSStatus']['pointingPositions']['currentAzEl']['azimuth']['degreesArc']) +
-                      np.float(tcsStatus['tcsTCSStatus']['pointingPositions']['currentAzEl']['azimuth']['minutesArc'])/60. +
-                      np.float(tcsStatus['tcsTCSStatus']['pointingPositions']['currentAzEl']['azimuth']['secondsArc'])/3600.)
-                el = (np.float(tcsStatus['tcsTCSStatus']['pointingPositions']['currentAzEl']['elevation']['degreesAlt']) +
-                      np.float(tcsStatus['tcsTCSStatus']['pointingPositions']['currentAzEl']['elevation']['minutesArc'])/60. +
-                      np.float(tcsStatus['tcsTCSStatus']['pointingPositions']['currentAzEl']['elevation']['secondsArc'])/3600.)
-                hdu.header['AZ'] = (az, 'Azimuth (deg)')
-                hdu.header['EL'] = (el, 'Elevation (deg)')
-                hdu.header['AIRMASS'] = (np.float(tcsStatus['tcsTCSStatus']['limits']['airmass']), 'Airmass')
-                hdu.header['TARGNAME'] = (tcsStatus['tcsTCSStatus']['pointingPositions']['targetName'], 'TCS Target Name')
-                hdu.header['LST'] = ('{0:2n}:{1:02n}:{2:04.1f}'.format(
-                                          int(tcsStatus['tcsTCSStatus']['currentTimes']['lst']['hours']),
-                                          int(tcsStatus['tcsTCSStatus']['currentTimes']['lst']['minutesTime']),
-                                          float(tcsStatus['tcsTCSStatus']['currentTimes']['lst']['secondsTime'])),
-                                     'TCS LST')
-                hdu.header['rotIPA'] = (np.float(tcsStatus['tcsTCSStatus']['pointingPositions']['currentRotatorPositions']['rotIPA']),
-                                        'TCS rotIPA')
-            if tcsTelemetry is not None:
-                # TODO: clean up headers coming from TCS Telemetry, right now am just trying to mirror the xml packet grammar as closely as possible
-                hdu.header['TCSLST'] = (tcsTelemetry['TCSTelemetry']['TCSLST'], 'TCSTelemetry TCSLST')
-                hdu.header['DEMANDRA'] = (tcsTelemetry['TCSTelemetry']['DemandRa'], 'TCSTelemetry DemandRa')
-                hdu.header['DEMANDDE'] = (tcsTelemetry['TCSTelemetry']['DemandDec'], 'TCSTelemetry DemandDec')
-                try:
-                    hdu.header['TCSCURAZ'] = (np.float(tcsTelemetry['TCSTelemetry']['TCSCurrentAzimuth']), 'TCSTelemetry TCSCurrentAzimuth')
-                except ValueError:
-                    hdu.header['TCSCURAZ'] = (tcsTelemetry['TCSTelemetry']['TCSCurrentAzimuth'], 'TCSTelemetry TCSCurrentAzimuth')      
+        if pipelined is not None:
+            self._pipelined = pipelined
+        self.output_mode(output)
+        if self._output_mode != 'frames' and self._coadd_stats:
+            raise ValueError("coadd stats {} can only be written in 'frames' output mode".format(self._coadd_stats))
+        ramp = self._coadd_mode == 'ramp'
+        if ramp and self._output_mode != 'frames':
+            raise ValueError("coadd mode 'ramp' can only be written in 'frames' output mode")
+        if ramp and self._coadd_stats:
+            raise ValueError("coadd stats {} don't apply in coadd mode 'ramp'".format(self._coadd_stats))
+        # one batched write of whatever changed since the last sequence (nothing, back to back); call
+        # resync() if the camera seems to have forgotten a setting such as its PWM
+        self._apply_settings()
+        with self._usb_lock:
+            self._xenics.set_nondestructive(1 if ramp else 0)
+        # the integration time is only a placeholder for the time between reads, which _capture_ramp measures
+        self._ramp = (RampAccumulator(self._frame_shape, self._exptime_sec, **self._ramp_settings)
+                      if ramp else None)
+        self._abort_requested = False
+        self._xenics.clear_capture_abort()
+        if aborted is not None and aborted():
+            self.abort()
+        # drop pooled buffers left over from sequences with a different number of coadds or coadd mode
+        self._frame_pool.trim(keep=self._frame_buffer_specs().values())
+        if self._output_mode == 'cube':
+            self._cube_writer = CubeWriter(self._frame_shape, self._get_next_filename,
+                                           chunk_frames=self._chunk_frames,
+                                           nframes=None if self._nexp == -1 else self._nexp,
+                                           compress=self._compress)
+        if self._output_mode == 'spool' and self._spool is None:
+            self._spool = self._open_spool()
+        if self._live_name is not None and self._live is None and not ramp:
+            self._live = LiveFramePublisher(self._frame_shape, np.int32, name=self._live_name)
+        try:
+            if self._pipelined:
+                self._go_pipelined(on_capture_done)
+            else:
+                self._go_serial(on_capture_done)
+        finally:
+            cube_writer = self._cube_writer
+            self._cube_writer = None
+            if cube_writer is not None:
+                cube_writer.close()
+        # chunks are finished in background threads, so their failures only come to light here
+        if cube_writer is not None and cube_writer.errors:
+            raise IOError("could not finish {} cube chunk(s): {}".format(
+                          len(cube_writer.errors),
+                          '; '.join('{}: {}'.format(filename, e) for filename, e in cube_writer.errors)))
+
+    def _open_spool(self):
+        if not os.path.isdir(self.spool_dir):
+            os.mkdir(self.spool_dir)
+        leftover = [name for name in os.listdir(self.spool_dir) if name.endswith('.spool')]
+        if leftover:
+            print("found spool files from an earlier session in {}; recover frames from them with "
+                  "`python -m nihts_xcam.spool recover <file>`: {}".format(self.spool_dir, ', '.join(leftover)))
+        path = os.path.join(self.spool_dir, 'xcam-{}.spool'.format(time.strftime('%Y%m%dT%H%M%S', time.gmtime())))
+        return SpoolWriter(path, self._frame_shape, dtype=np.int32,
+                           nslots=self._spool_slots, processes=self._spool_processes)
+
+    def _go_serial(self, on_capture_done=None):
+        bufs = self._acquire_frame_buffers(self._frame_pool.acquire)
+        try:
+            cur_nexp = 0
+            while ((cur_nexp < self._nexp) or (self._nexp == -1)) and not self._abort_requested:
+                cur_nexp += 1
+                frame_info = self._capture_one(bufs, cur_nexp)
+                if frame_info is None:
+                    break
+                if cur_nexp == self._nexp and on_capture_done is not None:
+                    # done with the camera; the last frame is coadded and written meanwhile
+                    on_capture_done()
+                    on_capture_done = None
+                self._coadd(bufs, frame_info)
+                self._measure_quicklook(bufs, frame_info)
+                hdulist = self._make_hdu(bufs, frame_info)
+                self._write_hdu(hdulist, frame_info)
+            if on_capture_done is not None:
+                on_capture_done()
+        finally:
+            self._release_frame_buffers(bufs)
+            self.metrics.set_gauge('frame_pool_mb', self._frame_pool.nbytes() / 1e6)
+
+    def _frame_buffer_specs(self):
+        """
+        {name: (shape, dtype)} of the buffers needed per frame in the current coadd mode:
+            stack - [coadds, height, width] raw frames ('stack' mode only), height and width those of
+                    the current window (see window())
+            sum - the coadded image
+            sumsq, variance - per-pixel sum of squares and the variance computed from it ('variance' stat),
+                              plus sum2, float64 scratch for that
+            min, max - per-pixel min and max over the coadds ('minmax' stat)
+            calibrated - float32 calibrated image for the quick-look stage (if it is on)
+        or in 'ramp' mode
+            read, read2 - one nondestructive read each (one being read while the other is fitted)
+            rate, rate_variance, dq - the ramp fit (float32 ADU/s and (ADU/s)**2, uint8 flags)
+        """
+        frame_shape = self._frame_shape
+        if self._coadd_mode == 'ramp':
+            return {'read': (frame_shape, ctypes.c_ushort), 'read2': (frame_shape, ctypes.c_ushort),
+                    'rate': (frame_shape, np.float32),
+                    'rate_variance': (frame_shape, np.float32), 'dq': (frame_shape, np.uint8)}
+        specs = {'sum': (frame_shape, np.int32)}
+        if self._coadd_mode == 'stack':
+            specs['stack'] = ((self._coadds,) + frame_shape, ctypes.c_ushort)
+        if 'variance' in self._coadd_stats:
+            specs['sumsq'] = (frame_shape, np.float64)
+            specs['sum2'] = (frame_shape, np.float64)
+            specs['variance'] = (frame_shape, np.float32)
+        if 'minmax' in self._coadd_stats:
+            specs['min'] = (frame_shape, ctypes.c_ushort)
+            specs['max'] = (frame_shape, ctypes.c_ushort)
+        if self._quicklook is not None:
+            specs['calibrated'] = (frame_shape, np.float32)
+        return specs
+
+    def _acquire_frame_buffers(self, acquire):
+        """
+        One frame's buffers (see _frame_buffer_specs) from acquire(shape, dtype), or None if acquire
+        gives up (returns None) on any of them.
+        """
+        bufs = {}
+        for name, (shape, dtype) in self._frame_buffer_specs().items():
+            buf = acquire(shape, dtype)
+            if buf is None:
+                self._release_frame_buffers(bufs)
+                return None
+            bufs[name] = buf
+        return bufs
+
+    def _release_frame_buffers(self, bufs):
+        for buf in bufs.values():
+            self._frame_pool.release(buf)
+        bufs.clear()
+
+    def _capture_one(self, bufs, cur_nexp):
+        """
+        Capture one coadded frame into bufs: into bufs['stack'] ([coadds, height, width] uint16) in
+        'stack' mode, straight into bufs['sum'] (and the stats buffers) in 'stream' mode.  Every pixel
+        is overwritten (the driver zeroes any frame whose USB read fails), so no clearing is needed.
+
+        Returns a dict of the per-frame values (times, stage timings) needed later to build the header,
+        or None if the sequence was aborted before all coadds were read.
+        """
+        timings = {}
+        ncoadds_ok = None
+        ramp_dt_sec = ramp_sec = None
+        start_time = time.time()
+        start_datetime = dt.datetime.utcnow()
+        with self.timer.stage('capture', timings):
+            if 'read' in bufs:
+                ncoadds_done, ncoadds_ok, ramp_dt_sec, ramp_sec = self._capture_ramp(bufs, timings)
+            elif 'stack' in bufs:
+                stack = bufs['stack']
+                ncoadds_done = self._capture_frames(
+                    lambda i: self._xenics.capture_frames_abortable(stack[i].reshape(-1)))
+            else:
+                sums = [bufs['sum'].reshape(-1)] + [bufs[name].reshape(-1) if name in bufs else empty
+                                                    for name, empty in [('sumsq', self._no_sumsq),
+                                                                        ('min', self._no_minmax),
+                                                                        ('max', self._no_minmax)]]
+                # the first coadd resets the sums, the rest add to them
+                ncoadds_done = self._capture_frames(
+                    lambda i: self._xenics.capture_coadd(*(sums + [1, 1 if i else 0])))
+                ncoadds_ok = self._xenics.get_coadd_frames_ok()
+        end_datetime = dt.datetime.utcnow()
+        end_time = time.time()
+        self._update_capture_counts()
+        if ncoadds_done < self._coadds:
+            self.metrics.increment('frames_aborted')
+            print("sequence aborted at frame {} after {} of {} coadds; partial frame discarded".format(
+                   cur_nexp, ncoadds_done, self._coadds))
+            return None
+        print("exp of {} coadds of {} seconds: took {} sec, expected ~ {} sec".format(
+               self.coadds(), self.exptime(),
+               (end_datetime - start_datetime).total_seconds(),
+               self.coadds()*self.exptime()))
+        return {'cur_nexp': cur_nexp,
+                'start_datetime': start_datetime, 'end_datetime': end_datetime,
+                'start_time': start_time, 'end_time': end_time,
+                'obs_datetime': dt.datetime.utcnow(),
+                'ncoadds_ok': ncoadds_ok,
+                'ramp_dt_sec': ramp_dt_sec, 'ramp_sec': ramp_sec,
+                # the sequence's settings, as the next sequence's may be applied before this frame is written
+                'exptime_sec': self._exptime_sec, 'gain': self._gain, 'coadds': self._coadds,
+                'nexp': self._nexp, 'target': self._target_name,
+                'quicklook': None,
+                'timings': timings}
+
+    def _capture_ramp(self, bufs, timings):
+        """
+        Reset the detector and fold each of the coadds nondestructive reads into self._ramp as it
+        arrives ('ramp' stage, per read), then write the fit into bufs.  Returns (reads done, reads ok,
+        seconds between reads, seconds from the reset to the last read).
+
+        The camera reads once per frame period (integration plus readout, and whatever else holds up
+        the free-running readout), so the time between reads is measured from when the first and last
+        good reads came in, rather than taken to be the integration time.
+
+        Reads alternate between bufs['read'] and bufs['read2'], the next one being read from USB (in a
+        helper thread, without the GIL) while the last is folded in.
+        """
+        ramp = self._ramp
+        reads = (bufs['read'], bufs['read2'])
+
+        def read_one(read):
+            # a read that failed was zeroed by the driver; the frames-ok count tells them apart
+            with self._usb_lock:
+                frames_ok = self._xenics.get_frames_ok_count()
+                done = self._xenics.capture_frames_abortable(read.reshape(-1))
+            return done, self._xenics.get_frames_ok_count() > frames_ok, time.time()
+
+        with self._usb_lock:
+            self._xenics.reset_detector()
+            reset_time = time.time()
+        ramp.start()
+        first = last = None  # (index, time) of the first and last good reads
+        pending = self._start_capture(read_one, reads[0])
+        for i in range(self._coadds):
+            done, ok, read_time = self._join_capture(pending)
+            if done < 1:
+                return i, ramp.nreads_ok, None, None
+            if i + 1 < self._coadds:
+                pending = self._start_capture(read_one, reads[(i + 1) % 2])
+            if ok:
+                last = (i, read_time)
+                if first is None:
+                    first = last
+            with self.timer.stage('ramp', timings):
+                ramp.add(reads[i % 2], ok=ok)
+        if last is None or last[0] == first[0]:
+            # no fit to scale anyway
+            dt_sec, last = ramp.dt_sec, (None, time.time())
+        else:
+            # failed reads still took their frame period, so they count in the spacing
+            dt_sec = (last[1] - first[1]) / (last[0] - first[0])
+        with self.timer.stage('ramp', timings):
+            ramp.finish(bufs['rate'], bufs['rate_variance'], bufs['dq'], dt_sec=dt_sec)
+        return self._coadds, ramp.nreads_ok, dt_sec, last[1] - reset_time
+
+    def _capture_frames(self, capture_one):
+        """
+        Read the frame's coadds, calling capture_one(i) (capture_frames_abortable or capture_coadd, for
+        one frame) for each of them in turn, and return the number of coadds actually read.
+
+        The extension releases the GIL while it reads from USB.  When called from the main thread the
+        reads are done in a helper thread, so that ctrl-c is still seen here and can abort them.
+        _usb_lock is held for each coadd's read and let go in between, so the temperature monitor's
+        register reads happen between frames, never in the middle of a frame's bulk transfer, and
+        carry on through a long stack of coadds.
+        """
+        def run():
+            for i in range(self._coadds):
+                with self._usb_lock:
+                    done = capture_one(i)
+                if done < 1:
+                    return i
+            return self._coadds
+        if threading.current_thread().name != 'MainThread':
+            return run()
+        return self._join_capture(self._start_capture(run))
+
+    def _start_capture(self, capture, *args):
+        """
+        Start capture(*args) in a helper thread; pass what this returns to _join_capture for the result.
+        """
+        result = []
+
+        def run():
+            try:
+                result.append(capture(*args))
+            except Exception as e:
+                result.append(e)
+        t = threading.Thread(target=run)
+        t.start()
+        return t, result
+
+    def _join_capture(self, started):
+        t, result = started
+        while t.is_alive():
+            try:
+                t.join(0.2)
+            except KeyboardInterrupt:
+                self.abort()
+        if isinstance(result[0], Exception):
+            raise result[0]
+        return result[0]
+
+    def _coadd(self, bufs, frame_info):
+        """
+        Sum the stack into bufs['sum'] ('stack' mode) and work out the stats images.
+        """
+        with self.timer.stage('coadd', frame_info['timings']):
+            if 'stack' in bufs:
+                stack = bufs['stack']
+                # summing straight into int32 avoids numpy's default upgrade to a uint64 intermediate
+                stack.sum(axis=0, dtype=np.int32, out=bufs['sum'])
+                if 'sumsq' in bufs:
+                    bufs['sumsq'][:] = 0.
+                    for frame in stack:
+                        np.square(frame, out=bufs['sum2'], dtype=np.float64)
+                        bufs['sumsq'] += bufs['sum2']
+                if 'min' in bufs:
+                    stack.min(axis=0, out=bufs['min'])
+                    stack.max(axis=0, out=bufs['max'])
+            if 'variance' in bufs:
+                n = frame_info['ncoadds_ok'] if frame_info['ncoadds_ok'] is not None else frame_info['coadds']
+                if n > 1:
+                    # (sumsq - sum**2 / n) / (n - 1); in float64, as the two terms nearly cancel
+                    sum2 = bufs['sum2']
+                    np.square(bufs['sum'], out=sum2, dtype=np.float64)
+                    sum2 /= n
+                    np.subtract(bufs['sumsq'], sum2, out=sum2)
+                    sum2 /= (n - 1)
+                    np.copyto(bufs['variance'], sum2, casting='same_kind')
+                else:
+                    bufs['variance'][:] = 0.
+
+    def _measure_quicklook(self, bufs, frame_info):
+        """Run the quick-look stage (see quicklook()) on the coadded frame, if it is on."""
+        ql = self._quicklook
+        if ql is None or 'sum' not in bufs:
+            return
+        with self.timer.stage('quicklook', frame_info['timings']):
+            ncoadds = frame_info['ncoadds_ok'] if frame_info['ncoadds_ok'] is not None else frame_info['coadds']
+            frame_info['quicklook'] = ql.measure(bufs['sum'], frame_info['exptime_sec'], frame_info['gain'], ncoadds,
+                                                 out=bufs.get('calibrated'), window=self._window_if_set(),
+                                                 cur_nexp=frame_info['cur_nexp'],
+                                                 end_time=frame_info['end_time'])
+
+    def _window_if_set(self):
+        return None if self._window == (0, 0, self._max_width, self._max_height, 1, 1) else self._window
+
+    def _make_hdu(self, bufs, frame_info):
+        """
+        The HDUList to be written for one frame: the coadded image, plus VARIANCE/MIN/MAX image
+        extensions if those stats are being kept (see coadd_mode()).  In 'cube' and 'spool' output
+        modes just a FrameMetadata holding the image and header values.
+        """
+        with self.timer.stage('header', frame_info['timings']):
+            if 'rate' in bufs:
+                hdu = fits.PrimaryHDU(bufs['rate'])
+                self._fill_header(hdu.header, frame_info)
+                hdu.header['BUNIT'] = ('ADU/s', 'up the ramp count rate')
+                hdu.header['RAMPREAD'] = (frame_info['coadds'], 'nondestructive reads per ramp')
+                hdu.header['RAMPDT'] = (frame_info['ramp_dt_sec'], 'seconds between reads, measured')
+                hdu.header['RAMPTIME'] = (frame_info['ramp_sec'], 'seconds from detector reset to last read')
+                return fits.HDUList([hdu, fits.ImageHDU(bufs['rate_variance'], name='VARIANCE'),
+                                     fits.ImageHDU(bufs['dq'], name='DQ')])
+            if self._output_mode != 'frames':
+                hdulist = header = FrameMetadata(bufs['sum'])
+                self._fill_header(header, frame_info)
+            else:
+                hdu = fits.PrimaryHDU(bufs['sum'])
+                self._fill_header(hdu.header, frame_info)
+                header = hdu.header
+                hdulist = fits.HDUList([hdu])
+                if 'variance' in bufs:
+                    hdulist.append(fits.ImageHDU(bufs['variance'], name='VARIANCE'))
+                if 'min' in bufs:
+                    hdulist.append(fits.ImageHDU(bufs['min'], name='MIN'))
+                    hdulist.append(fits.ImageHDU(bufs['max'], name='MAX'))
+        # outside the header stage, which would otherwise count the publish time twice
+        self._publish_live(bufs['sum'], header, frame_info)
+        return hdulist
+
+    def _publish_live(self, im, header, frame_info):
+        if self._live is not None:
+            with self.timer.stage('publish', frame_info['timings']):
+                self._live.publish(im, header)
+
+    def _go_pipelined(self, on_capture_done=None):
+        """
+        Pipelined version of the go() loop:
+
+            capture -> coadd_q -> coadd (and quick-look) -> header_q -> header -> write_q -> write
+
+        Each frame's buffers come from the frame pool, at most _pipeline_depth of each kind, so capture
+        blocks (backpressure) when every stack is still waiting on a downstream stage.  The raw stack
+        is returned to the pool after the coadd, everything else only once the FITS write has finished.
+        ctrl-c (or abort()) abandons the frame being captured; frames already captured are still written.
+        """
+        depth = self._pipeline_depth
+        pool = self._frame_pool
+        coadd_q = queue.Queue(maxsize=depth)
+        header_q = queue.Queue(maxsize=depth)
+        write_q = queue.Queue(maxsize=depth)
+        queue_names = {id(coadd_q): 'queue_depth_coadd', id(header_q): 'queue_depth_header',
+                       id(write_q): 'queue_depth_write'}
+        failed = threading.Event()
+        errors = []
+
+        def put(q, item):
+            while not failed.is_set():
                 try:
-                    hdu.header['TCSCUREL'] = (np.float(tcsTelemetry['TCSTelemetry']['TCSCurrentElev']), 'TCSTelemetry TCSCurrentElev')
-                except ValueError:
-                    hdu.header['TCSCUREL'] = (tcsTelemetry['TCSTelemetry']['TCSCurrentElev'], 'TCSTelemetry TCSCurrentElev')
-                hdu.header['MNTGMODE'] = (tcsTelemetry['TCSTelemetry']['MountGuideMode'], 'TCSTelemetry MountGuideMode')
-                hdu.header['SCITARGN'] = (tcsTelemetry['TCSTelemetry']['ScienceTargetName'], 'TCSTelemetry ScienceTargetName')
-                hdu.header['M1COVER'] = (tcsTelemetry['TCSTelemetry']['m1CoverState'], 'TCSTelemetry m1CoverState')
+                    q.put(item, timeout=0.1)
+                    self.metrics.set_gauge(queue_names[id(q)], q.qsize())
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def get(q):
+            while not failed.is_set():
                 try:
-                    hdu.header['DOMEDAZ'] = (np.float(tcsTelemetry['TCSTelemetry']['MountDomeAzimuthDifference']), 'TCSTelemetry MountDomeAzimuthDifference')
-                except ValueError:
-                    hdu.header['DOMEDAZ'] = (tcsTelemetry['TCSTelemetry']['MountDomeAzimuthDifference'], 'TCSTelemetry MountDomeAzimuthDifference')
-                hdu.header['DOMEWARN'] = (tcsTelemetry['TCSTelemetry']['DomeOccultationWarning'], 'TCSTelemetry DomeOccultationWarning')
+                    item = q.get(timeout=0.1)
+                    self.metrics.set_gauge(queue_names[id(q)], q.qsize())
+                    return item
+                except queue.Empty:
+                    pass
+            return None
+
+        def acquire(shape, dtype):
+            while not failed.is_set():
+                buf = pool.acquire(shape, dtype, limit=depth, timeout=0.1)
+                if buf is not None:
+                    return buf
+            return None
+
+        def stage(target, out_q):
+            def run():
                 try:
-                    hdu.header['PARANGLE'] = (np.float(tcsTelemetry['TCSTelemetry']['CurrentParAngle']), 'TCSTelemetry CurrentParAngle')
-                except ValueError:
-                    hdu.header['PARANGLE'] = (tcsTelemetry['TCSTelemetry']['CurrentParAngle'], 'TCSTelemetry CurrentParAngle')
+                    target()
+                except Exception:
+                    errors.append(sys.exc_info())
+                    failed.set()
+                finally:
+                    if out_q is not None:
+                        put(out_q, None)
+            return threading.Thread(target=run)
+
+        def capture():
+            cur_nexp = 0
+            while ((cur_nexp < self._nexp) or (self._nexp == -1)) and not self._abort_requested:
+                bufs = self._acquire_frame_buffers(acquire)
+                if bufs is None:
+                    return
+                cur_nexp += 1
                 try:
-                    hdu.header['TCSroPA'] = (np.float(tcsTelemetry['TCSTelemetry']['TCSCurrentRotatorPA']), 'TCSTelemetry TCSCurrentRotatorPA')
-                except ValueError:
-                    hdu.header['TCSroPA'] = (tcsTelemetry['TCSTelemetry']['TCSCurrentRotatorPA'], 'TCSTelemetry TCSCurrentRotatorPA')
+                    frame_info = self._capture_one(bufs, cur_nexp)
+                except Exception:
+                    self._release_frame_buffers(bufs)
+                    raise
+                if frame_info is None or not put(coadd_q, (bufs, frame_info)):
+                    self._release_frame_buffers(bufs)
+                    break
+            if on_capture_done is not None and not failed.is_set():
+                on_capture_done()
+
+        def coadd():
+            while True:
+                item = get(coadd_q)
+                if item is None:
+                    return
+                bufs, frame_info = item
                 try:
-                    hdu.header['TCSroIAA'] = (np.float(tcsTelemetry['TCSTelemetry']['TCSCurrentRotatorIAA']), 'TCSTelemetry TCSCurrentRotatorIAA')
-                except ValueError:
-                    hdu.header['TCSroIAA'] = (tcsTelemetry['TCSTelemetry']['TCSCurrentRotatorIAA'], 'TCSTelemetry TCSCurrentRotatorIAA')
+                    self._coadd(bufs, frame_info)
+                    self._measure_quicklook(bufs, frame_info)
+                finally:
+                    for name in ('stack', 'read', 'read2'):
+                        if name in bufs:
+                            pool.release(bufs.pop(name))
+                if not put(header_q, item):
+                    self._release_frame_buffers(bufs)
+                    return
+
+        def header():
+            while True:
+                item = get(header_q)
+                if item is None:
+                    return
+                bufs, frame_info = item
                 try:
-                    hdu.header['TCSroIPA'] = (np.float(tcsTelemetry['TCSTelemetry']['TCSCurrentRotatorIPA']), 'TCSTelemetry TCSCurrentRotatorIPA')
-                except ValueError:
-                    hdu.header['TCSroIPA'] = (tcsTelemetry['TCSTelemetry']['TCSCurrentRotatorIPA'], 'TCSTelemetry TCSCurrentRotatorIPA')
-                hdu.header['ROTFRAME'] = (tcsTelemetry['TCSTelemetry']['RotatorFrame'], 'TCSTelemetry RotatorFrame')
-                hdu.header['TARGFRAM'] = (tcsTelemetry['TCSTelemetry']['TargetFrame'], 'TCSTelemetry TargetFrame')
+                    hdulist = self._make_hdu(bufs, frame_info)
+                except Exception:
+                    self._release_frame_buffers(bufs)
+                    raise
+                if not put(write_q, (bufs, hdulist, frame_info)):
+                    self._release_frame_buffers(bufs)
+                    return
+
+        def write():
+            while True:
+                item = get(write_q)
+                if item is None:
+                    return
+                bufs, hdulist, frame_info = item
                 try:
-                    hdu.header['TCSEQUIN'] = (np.float(tcsTelemetry['TCSTelemetry']['equinox']), 'TCSTelemetry equinox')
-                except ValueError:
-                    hdu.header['TCSEQUIN'] = (tcsTelemetry['TCSTelemetry']['equinox'], 'TCSTelemetry equinox')
-                hdu.header['TCSState'] = (tcsTelemetry['TCSTelemetry']['TCSState'], 'TCSTelemetry TCSState')
-                hdu.header['TCSHealt'] = (tcsTelemetry['TCSTelemetry']['TCSHealth'], 'TCSTelemetry TCSHealth')
-                hdu.header['TCSAMODE'] = (tcsTelemetry['TCSTelemetry']['TCSAccessMode'], 'TCSTelemetry TCSAccessMode')
-                hdu.header['TCSINPOS'] = (tcsTelemetry['TCSTelemetry']['InPosition'], 'TCSTelemetry InPosition')
+                    self._write_hdu(hdulist, frame_info)
+                finally:
+                    self._release_frame_buffers(bufs)
+
+        threads = [stage(capture, coadd_q), stage(coadd, header_q), stage(header, write_q), stage(write, None)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            while t.is_alive():
                 try:
-                    hdu.header['TCSMNTTC'] = (np.float(tcsTelemetry['TCSTelemetry']['MountTemperature']), 'TCSTelemetry MountTemperature')
-                except ValueError:
-                    hdu.header['TCSMNTTC'] = (tcsTelemetry['TCSTelemetry']['MountTemperature'], 'TCSTelemetry MountTemperature')
-                hdu.header['CLSLOBAN'] = (tcsTelemetry['TCSTelemetry']['CLSLowBankState'], 'TCSTelemetry CLSLowBankState')
-                hdu.header['DSSPOSST'] = (tcsTelemetry['TCSTelemetry']['DSSPositionStatus'], 'TCSTelemetry DSSPositionStatus')
-                # TODO: consider making a test for age of TCSTelemetry packet age and changing OK status accordingly
-                hdu.header['TCSTELEM'] = (True, 'TCSTelemetry packet OK')
-            else:
-                hdu.header['TCSTELEM'] = (False, 'TCSTelemetry packet not OK')
-    # AOS Packet:
-    # OrderedDict([(u'AOSDataPacket', OrderedDict([(u'timestamp', u'2016-04-20T03:16:29.988+00:00'), (u'detailedState', u'UnlockedOpenLoopState'), (u'summaryState', u'Enabled'), (u'tipTiltPistonDemandM1', OrderedDict([(u'X_Tilt_rad', u'0'), (u'Y_Tilt_rad', u'0'), (u'Piston_m', u'0')])), (u'tipTiltPistonDemandM2', OrderedDict([(u'X_Tilt_rad', u'-0.0001380827127709'), (u'Y_Tilt_rad', u'0.00015234633023942'), (u'Piston_m', u'0.00011020825009747')])), (u'comaPointingOffset', OrderedDict([(u'xCorrection_arcsec', u'-18.538316440227'), (u'yCorrection_arcsec', u'-16.802643163435')])), (u'totalFocusOffset', u'0.0006'), (u'focusOffsetDemandOutOfRange', u'false'), (u'wavefrontDataOutOfRange', u'false'), (u'M1FSettled', u'true'), (u'M1LSettled', u'true'), (u'M1PSettled', u'true'), (u'M2PSettled', u'true'), (u'M2VSettled', u'true')]))])
-
-            if aos is not None:
-                hdu.header['FOCUS'] = (1e6*np.float(aos['AOSDataPacket']['totalFocusOffset']), 'Focus (in microns)')
-                hdu.header['AOSTIME'] = (aos['AOSDataPacket']['timestamp'], 'AOS timestamp')
-                hdu.header['AOSDETAI'] = (aos['AOSDataPacket']['detailedState'], 'AOS detailedState')
-                hdu.header['AOSSUMMA'] = (aos['AOSDataPacket']['summaryState'], 'AOS summaryState')
-                # have not bothered to inlude tiptilt pistons, coma pointing offsets
-                hdu.header['M1FSettl'] = (aos['AOSDataPacket']['M1FSettled'] == 'true', 'AOS M1FSettled')
-                hdu.header['M1LSettl'] = (aos['AOSDataPacket']['M1LSettled'] == 'true', 'AOS M1LSettled')
-                hdu.header['M1PSettl'] = (aos['AOSDataPacket']['M1PSettled'] == 'true', 'AOS M1PSettled')
-                hdu.header['M2PSettl'] = (aos['AOSDataPacket']['M2PSettled'] == 'true', 'AOS M2PSettled')
-                hdu.header['M2VSettl'] = (aos['AOSDataPacket']['M2VSettled'] == 'true', 'AOS M2VSettled')
-                hdu.header['FOCUS_OK'] = (aos['AOSDataPacket']['focusOffsetDemandOutOfRange'] == 'false', 
-                                          'AOS focusOffsetDemandOutOfRange == false')
-                hdu.header['WAVEF_OK'] = (aos['AOSDataPacket']['wavefrontDataOutOfRange'] == 'false', 
-                                          'AOS wavefrontDataOutOfRange == false')
+                    t.join(0.2)
+                except KeyboardInterrupt:
+                    print("aborting sequence; waiting for frames already captured to be written")
+                    self.abort()
+        # return anything still sitting in the queues after a failure
+        for q in (coadd_q, header_q, write_q):
+            while not q.empty():
+                item = q.get()
+                if item is not None:
+                    self._release_frame_buffers(item[0])
+        self.metrics.set_gauge('frame_pool_mb', pool.nbytes() / 1e6)
+        if errors:
+            exc_type, exc_value, exc_tb = errors[0]
+            raise exc_value
+
+    def _fill_header(self, header, frame_info):
+        """
+        Fill in the FITS header for one frame.
+
+        frame_info is the dict of per-frame values recorded by _capture_one at capture time.
+        """
+        header['OBJECT'] = frame_info['target']
+        header['DATE-OBS'] = frame_info['obs_datetime'].isoformat()
+        header['EXPTIME'] = (frame_info['exptime_sec'], "exposure time in seconds")
+        header['COADDS'] = (frame_info['coadds'], "number of coadds per frame written to disk")
+        header['CURNEXP'] = (frame_info['cur_nexp'], "current frame number in sequence")
+        header['NEXP'] = (frame_info['nexp'], "total number of frames in current sequence")
+        if frame_info['ncoadds_ok'] is not None:
+            header['COADDOK'] = (frame_info['ncoadds_ok'], "coadds read without USB error")
+        header['DATE-BEG'] = (frame_info['start_datetime'].isoformat(), "UT date time at sequence start")
+        header['DATE-END'] = (frame_info['end_datetime'].isoformat(), "UT date time at sequence end")
+        header['FILENAME'] = "current.fits"
+        x0, y0, width, height, xinc, yinc = self._window
+        header['DETSEC'] = ('[{}:{},{}:{}]'.format(x0 + 1, x0 + width, y0 + 1, y0 + height),
+                            'window of interest on detector (1-based)')
+        header['LTV1'] = (1. - (x0 + 1.) / xinc, 'frame x = LTM1_1 * detector x + LTV1')
+        header['LTV2'] = (1. - (y0 + 1.) / yinc, 'frame y = LTM2_2 * detector y + LTV2')
+        header['LTM1_1'] = (1. / xinc, 'window x increment is 1/LTM1_1')
+        header['LTM2_2'] = (1. / yinc, 'window y increment is 1/LTM2_2')
+        header['INSTRUME'] = "Xenics serial number {}".format(self.serial_number)
+        header['PWM'] = (self._pwm, "xenics cooling power setting")
+        header['FAN'] = (self._fan, "xenics fan setting")
+        with self.timer.stage('temperature', frame_info['timings']):
+            tk_adu, tk_adc = self._lookup_temperatures(np.array([frame_info['start_time'], frame_info['end_time']]))
+            tk = self._convert_adu_to_kelvin(tk_adu)
+        self.metrics.set_gauge('detector_temperature_adu', float(tk_adu[1]))
+        self.metrics.set_gauge('detector_temperature_k', float(tk[1]))
+        header['TK_ADU1'] = (float(tk_adu[0]), 'get_temperature_ADU at sequence start')
+        header['TK1'] = (float(tk[0]), 'T(K) at sequence start')
+        header['TK_ADC1'] = (float(tk_adc[0]), 'get_temperature_ADCtype at sequence start')
+        header['TK_ADU2'] = (float(tk_adu[1]), 'get_temperature_ADU at sequence end')
+        header['TK2'] = (float(tk[1]), 'T(K) at sequence end')
+        header['TK_ADC2'] = (float(tk_adc[1]), 'get_temperature_ADCtype at sequence end')
+        header.extend(self.telemetry.cards_at((frame_info['start_time'] + frame_info['end_time']) / 2.))
+        if frame_info['quicklook'] is not None:
+            header.extend(header_cards(frame_info['quicklook']))
 
+    def _write_hdu(self, hdulist, frame_info):
+        timings = frame_info['timings']
+        if isinstance(hdulist, FrameMetadata) and self._output_mode == 'spool':
+            with self.timer.stage('filename', timings):
+                filename = self._get_next_filename()
+            hdulist['FILENAME'] = (os.path.basename(filename), 'original filename as written to disk')
+            with self.timer.stage('write', timings):
+                self._spool.write(hdulist, filename)
+            self.metrics.set_gauge('spool_pending', self._spool.pending())
+            self.metrics.record_frame({'cur_nexp': frame_info['cur_nexp'], 'filename': os.path.basename(filename),
+                                       'end_time': frame_info['end_datetime'].isoformat(), 'timings': timings})
+            print("spooled frame {} for {}".format(frame_info['cur_nexp'], os.path.basename(filename)))
+            return filename
+        if isinstance(hdulist, FrameMetadata):
+            with self.timer.stage('write', timings):
+                filename = self._cube_writer.write(hdulist)
+            self.metrics.record_frame({'cur_nexp': frame_info['cur_nexp'], 'filename': os.path.basename(filename),
+                                       'end_time': frame_info['end_datetime'].isoformat(), 'timings': timings})
+            print("added frame {} to {}".format(frame_info['cur_nexp'], os.path.basename(filename)))
+            return filename
+        with self.timer.stage('filename', timings):
             filename = self._get_next_filename()
-            hdu.header['FILENAME'] = (os.path.basename(filename), 'original filename as written to disk')
-            hdulist.writeto(filename)
-            print("wrote {} to disk".format(os.path.basename(filename)))
-    
-        
-        
+        hdulist[0].header['FILENAME'] = (os.path.basename(filename), 'original filename as written to disk')
+        with self.timer.stage('write', timings):
+            # replaces the empty file that _get_next_filename created to claim the name
+            with open(filename, 'wb') as f:
+                hdulist.writeto(f)
+        self.metrics.record_frame({'cur_nexp': frame_info['cur_nexp'], 'filename': os.path.basename(filename),
+                                   'end_time': frame_info['end_datetime'].isoformat(), 'timings': timings})
+        print("wrote {} to disk".format(os.path.basename(filename)))
+        return filename
+
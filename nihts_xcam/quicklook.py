@@ -0,0 +1,240 @@
+"""
+Real-time quick-look measurements on each coadded frame, for target acquisition and guiding.
+
+CalibrationLibrary holds master darks (per single exposure), flats and bad pixel masks, keyed by
+(exptime, gain); the combination actually applied to a frame (dark scaled by the number of coadds,
+1/flat with bad pixels zeroed) is worked out once per (exptime, gain, coadds) and cached.
+
+QuickLook calibrates a frame and, in each region, estimates the background from the region's border
+pixels and measures flux, centroid, FWHM (from second moments) and peak of what is above it.
+Everything is vectorized numpy on the region cut-outs, which keeps it well inside a video-rate frame
+time.
+
+Calibration maps and regions are always given in full-frame pixels.  When the camera is reading out a
+window of interest they are cut down to match it, and positions are still reported in full-frame
+pixels.  Results are returned as a dict per region and also put on a bounded queue for other threads
+(e.g. a guider) to pick up.
+"""
+from __future__ import division
+import collections
+import threading
+import time
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+import numpy as np
+from astropy.io import fits
+
+FWHM_PER_SIGMA = 2. * np.sqrt(2. * np.log(2.))
+
+
+def _key(exptime_sec, gain):
+    return round(float(exptime_sec), 6), bool(gain)
+
+
+class CalibrationLibrary():
+    """
+    Master calibrations keyed by (exptime_sec, gain).
+
+        dark - master dark of a single exposure (not a coadd) at that exptime, ADU
+        flat - normalized flat field
+        bad_pixels - boolean mask, True where the pixel is bad
+
+    A flat or bad pixel mask added with exptime_sec=None applies to every exptime at that gain
+    unless there is one for the exact exptime.  All maps are full frame.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._darks = {}
+        self._flats = {}
+        self._bad_pixels = {}
+        self._cache = {}
+
+    def add(self, exptime_sec, gain, dark=None, flat=None, bad_pixels=None):
+        with self._lock:
+            for store, value in ((self._darks, dark), (self._flats, flat), (self._bad_pixels, bad_pixels)):
+                if value is not None:
+                    store[(None if exptime_sec is None else _key(exptime_sec, gain)[0], bool(gain))] = \
+                        np.asarray(value)
+            self._cache = {}
+
+    def load(self, exptime_sec, gain, dark_file=None, flat_file=None, bad_pixel_file=None):
+        """Same as add(), from FITS files (primary HDU; bad pixel file nonzero where bad)."""
+        self.add(exptime_sec, gain,
+                 dark=fits.getdata(dark_file).astype(np.float32) if dark_file is not None else None,
+                 flat=fits.getdata(flat_file).astype(np.float32) if flat_file is not None else None,
+                 bad_pixels=fits.getdata(bad_pixel_file) != 0 if bad_pixel_file is not None else None)
+
+    def _lookup(self, store, exptime, gain):
+        if (exptime, gain) in store:
+            return store[(exptime, gain)]
+        return store.get((None, gain))
+
+    def get(self, exptime_sec, gain, coadds, shape, window=None):
+        """
+        (dark_sum, inv_flat, calibrated) for a coadded frame: dark_sum (float32, dark * coadds, or
+        None), inv_flat (float32, 1/flat with 0 at bad pixels, or None) and whether any calibration
+        was found.  Cached.
+
+        window - (x0, y0, width, height, xinc, yinc) the frame was read out with (see
+                 XenicsCamera.window()), or None for full frame
+        """
+        exptime, gain = _key(exptime_sec, gain)
+        cache_key = (exptime, gain, coadds, shape, window)
+        with self._lock:
+            if cache_key in self._cache:
+                return self._cache[cache_key]
+            dark = self._lookup(self._darks, exptime, gain)
+            flat = self._lookup(self._flats, exptime, gain)
+            bad = self._lookup(self._bad_pixels, exptime, gain)
+        if window is not None:
+            x0, y0, width, height, xinc, yinc = window
+            cut = (slice(y0, y0 + height, yinc), slice(x0, x0 + width, xinc))
+            dark, flat, bad = [None if m is None else m[cut] for m in (dark, flat, bad)]
+        dark_sum = None if dark is None else (dark * coadds).astype(np.float32)
+        inv_flat = None
+        if flat is not None or bad is not None:
+            inv_flat = np.ones(shape, dtype=np.float32)
+            if flat is not None:
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    inv_flat = np.where(flat > 0, 1. / flat, 0.).astype(np.float32)
+            if bad is not None:
+                inv_flat[bad] = 0.
+        result = (dark_sum, inv_flat, dark is not None or flat is not None or bad is not None)
+        with self._lock:
+            self._cache[cache_key] = result
+        return result
+
+
+class Region():
+    """
+    A box [y0:y1, x0:x1] to measure in, with the outer `border` pixels used for the background.
+    """
+    def __init__(self, name, y0, y1, x0, x1, border=3, nsigma=3.):
+        self.name = name
+        self.y0, self.y1, self.x0, self.x1 = y0, y1, x0, x1
+        self.border = border
+        self.nsigma = nsigma
+        ny, nx = y1 - y0, x1 - x0
+        self.yy, self.xx = np.mgrid[y0:y1, x0:x1].astype(np.float32)
+        self.edge = np.ones((ny, nx), dtype=bool)
+        self.edge[border:ny - border, border:nx - border] = False
+
+    @classmethod
+    def around(cls, name, y, x, half_size=10, **kwargs):
+        return cls(name, y - half_size, y + half_size + 1, x - half_size, x + half_size + 1, **kwargs)
+
+    def windowed(self, window):
+        """
+        This region in the pixels of a frame read out with window (x0, y0, width, height, xinc, yinc),
+        keeping full-frame coordinates for the centroid; None if too little of it is in the window.
+        """
+        x0, y0, width, height, xinc, yinc = window
+        j0, j1 = [min(max(-(-(x - x0) // xinc), 0), -(-width // xinc)) for x in (self.x0, self.x1)]
+        i0, i1 = [min(max(-(-(y - y0) // yinc), 0), -(-height // yinc)) for y in (self.y0, self.y1)]
+        if min(i1 - i0, j1 - j0) <= 2 * self.border:
+            return None
+        region = Region(self.name, i0, i1, j0, j1, border=self.border, nsigma=self.nsigma)
+        region.yy = (y0 + yinc * region.yy).astype(np.float32)
+        region.xx = (x0 + xinc * region.xx).astype(np.float32)
+        return region
+
+
+class QuickLook():
+    """
+    measure(image, exptime_sec, gain, coadds) calibrates image and measures each region, returning
+    {'regions': {name: {...}}, 'calibrated': bool, 'time': ...}.  The same dict goes on .results
+    (a queue.Queue of at most maxsize entries; the oldest is dropped when it is full).
+    """
+    def __init__(self, calibrations=None, regions=(), maxsize=1000):
+        self.calibrations = calibrations if calibrations is not None else CalibrationLibrary()
+        self.regions = list(regions)
+        self.results = queue.Queue(maxsize=maxsize)
+        self._windowed = {}
+
+    def calibrate(self, image, exptime_sec, gain, coadds, out=None, window=None):
+        dark_sum, inv_flat, calibrated = self.calibrations.get(exptime_sec, gain, coadds, image.shape,
+                                                               window=window)
+        cal = np.subtract(image, dark_sum if dark_sum is not None else 0., out=out, dtype=np.float32)
+        if inv_flat is not None:
+            cal *= inv_flat
+        return cal, calibrated, inv_flat
+
+    def _measure_region(self, cal, good, region):
+        sub = cal[region.y0:region.y1, region.x0:region.x1]
+        edge = region.edge if good is None else region.edge & good[region.y0:region.y1, region.x0:region.x1]
+        edge_values = sub[edge]
+        if edge_values.size == 0:
+            return None
+        background = float(np.median(edge_values))
+        noise = 1.4826 * float(np.median(np.abs(edge_values - background)))
+        above = sub - background
+        weights = np.where(above > region.nsigma * noise, above, 0.)
+        if good is not None:
+            weights *= good[region.y0:region.y1, region.x0:region.x1]
+        total = float(weights.sum())
+        result = {'background': background, 'noise': noise, 'flux': total,
+                  'peak': float(above.max()), 'x': None, 'y': None, 'fwhm': None}
+        if total > 0:
+            x = float((weights * region.xx).sum() / total)
+            y = float((weights * region.yy).sum() / total)
+            var = float((weights * ((region.xx - x) ** 2 + (region.yy - y) ** 2)).sum() / total) / 2.
+            result.update(x=x, y=y, fwhm=float(FWHM_PER_SIGMA * np.sqrt(var)))
+        return result
+
+    def _regions_for(self, window):
+        """[(region, region as measured in a frame read out with window, or None)]"""
+        if window is None:
+            return [(region, region) for region in self.regions]
+        key = (window, tuple(id(region) for region in self.regions))
+        if key not in self._windowed:
+            self._windowed = {key: [(region, region.windowed(window)) for region in self.regions]}
+        return self._windowed[key]
+
+    def measure(self, image, exptime_sec, gain, coadds, out=None, window=None, cur_nexp=None, end_time=None):
+        """
+        out - float32 array for the calibrated image, to save allocating one per frame
+        window - window of interest the image was read out with (see CalibrationLibrary.get)
+        cur_nexp, end_time - frame number and capture end time (time.time()), copied into the results;
+                             latency_sec is how long after end_time the results were ready
+        """
+        cal, calibrated, inv_flat = self.calibrate(image, exptime_sec, gain, coadds, out=out, window=window)
+        good = None if inv_flat is None else inv_flat > 0
+        results = {'cur_nexp': cur_nexp, 'calibrated': calibrated, 'time': time.time(),
+                   'regions': collections.OrderedDict()}
+        for region, windowed in self._regions_for(window):
+            results['regions'][region.name] = (None if windowed is None else
+                                               self._measure_region(cal, good, windowed))
+        if end_time is not None:
+            results['end_time'] = end_time
+            results['latency_sec'] = time.time() - end_time
+        try:
+            self.results.put_nowait(results)
+        except queue.Full:
+            try:
+                self.results.get_nowait()
+            except queue.Empty:
+                pass
+            self.results.put_nowait(results)
+        return results
+
+
+def header_cards(results):
+    """
+    FITS cards for measure() results: QL<n>NAME, QL<n>BKG, QL<n>FLUX and, where something was found,
+    QL<n>X, QL<n>Y (0-based pixel) and QL<n>FWHM (pixels) for the n'th region.
+    """
+    cards = [('QLCAL', results['calibrated'], 'quick-look calibration applied')]
+    for n, (name, result) in enumerate(results['regions'].items(), 1):
+        cards.append(('QL{}NAME'.format(n), name, 'quick-look region name'))
+        if result is None:
+            continue
+        cards.append(('QL{}BKG'.format(n), result['background'], 'quick-look background per pixel, ADU'))
+        cards.append(('QL{}FLUX'.format(n), result['flux'], 'quick-look flux above background, ADU'))
+        if result['x'] is not None:
+            cards.append(('QL{}X'.format(n), result['x'], 'quick-look centroid x, pixels'))
+            cards.append(('QL{}Y'.format(n), result['y'], 'quick-look centroid y, pixels'))
+            cards.append(('QL{}FWHM'.format(n), result['fwhm'], 'quick-look FWHM, pixels'))
+    return cards
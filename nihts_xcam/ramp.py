@@ -0,0 +1,192 @@
+"""
+Up-the-ramp slope fitting of non-destructive reads, one read at a time.
+
+RampAccumulator keeps running least squares sums per pixel (number of reads, sum of y, sum of j*y for
+read index j within the current ramp segment), so a ramp of any number of reads needs the same few
+images of memory and every read is folded in with a handful of vectorized numpy operations as it
+arrives.  With reads evenly spaced, the least squares slope (ADU per read) of a segment of n reads is
+
+    slope = (sum(j*y) - (n-1)/2 * sum(y)) / (n*(n**2-1)/12)
+
+and its variance (read noise sigma_r ADU, e_per_adu electrons per ADU)
+
+    12 sigma_r**2 / (n*(n**2-1))  +  6 (n**2+1) slope / (5 n (n**2-1) e_per_adu)
+
+Everything is fitted per read; only finish() divides by the time between reads, dt, to give ADU/s.
+That way dt can be measured from the reads' timestamps once the ramp is over (the camera reads once
+per frame period, integration plus readout, not once per integration time).
+
+A pixel stops accumulating once a read reaches saturation_adu.  A read that departs from the segment's
+slope by more than jump_nsigma (a cosmic ray hit, usually) ends the segment and starts a new one from
+that read; segments are combined weighted by 1/variance.  A read that failed over USB ends every
+pixel's segment, since the reads either side of it are no longer dt apart.
+
+finish() gives the rate (ADU/s), its variance and a DQ image of the flags below; pixels without a
+segment of at least two reads have NaN rate and variance.
+"""
+from __future__ import division
+
+import numpy as np
+
+SATURATED = 1
+JUMP = 2
+NO_FIT = 4
+READ_FAILED = 8
+
+
+class RampAccumulator():
+    """
+    shape - frame shape
+    dt_sec - time between reads, unless finish() is given the measured one
+    read_noise_adu, e_per_adu - for the jump threshold and the variance
+    saturation_adu - reads at or above this are not used
+    jump_nsigma - threshold for jump detection, in units of the expected read-to-read scatter
+    """
+    def __init__(self, shape, dt_sec, read_noise_adu=15., e_per_adu=1., saturation_adu=60000.,
+                 jump_nsigma=6.):
+        self.shape = tuple(shape)
+        self.dt_sec = float(dt_sec)
+        self.read_noise_adu = float(read_noise_adu)
+        self.e_per_adu = float(e_per_adu)
+        self.saturation_adu = saturation_adu
+        self.jump_nsigma = float(jump_nsigma)
+        self._n = np.zeros(shape, dtype=np.float64)  # float, as it is mostly used in float arithmetic
+        self._sy = np.zeros(shape, dtype=np.float64)
+        self._sjy = np.zeros(shape, dtype=np.float64)
+        self._last = np.zeros(shape, dtype=np.float32)
+        self._wsum = np.zeros(shape, dtype=np.float64)
+        self._wrate = np.zeros(shape, dtype=np.float64)
+        self._active = np.ones(shape, dtype=bool)
+        self.flags = np.zeros(shape, dtype=np.uint8)
+        # scratch, so that add() doesn't allocate
+        self._y = np.zeros(shape, dtype=np.float32)
+        self._est = np.zeros(shape, dtype=np.float64)
+        self._denom = np.zeros(shape, dtype=np.float64)
+        self._resid = np.zeros(shape, dtype=np.float64)
+        self._mask = np.zeros(shape, dtype=bool)
+        self.start()
+
+    def nbytes(self):
+        return sum(a.nbytes for a in (self._n, self._sy, self._sjy, self._last, self._wsum, self._wrate,
+                                      self._active, self.flags, self._y, self._est, self._denom, self._resid,
+                                      self._mask))
+
+    def start(self):
+        """Begin a new ramp (after the detector has been reset)."""
+        for a in (self._n, self._sy, self._sjy, self._wsum, self._wrate, self.flags):
+            a[...] = 0
+        self._active[...] = True
+        self.nreads = 0
+        self.nreads_ok = 0
+        self._gap = False
+
+    def _segment_variance(self, n, slope):
+        """Variance of the slope (ADU/read) fitted to n >= 2 reads of a ramp with the given slope."""
+        nn1 = n * (n * n - 1.)
+        var = 12. * self.read_noise_adu ** 2 / nn1
+        var += 6. * (n * n + 1.) * np.maximum(slope, 0.) / (5. * nn1 * self.e_per_adu)
+        return np.maximum(var, 1e-12)
+
+    def _close_segments(self, mask):
+        """Fold the current segment of the pixels in mask into the combined rate and restart them."""
+        idx = np.nonzero(mask & (self._n >= 2))
+        if len(idx[0]):
+            n = self._n[idx]
+            slope = (self._sjy[idx] - 0.5 * (n - 1.) * self._sy[idx]) / (n * (n * n - 1.) / 12.)
+            w = 1. / self._segment_variance(n, slope)
+            self._wsum[idx] += w
+            self._wrate[idx] += w * slope
+        self._n[mask] = 0
+        self._sy[mask] = 0.
+        self._sjy[mask] = 0.
+
+    def add(self, read, ok=True):
+        """
+        Fold in the next read (a frame shaped array).  ok=False for a read that failed (e.g. the
+        driver zeroed it after a USB error); it is skipped.
+        """
+        self.nreads += 1
+        if not ok:
+            self._gap = True
+            self.flags |= READ_FAILED
+            return
+        self.nreads_ok += 1
+        y = self._y
+        np.copyto(y, read, casting='unsafe')
+        active = self._active
+        # saturated pixels drop out for the rest of the ramp
+        np.greater_equal(y, self.saturation_adu, out=self._mask)
+        self._mask &= active
+        if self._mask.any():
+            self.flags[self._mask] |= SATURATED
+            active &= ~self._mask
+        if self._gap:
+            self._close_segments(np.ones(self.shape, dtype=bool))
+            self._gap = False
+        elif self.nreads_ok > 2:
+            # expected read-to-read step from the segment's slope so far (per read), where n >= 2
+            n = self._n
+            denom = self._denom
+            np.multiply(n, n, out=denom)
+            denom -= 1.
+            denom *= n
+            denom /= 12.
+            np.maximum(denom, 0.5, out=denom)  # n < 2 -> placeholder; masked out below
+            np.subtract(n, 1., out=self._resid)
+            self._resid *= 0.5
+            self._resid *= self._sy
+            np.subtract(self._sjy, self._resid, out=self._resid)
+            np.divide(self._resid, denom, out=self._est)
+            # residual of this step, squared
+            np.subtract(y, self._last, out=self._resid)
+            self._resid -= self._est
+            np.square(self._resid, out=self._resid)
+            # ... against jump_nsigma**2 times its variance: sigma_r**2 * (2 + n/denom), as the step
+            # shares a read with the slope estimate, plus the poisson noise of the step
+            np.divide(n, denom, out=denom)
+            denom += 2.
+            denom *= self.read_noise_adu ** 2
+            np.maximum(self._est, 0., out=self._est)
+            self._est /= self.e_per_adu
+            denom += self._est
+            denom *= self.jump_nsigma ** 2
+            np.greater(self._resid, denom, out=self._mask)
+            self._mask &= active
+            self._mask &= n >= 2
+            if self._mask.any():
+                self.flags[self._mask] |= JUMP
+                self._close_segments(self._mask)
+        # sum(j*y) with j the read's index in its segment (= n before this read), sum(y), n
+        np.multiply(self._n, y, out=self._est)
+        np.add(self._sjy, self._est, out=self._sjy, where=active)
+        np.add(self._sy, y, out=self._sy, where=active)
+        self._n += active
+        np.copyto(self._last, y)
+
+    def finish(self, rate=None, variance=None, dq=None, dt_sec=None):
+        """
+        Close the ramp and return (rate, variance, dq): ADU/s and (ADU/s)**2 as float32 and the flags
+        as uint8, written into the given arrays if any.  dt_sec, if given, is the time between reads
+        to use instead of the one given to the constructor.
+        """
+        dt = self.dt_sec if dt_sec is None else float(dt_sec)
+        self._close_segments(np.ones(self.shape, dtype=bool))
+        if rate is None:
+            rate = np.empty(self.shape, dtype=np.float32)
+        if variance is None:
+            variance = np.empty(self.shape, dtype=np.float32)
+        fitted = self._wsum > 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            np.divide(self._wrate, self._wsum, out=self._est)
+            self._est /= dt
+            self._est[~fitted] = np.nan
+            np.copyto(rate, self._est, casting='same_kind')
+            np.divide(1. / (dt * dt), self._wsum, out=self._est)
+            self._est[~fitted] = np.nan
+            np.copyto(variance, self._est, casting='same_kind')
+        self.flags[~fitted] |= NO_FIT
+        if dq is None:
+            dq = self.flags.copy()
+        else:
+            np.copyto(dq, self.flags)
+        return rate, variance, dq
@@ -0,0 +1,248 @@
+"""
+Back-to-back observing from a queue of sequences.
+
+SequenceScheduler runs SequenceSpecs (exptime, coadds, nexp, target, gain, ...) on a XenicsCamera one
+after another from a worker thread, so the camera isn't left idle between sequences while someone types
+the next go().  As soon as the last frame of a sequence has been read from the camera, the next
+sequence's exposure time and gain are written (XenicsCamera.configure) while the earlier frames are
+still going through the coadd/header/write stages, so the next go() usually has nothing left to write.
+
+    scheduler = SequenceScheduler(camera)
+    scheduler.submit(SequenceSpec(0.5, 10, 5, target='HD 12345'))
+    scheduler.submit(exptime=0.01, coadds=1, nexp=200, pipelined=True, output='cube')
+    scheduler.status()
+
+pause() lets the current sequence finish and then holds the queue; abort() stops the current sequence
+(and with clear=True drops the queue as well).  Everything is safe to call from any thread; see
+nihts_xcam.command_server for doing it over a local socket.
+"""
+from __future__ import print_function, division
+import collections
+import itertools
+import threading
+import time
+import traceback
+
+
+class _Aborted(Exception):
+    pass
+
+
+class SequenceSpec():
+    """
+    One go() sequence.  target and gain, if None, are left as they are on the camera; likewise
+    pipelined and output (see XenicsCamera.go).
+    """
+    fields = ('exptime', 'coadds', 'nexp', 'target', 'gain', 'pipelined', 'output')
+
+    def __init__(self, exptime, coadds=1, nexp=1, target=None, gain=None, pipelined=None, output=None):
+        if exptime <= 0:
+            raise ValueError("exptime must be positive, not {}".format(exptime))
+        if coadds < 1:
+            raise ValueError("coadds must be at least 1, not {}".format(coadds))
+        if nexp < 1 and nexp != -1:
+            raise ValueError("nexp must be at least 1, or -1 for video mode, not {}".format(nexp))
+        if output not in (None, 'frames', 'cube', 'spool'):
+            raise ValueError("output must be 'frames', 'cube' or 'spool', not {}".format(output))
+        self.exptime = float(exptime)
+        self.coadds = int(coadds)
+        self.nexp = int(nexp)
+        self.target = target
+        self.gain = None if gain is None else bool(gain)
+        self.pipelined = pipelined
+        self.output = output
+        # filled in by SequenceScheduler
+        self.id = None
+        self.state = 'new'
+        self.submitted = None
+        self.started = None
+        self.finished = None
+        self.preapplied = False
+        self.error = None
+
+    @classmethod
+    def from_dict(cls, d):
+        unknown = set(d) - set(cls.fields)
+        if unknown:
+            raise ValueError("unknown sequence fields: {}".format(', '.join(sorted(unknown))))
+        return cls(**d)
+
+    def to_dict(self):
+        d = collections.OrderedDict((name, getattr(self, name)) for name in ('id', 'state') + self.fields)
+        for name in ('submitted', 'started', 'finished', 'preapplied', 'error'):
+            d[name] = getattr(self, name)
+        return d
+
+
+class SequenceScheduler():
+    """
+    Runs submitted SequenceSpecs on camera, in order, from a daemon thread.
+
+        history - how many finished sequences status() reports
+    """
+    def __init__(self, camera, history=20):
+        self.camera = camera
+        self._cond = threading.Condition()
+        self._queue = collections.deque()
+        self._current = None
+        self._finished = collections.deque(maxlen=history)
+        self._ids = itertools.count(1)
+        self._paused = False
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, name='sequence-scheduler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, spec=None, **kwargs):
+        """
+        Queue a SequenceSpec (or its fields as keyword arguments).  Returns the sequence id.
+        """
+        if spec is None:
+            spec = SequenceSpec(**kwargs)
+        elif isinstance(spec, dict):
+            spec = SequenceSpec.from_dict(spec)
+        with self._cond:
+            spec.id = next(self._ids)
+            spec.state = 'queued'
+            spec.submitted = time.time()
+            self._queue.append(spec)
+            self._cond.notify_all()
+        return spec.id
+
+    def abort(self, clear=False):
+        """
+        Stop the current sequence (frames already captured are still written).  clear=True also drops
+        everything still queued.  Returns the ids of the sequences aborted/dropped.
+        """
+        ids = []
+        with self._cond:
+            if clear:
+                while self._queue:
+                    spec = self._queue.popleft()
+                    spec.state = 'dropped'
+                    spec.finished = time.time()
+                    self._finished.append(spec)
+                    ids.append(spec.id)
+            if self._current is not None:
+                self._current.state = 'aborting'
+                ids.insert(0, self._current.id)
+                self.camera.abort()
+        return ids
+
+    def remove(self, sequence_id):
+        """Drop a queued (not yet started) sequence.  Returns True if it was found."""
+        with self._cond:
+            for spec in self._queue:
+                if spec.id == sequence_id:
+                    self._queue.remove(spec)
+                    spec.state = 'dropped'
+                    spec.finished = time.time()
+                    self._finished.append(spec)
+                    return True
+        return False
+
+    def pause(self):
+        """Don't start any more sequences (the current one runs to the end) until resume()."""
+        with self._cond:
+            self._paused = True
+
+    def resume(self):
+        with self._cond:
+            self._paused = False
+            self._cond.notify_all()
+
+    def status(self):
+        with self._cond:
+            if self._current is not None:
+                state = 'running'
+            elif self._paused:
+                state = 'paused'
+            else:
+                state = 'idle'
+            return {'state': state,
+                    'paused': self._paused,
+                    'current': None if self._current is None else self._current.to_dict(),
+                    'queue': [spec.to_dict() for spec in self._queue],
+                    'finished': [spec.to_dict() for spec in self._finished]}
+
+    def wait(self, timeout=None):
+        """Wait until the queue is empty and nothing is running (or paused).  Returns True if so."""
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while self._current is not None or (self._queue and not self._paused):
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def stop(self, abort=True):
+        """Stop the worker thread, after aborting the current sequence if abort=True."""
+        if abort:
+            self.abort()
+        with self._cond:
+            self._stop = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def _next_spec(self):
+        with self._cond:
+            while not self._stop and (self._paused or not self._queue):
+                self._cond.wait()
+            if self._stop:
+                return None
+            spec = self._queue.popleft()
+            spec.state = 'running'
+            spec.started = time.time()
+            self._current = spec
+            return spec
+
+    def _preapply_next(self):
+        """
+        go()'s on_capture_done: write the next sequence's exposure time and gain while this one's last
+        frame (and, pipelined, any before it still in the pipeline) is still being coadded and written.
+        """
+        with self._cond:
+            current = self._current
+            if self._paused or not self._queue or current is None or current.state != 'running':
+                return
+            spec = self._queue[0]
+        try:
+            self.camera.configure(spec.exptime, spec.gain)
+            spec.preapplied = True
+        except Exception:
+            traceback.print_exc()
+
+    def _run(self):
+        while True:
+            spec = self._next_spec()
+            if spec is None:
+                return
+            try:
+                if spec.state == 'aborting':  # abort() came before go() had started
+                    raise _Aborted()
+                if spec.target is not None:
+                    self.camera.target(spec.target)
+                self.camera.configure(spec.exptime, spec.gain)
+                # abort() sets the state before calling camera.abort(), so checking it after go() has
+                # cleared the camera's abort flag catches an abort that came in before go() started
+                self.camera.go(spec.exptime, spec.coadds, spec.nexp, pipelined=spec.pipelined,
+                               output=spec.output, on_capture_done=self._preapply_next,
+                               aborted=lambda: spec.state == 'aborting')
+                state = 'aborted' if spec.state == 'aborting' else 'done'
+            except _Aborted:
+                state = 'aborted'
+            except Exception as e:
+                traceback.print_exc()
+                state = 'failed'
+                spec.error = '{}: {}'.format(type(e).__name__, e)
+            with self._cond:
+                spec.state = state
+                spec.finished = time.time()
+                self._finished.append(spec)
+                self._current = None
+                if state == 'failed':
+                    # don't carry on with the rest of the queue on a camera in an unknown state
+                    self._paused = True
+                    print("sequence {} failed; queue paused (resume() to carry on)".format(spec.id))
+                self._cond.notify_all()
@@ -0,0 +1,565 @@
+"""
+Simulated stand-ins for the camera hardware, so that XenicsCamera can be run (and profiled) without
+the Xenics camera, the pwrusb power switch or the DCT STOMP broker:
+
+    SimulatedXenics - same functions as the compiled `xenics` extension, frames generated with numpy
+    SimulatedPowerSwitch - records on/off calls
+    SimulatedStompConnection - accepts the stomp.Connection calls we make; messages can be injected
+    SimulatedStompBroker - local stand-in broker shared by SimulatedStompConnections
+
+simulated_camera() wires these together into a XenicsCamera.
+"""
+from __future__ import print_function
+import sys
+import time
+import threading
+import tempfile
+import numpy as np
+
+MAXWIDTH = 320
+MAXHEIGHT = 256
+
+
+class SimulatedXenics():
+    """
+    Pure python/numpy imitation of the `xenics` extension.
+
+    Timing model: each frame takes (integration time + readout_sec) of wall clock when realtime=True,
+    mirroring the camera's free-running mode.  With realtime=False frames are returned as fast as
+    they can be generated, which is what you want for exercising the rest of the acquisition loop.
+    In nondestructive mode each read holds the charge built up, by the wall clock, since
+    reset_detector(), so reads arrive (and ramps grow) once per frame period as on the camera.
+
+        readout_sec - USB readout time per full frame (~ 160kB at ~30 MB/s); a window (set_window) takes
+                      this in proportion to its number of pixels
+        register_read_sec - latency of a register read (e.g. get_temperature_ADU) or write
+                            (register_writes counts the writes that actually went to the camera)
+        bias_adu, dark_adu_per_sec, read_noise_adu - detector model; frames are clipped to uint16
+        drop_probability - chance that any one frame read fails (frame zeroed, like the driver)
+        cosmic_ray_probability - chance per pixel per frame of a cosmic ray hit (adding 200-5000 ADU,
+                                 which in nondestructive mode stays in every read until reset_detector)
+        usb_enumerate_sec - after power on, open_camera fails (camera not found on USB) for this long
+        settle_sec - after open_camera, check_frame_read fails for this long
+        temperature_adu, temperature_noise_adu - what get_temperature_ADU returns
+        seed - for the random number generator
+    """
+    def __init__(self, realtime=True, readout_sec=0.0055, register_read_sec=0.0005,
+                 bias_adu=1000., dark_adu_per_sec=50., read_noise_adu=15.,
+                 drop_probability=0., temperature_adu=24000, temperature_noise_adu=3., seed=None,
+                 usb_enumerate_sec=0., settle_sec=0., cosmic_ray_probability=0.):
+        self.realtime = realtime
+        self.readout_sec = readout_sec
+        self.register_read_sec = register_read_sec
+        self.bias_adu = bias_adu
+        self.dark_adu_per_sec = dark_adu_per_sec
+        self.read_noise_adu = read_noise_adu
+        self.drop_probability = drop_probability
+        self.cosmic_ray_probability = cosmic_ray_probability
+        # nondestructive mode: when reset_detector() was last called and the cosmic ray charge collected since
+        self._reset_at = None
+        self._ramp_charge = None
+        self.usb_enumerate_sec = usb_enumerate_sec
+        self.settle_sec = settle_sec
+        # powered from the start unless a SimulatedPowerSwitch says otherwise
+        self._powered_at = time.time() - usb_enumerate_sec
+        self._opened_at = None
+        self.open_calls = 0
+        self.temperature_adu = temperature_adu
+        self.temperature_noise_adu = temperature_noise_adu
+        self._rng = np.random.RandomState(seed)
+        self._rng_lock = threading.Lock()
+        self._abort = False
+        self.camera_found_on_usb = 0
+        self.frames_captured = 0
+        self.frames_dropped = 0
+        self.coadd_frames_ok = 0
+        # register cache, as in the driver: writes that wouldn't change anything are skipped while valid
+        self.register_cache_valid = 0
+        self.register_writes = 0
+        self.register_writes_skipped = 0
+        self.dummy_frames_taken = 0
+        self.set_9808_params_to_default()
+        self.pwm = 0
+        self.fan = 1
+        self.integration_time_millisec = 50
+        self.ADC_Vin = 2830
+        self.ADC_Vref = 2430
+        self.Vdet_comA = 3700
+        self.Vdet_comB = 3700
+        # a fixed pattern so that frames look like a detector rather than pure noise
+        yy, xx = np.mgrid[0:MAXHEIGHT, 0:MAXWIDTH]
+        self._pattern = (5. * np.sin(xx / 17.) * np.cos(yy / 23.)).astype(np.float32)
+        self._pattern[MAXHEIGHT // 2 - 2:MAXHEIGHT // 2 + 3, MAXWIDTH // 2 - 2:MAXWIDTH // 2 + 3] += 2000.
+        self._window_pattern = self._pattern
+        self.window = (0, 0, MAXWIDTH, MAXHEIGHT, 1, 1)
+
+    def _sleep(self, sec):
+        if self.realtime and sec > 0:
+            time.sleep(sec)
+
+    # -- camera open/close --------------------------------------------------------------------------
+    def power(self, on):
+        self._powered_at = time.time() if on else None
+        if not on:
+            self.close_camera()
+
+    def open_camera(self):
+        self.open_calls += 1
+        if self._powered_at is None or time.time() - self._powered_at < self.usb_enumerate_sec:
+            self.camera_found_on_usb = 0
+            return 1
+        self.camera_found_on_usb = 1
+        self._opened_at = time.time()
+        self._sleep(2 * self.readout_sec)
+        self.register_cache_valid = 1
+        return 0
+
+    def close_camera(self):
+        self.camera_found_on_usb = 0
+        self._opened_at = None
+        self.register_cache_valid = 0
+
+    def check_frame_read(self):
+        if self._opened_at is None:
+            return 1
+        self._sleep(self._frame_period_sec())
+        if time.time() - self._opened_at < self.settle_sec:
+            return 1
+        return 0
+
+    def get_camera_found_on_usb(self):
+        return self.camera_found_on_usb
+
+    def get_max_width(self):
+        return MAXWIDTH
+
+    def get_max_height(self):
+        return MAXHEIGHT
+
+    def set_window(self, x0, y0, width, height, xinc, yinc):
+        if (x0 < 0 or y0 < 0 or width < 1 or height < 1 or x0 + width > MAXWIDTH or y0 + height > MAXHEIGHT or
+                not 1 <= xinc <= 15 or not 1 <= yinc <= 15):
+            return -1
+        self.window = (x0, y0, width, height, xinc, yinc)
+        self._window_pattern = np.ascontiguousarray(self._pattern[y0:y0 + height:yinc, x0:x0 + width:xinc])
+        self.take_dummy_frame()
+        return 0
+
+    def get_frame_width(self):
+        return self._window_pattern.shape[1]
+
+    def get_frame_height(self):
+        return self._window_pattern.shape[0]
+
+    def _frame_pixels(self):
+        return self._window_pattern.size
+
+    def get_image_capture_timeout(self):
+        return 5000 + self.integration_time_millisec
+
+    def get_command_timeout(self):
+        return 0x00ffffff
+
+    # -- frames -------------------------------------------------------------------------------------
+    def _frame_period_sec(self):
+        return (self.integration_time_millisec / 1000. +
+                self.readout_sec * self._frame_pixels() / float(MAXWIDTH * MAXHEIGHT))
+
+    def reset_detector(self):
+        self._reset_at = time.time()
+        self._ramp_charge = None
+        self._write()
+        self._write()
+        return 0
+
+    def _fill_frame(self, frame):
+        exptime_sec = self.integration_time_millisec / 1000.
+        nondestructive = self.cw9808['nondestructive']
+        if nondestructive:
+            # the charge keeps building up, by the wall clock, from the reset until the read (so with
+            # realtime=False a ramp's reads differ only by the time it took to make them)
+            if self._reset_at is None:
+                self._reset_at = time.time()
+            exptime_sec = time.time() - self._reset_at
+        with self._rng_lock:
+            if self._rng.uniform() < self.drop_probability:
+                self.frames_dropped += 1
+                print("capture_data Error: usb_bulk_read returns -110 (simulated timeout)", file=sys.stderr)
+                frame[:] = 0
+                return
+            noise = self._rng.normal(0., self.read_noise_adu, self._frame_pixels()).astype(np.float32)
+            hits = None
+            if self.cosmic_ray_probability > 0:
+                hits = np.nonzero(self._rng.uniform(size=noise.size) < self.cosmic_ray_probability)[0]
+                energies = self._rng.uniform(200., 5000., size=hits.size).astype(np.float32)
+        noise += self.bias_adu + self.dark_adu_per_sec * exptime_sec
+        noise += self._window_pattern.reshape(-1) * exptime_sec
+        if nondestructive:
+            if self._ramp_charge is None or self._ramp_charge.size != noise.size:
+                self._ramp_charge = np.zeros(noise.size, dtype=np.float32)
+            if hits is not None:
+                self._ramp_charge[hits] += energies
+            noise += self._ramp_charge
+        elif hits is not None:
+            noise[hits] += energies
+        np.clip(noise, 0, 65535, out=noise)
+        frame[:] = noise
+
+    def capture_frames_abortable(self, frame_buffer):
+        n_pix = self._frame_pixels()
+        n_frames = frame_buffer.size // n_pix
+        for i in range(n_frames):
+            if self._abort:
+                return i
+            t0 = time.time()
+            self._fill_frame(frame_buffer[i * n_pix:(i + 1) * n_pix])
+            self.frames_captured += 1
+            self._sleep(self._frame_period_sec() - (time.time() - t0))
+        return n_frames
+
+    def capture_frames(self, frame_buffer):
+        self.capture_frames_abortable(frame_buffer)
+
+    def capture_coadd(self, sum_buffer, sumsq_buffer, min_buffer, max_buffer, n_frames, accumulate=0):
+        n_pix = self._frame_pixels()
+        if sum_buffer.size != n_pix:
+            return -1
+        do_sumsq = sumsq_buffer.size == n_pix
+        do_minmax = min_buffer.size == n_pix and max_buffer.size == n_pix
+        if not accumulate:
+            sum_buffer[:] = 0
+            if do_sumsq:
+                sumsq_buffer[:] = 0.
+            if do_minmax:
+                min_buffer[:] = 0xffff
+                max_buffer[:] = 0
+            self.coadd_frames_ok = 0
+        frame = np.empty(n_pix, dtype=np.uint16)
+        for i in range(n_frames):
+            if self._abort:
+                return i
+            t0 = time.time()
+            dropped = self.frames_dropped
+            self._fill_frame(frame)
+            self.frames_captured += 1
+            if self.frames_dropped == dropped:
+                self.coadd_frames_ok += 1
+                sum_buffer += frame
+                if do_sumsq:
+                    sumsq_buffer += np.square(frame, dtype=np.float64)
+                if do_minmax:
+                    np.minimum(min_buffer, frame, out=min_buffer)
+                    np.maximum(max_buffer, frame, out=max_buffer)
+            self._sleep(self._frame_period_sec() - (time.time() - t0))
+        return n_frames
+
+    def get_coadd_frames_ok(self):
+        return self.coadd_frames_ok
+
+    def get_frames_ok_count(self):
+        return self.frames_captured - self.frames_dropped
+
+    def get_usb_timeout_count(self):
+        return self.frames_dropped
+
+    def get_usb_underrun_count(self):
+        return 0
+
+    def get_usb_error_count(self):
+        return 0
+
+    def reset_capture_counts(self):
+        self.frames_captured = 0
+        self.frames_dropped = 0
+
+    def request_capture_abort(self):
+        self._abort = True
+
+    def clear_capture_abort(self):
+        self._abort = False
+
+    def get_capture_abort(self):
+        return int(self._abort)
+
+    def take_dummy_frame(self):
+        self.dummy_frames_taken += 2
+        self._sleep(2 * self._frame_period_sec())
+
+    # -- registers ----------------------------------------------------------------------------------
+    def get_temperature_ADU(self):
+        if self._opened_at is None:
+            return -1
+        self._sleep(self.register_read_sec)
+        with self._rng_lock:
+            return int(round(self.temperature_adu + self._rng.normal(0., self.temperature_noise_adu)))
+
+    def get_temperature_ADCtype(self):
+        if self._opened_at is None:
+            return -1
+        self._sleep(self.register_read_sec)
+        return 1
+
+    def _write(self):
+        self.register_writes += 1
+        self._sleep(self.register_read_sec)
+
+    def _unchanged(self, current, value):
+        if self.register_cache_valid and current == value:
+            self.register_writes_skipped += 1
+            return True
+        return False
+
+    def invalidate_register_cache(self):
+        self.register_cache_valid = 0
+
+    def get_register_cache_valid(self):
+        return self.register_cache_valid
+
+    def get_register_writes_skipped(self):
+        return self.register_writes_skipped
+
+    def get_dummy_frames_taken(self):
+        return self.dummy_frames_taken
+
+    def apply_settings(self, millisec, gain, fan, pwm):
+        pwm = min(max(0, pwm), 4095)
+        gain, fan = 1 if gain else 0, 1 if fan else 0
+        flush = wrote = False
+        if not self._unchanged(self.cw9808['gain'], gain):
+            self.cw9808['gain'] = gain
+            self.fan = fan
+            self._write()
+            self._write()  # fan, sent again after the command word
+            flush = wrote = True
+        elif not self._unchanged(self.fan, fan):
+            self.fan = fan
+            self._write()
+            wrote = True
+        if not self._unchanged(self.integration_time_millisec, int(millisec)):
+            self.integration_time_millisec = int(millisec)
+            self._write()
+            flush = wrote = True
+        if not self._unchanged(self.pwm, pwm):
+            self.pwm = pwm
+            self._write()
+            wrote = True
+        if flush:
+            self.take_dummy_frame()
+        if not wrote:
+            return -1
+        self.register_cache_valid = 1
+        return 0
+
+    def set_pwm(self, pwm):
+        pwm = min(max(0, pwm), 4095)
+        if not self._unchanged(self.pwm, pwm):
+            self.pwm = pwm
+            self._write()
+        return 0
+
+    def get_pwm(self):
+        return self.pwm
+
+    def set_fan(self, fan):
+        fan = 1 if fan else 0
+        if not self._unchanged(self.fan, fan):
+            self.fan = fan
+            self._write()
+        return 0
+
+    def get_fan(self):
+        return self.fan
+
+    def set_integration_time_millisec(self, millisec):
+        if not self._unchanged(self.integration_time_millisec, int(millisec)):
+            self.integration_time_millisec = int(millisec)
+            self._write()
+            self.take_dummy_frame()
+
+    def get_integration_time_millisec(self):
+        return self.integration_time_millisec
+
+    def set_ADC_Vin(self, value):
+        self.ADC_Vin = value
+        return 0
+
+    def set_ADC_Vref(self, value):
+        self.ADC_Vref = value
+        return 0
+
+    def set_Vdet_comA(self, value):
+        self.Vdet_comA = value
+        return 0
+
+    def set_Vdet_comB(self, value):
+        self.Vdet_comB = value
+        return 0
+
+    def get_ADC_Vin(self):
+        return self.ADC_Vin
+
+    def get_ADC_Vref(self):
+        return self.ADC_Vref
+
+    def get_Vdet_comA(self):
+        return self.Vdet_comA
+
+    def get_Vdet_comB(self):
+        return self.Vdet_comB
+
+    def set_9808_params_to_default(self):
+        self.cw9808 = {'itr': 0, 'gain': 1, 'multiplereadouts': 0, 'nondestructive': 0, 'xinv': 0,
+                       'yinv': 0, 'linerepeat': 0, 'refout': 0, 'reset': 0, 'skim': 0, 'power': 3,
+                       'current': 7, 'bias': 7, 'bandwidth': 3, 'outputfactor': 4}
+
+    def _set_9808(self, name, value):
+        if not self._unchanged(self.cw9808[name], value):
+            self.cw9808[name] = value
+            self._write()
+            self._write()  # fan
+            self.take_dummy_frame()
+        return 0
+
+    def __getattr__(self, name):
+        # set_gain/get_gain, set_nondestructive/get_nondestructive, ... for every command word 9808 field
+        if name.startswith('set_') and name[4:] in self.__dict__.get('cw9808', {}):
+            return lambda value: self._set_9808(name[4:], 1 if value else 0)
+        if name.startswith('get_') and name[4:] in self.__dict__.get('cw9808', {}):
+            return lambda: self.cw9808[name[4:]]
+        raise AttributeError(name)
+
+
+class SimulatedPowerSwitch():
+    """
+    Stand-in for PwrUsbSwitch.  `is_on` records the current power state, which is passed on to the
+    SimulatedXenics `camera` if given.
+    """
+    def __init__(self, camera=None):
+        self.camera = camera
+        self.on_calls = 0
+        self.off_calls = 0
+        self.is_on = False
+
+    def on(self):
+        self.on_calls += 1
+        if self.camera is not None and not self.is_on:
+            self.camera.power(True)
+        self.is_on = True
+
+    def off(self):
+        self.off_calls += 1
+        if self.camera is not None:
+            self.camera.power(False)
+        self.is_on = False
+
+
+class SimulatedStompBroker():
+    """
+    A local stand-in for the DCT STOMP broker that SimulatedStompConnections attach to.
+
+    publish(destination, body) delivers to every connected subscriber.  Setting `available` to False
+    makes new connects fail, and drop_connections() disconnects everyone, which is how reconnection
+    is exercised.
+    """
+    def __init__(self):
+        self.available = True
+        self.connections = []
+        self._lock = threading.Lock()
+
+    def connection_factory(self, host_and_ports=None):
+        return SimulatedStompConnection(host_and_ports, broker=self)
+
+    def _attach(self, connection):
+        with self._lock:
+            if not self.available:
+                raise IOError("simulated broker is not available")
+            self.connections.append(connection)
+
+    def _detach(self, connection):
+        with self._lock:
+            if connection in self.connections:
+                self.connections.remove(connection)
+
+    def publish(self, destination, body):
+        with self._lock:
+            connections = list(self.connections)
+        for connection in connections:
+            connection.inject(destination, body)
+
+    def drop_connections(self):
+        with self._lock:
+            connections = list(self.connections)
+        for connection in connections:
+            connection.disconnect()
+
+
+class SimulatedStompConnection():
+    """
+    Stand-in for stomp.Connection (the stomp.py 4.x calls that XenicsCamera makes).
+
+    inject(destination, body) delivers a message to the listeners as if it came from the broker.
+    If made with a SimulatedStompBroker, connecting can fail and disconnects are reported to the
+    listeners' on_disconnected.
+    """
+    def __init__(self, host_and_ports=None, broker=None):
+        self.host_and_ports = host_and_ports
+        self.broker = broker
+        self.listeners = {}
+        self.subscriptions = {}
+        self.connected = False
+
+    def set_listener(self, name, listener):
+        self.listeners[name] = listener
+
+    def start(self):
+        pass
+
+    def connect(self, *args, **kwargs):
+        if self.broker is not None:
+            self.broker._attach(self)
+        self.connected = True
+
+    def disconnect(self, *args, **kwargs):
+        was_connected = self.connected
+        self.connected = False
+        if self.broker is not None:
+            self.broker._detach(self)
+        if was_connected:
+            for listener in list(self.listeners.values()):
+                if hasattr(listener, 'on_disconnected'):
+                    listener.on_disconnected()
+
+    def is_connected(self):
+        return self.connected
+
+    def subscribe(self, destination, id, *args, **kwargs):
+        self.subscriptions[id] = destination
+
+    def inject(self, destination, body):
+        if not self.connected or destination not in self.subscriptions.values():
+            return
+        headers = {'destination': destination}
+        for listener in list(self.listeners.values()):
+            listener.on_message(headers, body)
+
+
+def simulated_camera(obsdatadir=None, broker=None, live_name=None, **kwargs):
+    """
+    Return a XenicsCamera running entirely on simulated hardware.
+
+    keyword arguments are passed to SimulatedXenics; data go to a fresh temporary directory unless
+    obsdatadir is given.  Telemetry comes from `broker` (a new SimulatedStompBroker by default),
+    available afterwards as camera.telemetry_client.broker.  Live frames are only published if
+    live_name is given.
+    """
+    from .nihts_xcam import XenicsCamera
+    if obsdatadir is None:
+        obsdatadir = tempfile.mkdtemp(prefix='xcam-sim-')
+    if broker is None:
+        broker = SimulatedStompBroker()
+    backend = SimulatedXenics(**kwargs)
+    camera = XenicsCamera(backend=backend, power_switch=SimulatedPowerSwitch(backend),
+                          stomp_connection_factory=broker.connection_factory, obsdatadir=obsdatadir,
+                          live_name=live_name)
+    camera.telemetry_client.broker = broker
+    return camera
@@ -0,0 +1,269 @@
+"""
+Raw memory-mapped spool for the fastest write path.
+
+A spool file is preallocated on local disk and memory mapped; go() in 'spool' output mode copies
+each coadded frame and a small JSON record of its header cards and destination filename into the
+next slot.  That memcpy is all the acquisition loop pays for.  A pool of worker processes turns each
+slot into the usual FITS file (same header, same filename) in the background.
+
+Layout (little endian):
+
+    file header, HEADER_BYTES:  magic, version, height, width, dtype, nslots, record_bytes
+    nslots slots, each:  record (state, json length, sequence number, json) padded to record_bytes,
+                         then the frame, padded to a page
+
+state is EMPTY, WRITTEN (frame and record complete, FITS not yet made) or CONVERTED.  It is only
+set to WRITTEN after the frame and record are in place, so after a crash every WRITTEN slot holds a
+complete frame, and
+
+    python -m nihts_xcam.spool recover path/to/file.spool
+
+writes the FITS files for them.  `status` instead of `recover` just lists the slots.
+"""
+from __future__ import division, print_function
+import argparse
+import json
+import mmap
+import multiprocessing
+import os
+import struct
+
+import numpy as np
+from astropy.io import fits
+
+MAGIC = b'XCAMSPL1'
+VERSION = 1
+HEADER_BYTES = 4096
+_HEADER = struct.Struct('<8sIII8sII')
+_RECORD = struct.Struct('<IIQ')
+
+EMPTY = 0
+WRITTEN = 1
+CONVERTED = 2
+
+
+def _page_padded(nbytes):
+    return -(-nbytes // mmap.PAGESIZE) * mmap.PAGESIZE
+
+
+class _Layout():
+    def __init__(self, height, width, dtype, nslots, record_bytes):
+        self.shape = (height, width)
+        self.dtype = np.dtype(dtype)
+        self.nslots = nslots
+        self.record_bytes = record_bytes
+        self.frame_bytes = height * width * self.dtype.itemsize
+        self.slot_bytes = record_bytes + _page_padded(self.frame_bytes)
+        self.file_bytes = HEADER_BYTES + nslots * self.slot_bytes
+
+    def record_offset(self, slot):
+        return HEADER_BYTES + slot * self.slot_bytes
+
+    def frame_offset(self, slot):
+        return self.record_offset(slot) + self.record_bytes
+
+    def pack(self):
+        return _HEADER.pack(MAGIC, VERSION, self.shape[0], self.shape[1], self.dtype.str.encode('ascii'),
+                            self.nslots, self.record_bytes)
+
+    @classmethod
+    def unpack(cls, buf):
+        magic, version, height, width, dtype, nslots, record_bytes = _HEADER.unpack_from(buf, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("not a version {} xcam spool file".format(VERSION))
+        return cls(height, width, dtype.rstrip(b'\0').decode('ascii'), nslots, record_bytes)
+
+
+def read_slot(mm, layout, slot):
+    """(state, sequence, record dict or None, frame array view) for one slot of a mapped spool."""
+    offset = layout.record_offset(slot)
+    state, length, sequence = _RECORD.unpack_from(mm, offset)
+    record = None
+    if state != EMPTY:
+        record = json.loads(bytes(mm[offset + _RECORD.size:offset + _RECORD.size + length]).decode('utf-8'))
+    frame = np.frombuffer(mm, dtype=layout.dtype, count=layout.shape[0] * layout.shape[1],
+                          offset=layout.frame_offset(slot)).reshape(layout.shape)
+    return state, sequence, record, frame
+
+
+def write_fits(frame, record):
+    """Write one frame as the FITS file named in its spool record."""
+    hdu = fits.PrimaryHDU(np.array(frame))
+    for keyword, value, comment in record['cards']:
+        hdu.header[keyword] = (value, comment)
+    with open(record['filename'], 'wb') as f:
+        fits.HDUList([hdu]).writeto(f)
+    return record['filename']
+
+
+def convert_slot(path, slot):
+    """
+    Worker process task: make the FITS file for one slot of the spool at path.  Returns the filename.
+    """
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    layout = _Layout.unpack(mm)
+    state, sequence, record, frame = read_slot(mm, layout, slot)
+    if state == EMPTY:
+        raise ValueError("slot {} of {} is empty".format(slot, path))
+    return write_fits(frame, record)
+
+
+def _json_value(value):
+    if isinstance(value, (np.bool_,)):
+        return bool(value)
+    if isinstance(value, np.integer):
+        return int(value)
+    if isinstance(value, np.floating):
+        return float(value)
+    return value
+
+
+class SpoolWriter():
+    """
+    Writes frames into a ring of nslots slots in the spool file at path, and has them converted to FITS
+    by a pool of `processes` worker processes.
+
+    write(metadata, filename) copies the frame (metadata.data, a FrameMetadata from cube_writer) into
+    the next slot.  If that slot's previous frame is still waiting for conversion, it waits for it.
+    wait() blocks until everything written so far has been converted; close() also stops the workers.
+    Conversion failures are reported and the slot left WRITTEN (and the spool file kept) for recover().
+
+    The workers are spawned (not forked), so they re-import the __main__ module: a script creating a
+    SpoolWriter must do so under `if __name__ == '__main__':`.
+    """
+    def __init__(self, path, shape, dtype=np.int32, nslots=256, record_bytes=32768, processes=2):
+        self.path = path
+        self.layout = _Layout(shape[0], shape[1], dtype, nslots, record_bytes)
+        with open(path, 'wb') as f:
+            f.truncate(self.layout.file_bytes)
+            f.write(self.layout.pack())
+        self._f = open(path, 'r+b')
+        self._mm = mmap.mmap(self._f.fileno(), self.layout.file_bytes)
+        self._frames = [np.frombuffer(self._mm, dtype=self.layout.dtype,
+                                      count=self.layout.shape[0] * self.layout.shape[1],
+                                      offset=self.layout.frame_offset(slot)).reshape(self.layout.shape)
+                        for slot in range(nslots)]
+        self._sequence = 0
+        self._pending = {}
+        self.converted = 0
+        self.errors = []
+        try:
+            context = multiprocessing.get_context('spawn')
+        except AttributeError:  # python 2
+            context = multiprocessing
+        self._pool = context.Pool(processes)
+
+    def _set_state(self, slot, state):
+        struct.pack_into('<I', self._mm, self.layout.record_offset(slot), state)
+
+    def write(self, metadata, filename):
+        slot = self._sequence % self.layout.nslots
+        for pending_slot, result in list(self._pending.items()):
+            if pending_slot == slot or result.ready():
+                self._finish(pending_slot, result)
+        record = json.dumps({'filename': filename,
+                             'cards': [(keyword, _json_value(value), comment)
+                                       for keyword, (value, comment) in metadata.cards.items()]},
+                            default=str).encode('utf-8')
+        if _RECORD.size + len(record) > self.layout.record_bytes:
+            raise ValueError("frame metadata ({} bytes) doesn't fit in a spool record".format(len(record)))
+        self._set_state(slot, EMPTY)
+        self._frames[slot][...] = metadata.data
+        offset = self.layout.record_offset(slot)
+        self._mm[offset + _RECORD.size:offset + _RECORD.size + len(record)] = record
+        _RECORD.pack_into(self._mm, offset, WRITTEN, len(record), self._sequence)
+        self._sequence += 1
+        self._pending[slot] = self._pool.apply_async(convert_slot, (self.path, slot))
+        return filename
+
+    def _finish(self, slot, result):
+        del self._pending[slot]
+        try:
+            result.get()
+        except Exception as e:
+            self.errors.append((slot, e))
+            print("SpoolWriter: converting slot {} failed ({}); `python -m nihts_xcam.spool recover {}` "
+                  "will retry it".format(slot, e, self.path))
+            return
+        self._set_state(slot, CONVERTED)
+        self.converted += 1
+
+    def wait(self):
+        for slot, result in sorted(self._pending.items()):
+            self._finish(slot, result)
+
+    def pending(self):
+        return len(self._pending)
+
+    def close(self):
+        """
+        Wait for the conversions, stop the workers and, if every frame made it to FITS, remove the spool.
+        """
+        self.wait()
+        self._pool.close()
+        self._pool.join()
+        del self._frames
+        self._mm.flush()
+        self._mm.close()
+        self._f.close()
+        if not self.errors:
+            os.remove(self.path)
+
+
+def recover(path, quiet=False):
+    """
+    Write FITS files for every slot of the spool at path that was written but not converted.
+    Returns the filenames written.
+    """
+    filenames = []
+    with open(path, 'r+b') as f:
+        mm = mmap.mmap(f.fileno(), 0)
+        layout = _Layout.unpack(mm)
+        slots = []
+        for slot in range(layout.nslots):
+            state, sequence, record, frame = read_slot(mm, layout, slot)
+            if state == WRITTEN:
+                slots.append((sequence, slot))
+        for sequence, slot in sorted(slots):
+            state, sequence, record, frame = read_slot(mm, layout, slot)
+            filenames.append(write_fits(frame, record))
+            struct.pack_into('<I', mm, layout.record_offset(slot), CONVERTED)
+            if not quiet:
+                print("recovered frame {} -> {}".format(sequence, record['filename']))
+        del frame
+        mm.close()
+    return filenames
+
+
+def status(path):
+    """[(slot, state, sequence, filename)] for the spool at path."""
+    out = []
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        layout = _Layout.unpack(mm)
+        for slot in range(layout.nslots):
+            state, sequence, record, frame = read_slot(mm, layout, slot)
+            if state != EMPTY:
+                out.append((slot, state, sequence, record['filename']))
+        del frame
+        mm.close()
+    return out
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Inspect an xcam spool file, or rebuild FITS files from it")
+    parser.add_argument('command', choices=['recover', 'status'])
+    parser.add_argument('spool')
+    args = parser.parse_args(args)
+    if args.command == 'recover':
+        filenames = recover(args.spool)
+        print("{} frames recovered from {}".format(len(filenames), args.spool))
+    else:
+        names = {EMPTY: 'empty', WRITTEN: 'written', CONVERTED: 'converted'}
+        for slot, state, sequence, filename in status(args.spool):
+            print("{:5d} {:9s} {:8d} {}".format(slot, names.get(state, state), sequence, filename))
+
+
+if __name__ == '__main__':
+    main()
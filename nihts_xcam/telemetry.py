@@ -0,0 +1,445 @@
+"""
+TCS and AOS telemetry from the DCT STOMP broker, turned into FITS header cards.
+
+Each STOMP message is converted once, on arrival in the listener thread, into a TelemetrySnapshot:
+a slotted record holding the finished FITS cards for that packet.  TelemetryStore keeps the recent
+snapshots for each topic with their receive times, and answers "what were the cards at time t",
+interpolating pointing between packets and flagging feeds that have gone stale.
+
+Packets are parsed by nihts_xcam.telemetry_parser.parse_packet, which only extracts the elements
+used here.  TelemetryStore is the only store of telemetry; use its latest()/history() for the most
+recent packets (the old module-level getset_dct_status() store is gone).
+"""
+from __future__ import division
+import bisect
+import collections
+import threading
+import time
+from xml.etree.ElementTree import ParseError
+
+from astropy.io import fits
+from stomp.listener import ConnectionListener
+
+from .telemetry_parser import parse_packet
+
+TCS_STATUS = 'tcsStatus'
+TCS_TELEMETRY = 'tcsTelemetry'
+AOS = 'aos'
+TOPICS = (TCS_STATUS, TCS_TELEMETRY, AOS)
+
+
+def _float_or_str(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return value
+
+
+# TCS Packet:  (rotator fixed)
+# OrderedDict([(u'tcsTCSStatus', OrderedDict([(u'accessMode', u'Operator'), (u'azCurrentWrap', u'1'), (u'heartbeat', u'8098'), (u'inPositionIsTrue', u'true'), (u'm1CoverState', u'Open'), (u'mountGuideMode', u'OpenLoop'), (u'rotCurrentWrap', u'-1'), (u'tcsHealth', u'GOOD'), (u'tcsState', u'ENABLED'), (u'currentTimes', OrderedDict([(u'lst', OrderedDict([(u'hours', u'9'), (u'minutesTime', u'45'), (u'secondsTime', u'23')])), (u'time', u'2016-04-20T03:16:30.528+00:00')])), (u'limits', OrderedDict([(u'moonProximity', OrderedDict([(u'distance_deg', u'83.382785373422'), (u'proximityFlag', u'false')])), (u'sunProximity', OrderedDict([(u'distance_deg', u'76.564887381463'), (u'proximityFlag', u'false')])), (u'zenith', OrderedDict([(u'currentZD_deg', u'50.837381'), (u'elZenithLimit_deg', u'89.3'), (u'inBlindSpotIsTrue', u'false'), (u'timeToBlindSpot_min', u'-1'), (u'timeToBlindSpotExit_min', u'-1')])), (u'airmass', u'1.580980523677'), (u'currentTimeToObservable_min', u'-1'), (u'currentTimeToUnobservable_min', u'175'), (u'timeToRotLimit_min', u'-1'), (u'timeToAzLimit_min', u'925')])), (u'pointingPositions', OrderedDict([(u'azElError', OrderedDict([(u'azError', u'-0.0252'), (u'elError', u'0.0108')])), (u'currentAzEl', OrderedDict([(u'azimuth', OrderedDict([(u'degreesArc', u'238'), (u'minutesArc', u'5'), (u'secondsArc', u'48.7')])), (u'elevation', OrderedDict([(u'degreesAlt', u'39'), (u'minutesArc', u'9'), (u'secondsArc', u'45.4')]))])), (u'currentHA', OrderedDict([(u'hours', u'2'), (u'minutesTime', u'45'), (u'secondsTime', u'36.11')])), (u'currentRADec', OrderedDict([(u'declination', OrderedDict([(u'degreesDec', u'1'), (u'minutesArc', u'28'), (u'secondsArc', u'47')])), (u'equinoxPrefix', u'J'), (u'equinoxYear', u'2000'), (u'frame', u'FK5'), (u'ra', OrderedDict([(u'hours', u'6'), (u'minutesTime', u'58'), (u'secondsTime', u'54.88')]))])), (u'currentRotatorPositions', OrderedDict([(u'rotPA', u'175.059382'), (u'iaa', u'4.95'), (u'rotIPA', u'180')])), (u'demandAzEl', OrderedDict([(u'azimuth', OrderedDict([(u'degreesArc', u'238'), (u'minutesArc', u'5'), (u'secondsArc', u'49.93')])), (u'elevation', OrderedDict([(u'degreesAlt', u'39'), (u'minutesArc', u'9'), (u'secondsArc', u'45.07')]))])), (u'demandRADec', OrderedDict([(u'declination', OrderedDict([(u'degreesDec', u'1'), (u'minutesArc', u'28'), (u'secondsArc', u'47.4')])), (u'equinoxPrefix', u'J'), (u'equinoxYear', u'2000'), (u'frame', u'FK5'), (u'ra', OrderedDict([(u'hours', u'6'), (u'minutesTime', u'58'), (u'secondsTime', u'54.82')]))])), (u'demandRotatorPositions', OrderedDict([(u'rotPA', u'175.059372')])), (u'targetName', u'0914-0119451'), (u'currentParAngle', u'44.569672815492')])), (u'axesTrackMode', u'All'), (u'inPositionAzIsTrue', u'true'), (u'inPositionElIsTrue', u'true'), (u'inPositionRotIsTrue', u'true'), (u'externalTargetCfgCmdPreviewIsTrue', u'false')]))])
+def tcs_status_cards(xml):
+    """
+    FITS cards from a parsed TCSTcsStatusSV packet, as a list of (keyword, value, comment).
+    """
+    tcs = xml['tcsTCSStatus']
+    pointing = tcs['pointingPositions']
+    ra = pointing['currentRADec']['ra']
+    dec = pointing['currentRADec']['declination']
+    azimuth = pointing['currentAzEl']['azimuth']
+    elevation = pointing['currentAzEl']['elevation']
+    lst = tcs['currentTimes']['lst']
+    az = float(azimuth['degreesArc']) + float(azimuth['minutesArc'])/60. + float(azimuth['secondsArc'])/3600.
+    el = float(elevation['degreesAlt']) + float(elevation['minutesArc'])/60. + float(elevation['secondsArc'])/3600.
+    return [('TELESCOP', 'DCT', 'Telescope name'),
+            ('TCS-TIME', tcs['currentTimes']['time'], 'TCS Packet UTC time'),
+            ('TCS-OK', tcs['inPositionIsTrue'] == 'true', 'TCS inPositionIsTrue'),
+            ('RA', '{0:2n}:{1:02n}:{2:05.2f}'.format(int(ra['hours']), int(ra['minutesTime']),
+                                                     float(ra['secondsTime'])), 'RA HH:MM:SS.SS'),
+            ('DEC', '{0:+3n}:{1:02n}:{2:04.1f}'.format(int(dec['degreesDec']), int(dec['minutesArc']),
+                                                       float(dec['secondsArc'])), 'DEC DDD:MM:SS.SS'),
+            ('AZ', az, 'Azimuth (deg)'),
+            ('EL', el, 'Elevation (deg)'),
+            ('AIRMASS', float(tcs['limits']['airmass']), 'Airmass'),
+            ('TARGNAME', pointing['targetName'], 'TCS Target Name'),
+            ('LST', '{0:2n}:{1:02n}:{2:04.1f}'.format(int(lst['hours']), int(lst['minutesTime']),
+                                                      float(lst['secondsTime'])), 'TCS LST'),
+            ('rotIPA', float(pointing['currentRotatorPositions']['rotIPA']), 'TCS rotIPA')]
+
+
+# TODO: clean up headers coming from TCS Telemetry, right now am just trying to mirror the xml packet grammar as closely as possible
+# (keyword, TCSTelemetry element, numeric?)
+TCS_TELEMETRY_FIELDS = [('TCSLST', 'TCSLST', False),
+                        ('DEMANDRA', 'DemandRa', False),
+                        ('DEMANDDE', 'DemandDec', False),
+                        ('TCSCURAZ', 'TCSCurrentAzimuth', True),
+                        ('TCSCUREL', 'TCSCurrentElev', True),
+                        ('MNTGMODE', 'MountGuideMode', False),
+                        ('SCITARGN', 'ScienceTargetName', False),
+                        ('M1COVER', 'm1CoverState', False),
+                        ('DOMEDAZ', 'MountDomeAzimuthDifference', True),
+                        ('DOMEWARN', 'DomeOccultationWarning', False),
+                        ('PARANGLE', 'CurrentParAngle', True),
+                        ('TCSroPA', 'TCSCurrentRotatorPA', True),
+                        ('TCSroIAA', 'TCSCurrentRotatorIAA', True),
+                        ('TCSroIPA', 'TCSCurrentRotatorIPA', True),
+                        ('ROTFRAME', 'RotatorFrame', False),
+                        ('TARGFRAM', 'TargetFrame', False),
+                        ('TCSEQUIN', 'equinox', True),
+                        ('TCSState', 'TCSState', False),
+                        ('TCSHealt', 'TCSHealth', False),
+                        ('TCSAMODE', 'TCSAccessMode', False),
+                        ('TCSINPOS', 'InPosition', False),
+                        ('TCSMNTTC', 'MountTemperature', True),
+                        ('CLSLOBAN', 'CLSLowBankState', False),
+                        ('DSSPOSST', 'DSSPositionStatus', False)]
+
+
+def tcs_telemetry_cards(xml):
+    """
+    FITS cards from a parsed tcs.loisTelemetry TCSTelemetry packet.
+
+    Numeric fields that don't parse as numbers (the TCS sometimes sends text) are kept as strings.
+    """
+    telemetry = xml['TCSTelemetry']
+    return [(keyword, _float_or_str(telemetry[element]) if numeric else telemetry[element],
+             'TCSTelemetry ' + element)
+            for keyword, element, numeric in TCS_TELEMETRY_FIELDS]
+
+
+# AOS Packet:
+# OrderedDict([(u'AOSDataPacket', OrderedDict([(u'timestamp', u'2016-04-20T03:16:29.988+00:00'), (u'detailedState', u'UnlockedOpenLoopState'), (u'summaryState', u'Enabled'), (u'tipTiltPistonDemandM1', OrderedDict([(u'X_Tilt_rad', u'0'), (u'Y_Tilt_rad', u'0'), (u'Piston_m', u'0')])), (u'tipTiltPistonDemandM2', OrderedDict([(u'X_Tilt_rad', u'-0.0001380827127709'), (u'Y_Tilt_rad', u'0.00015234633023942'), (u'Piston_m', u'0.00011020825009747')])), (u'comaPointingOffset', OrderedDict([(u'xCorrection_arcsec', u'-18.538316440227'), (u'yCorrection_arcsec', u'-16.802643163435')])), (u'totalFocusOffset', u'0.0006'), (u'focusOffsetDemandOutOfRange', u'false'), (u'wavefrontDataOutOfRange', u'false'), (u'M1FSettled', u'true'), (u'M1LSettled', u'true'), (u'M1PSettled', u'true'), (u'M2PSettled', u'true'), (u'M2VSettled', u'true')]))])
+def aos_cards(xml):
+    """
+    FITS cards from a parsed AOSDataPacket.
+    """
+    aos = xml['AOSDataPacket']
+    # have not bothered to inlude tiptilt pistons, coma pointing offsets
+    return [('FOCUS', 1e6*float(aos['totalFocusOffset']), 'Focus (in microns)'),
+            ('AOSTIME', aos['timestamp'], 'AOS timestamp'),
+            ('AOSDETAI', aos['detailedState'], 'AOS detailedState'),
+            ('AOSSUMMA', aos['summaryState'], 'AOS summaryState'),
+            ('M1FSettl', aos['M1FSettled'] == 'true', 'AOS M1FSettled'),
+            ('M1LSettl', aos['M1LSettled'] == 'true', 'AOS M1LSettled'),
+            ('M1PSettl', aos['M1PSettled'] == 'true', 'AOS M1PSettled'),
+            ('M2PSettl', aos['M2PSettled'] == 'true', 'AOS M2PSettled'),
+            ('M2VSettl', aos['M2VSettled'] == 'true', 'AOS M2VSettled'),
+            ('FOCUS_OK', aos['focusOffsetDemandOutOfRange'] == 'false', 'AOS focusOffsetDemandOutOfRange == false'),
+            ('WAVEF_OK', aos['wavefrontDataOutOfRange'] == 'false', 'AOS wavefrontDataOutOfRange == false')]
+
+
+CARD_BUILDERS = {TCS_STATUS: tcs_status_cards, TCS_TELEMETRY: tcs_telemetry_cards, AOS: aos_cards}
+
+# cards that are interpolated between packets: (keyword, wrap), where wrap=360. means an angle that
+# wraps at 360 deg (interpolate the short way round, result in [0, 360))
+INTERPOLATED = {TCS_STATUS: [('AZ', 360.), ('EL', None)],
+                TCS_TELEMETRY: [('TCSCURAZ', 360.), ('TCSCUREL', None), ('TCSroPA', 360.), ('PARANGLE', None)],
+                AOS: []}
+
+# (packet age keyword, packet ok keyword, description) for each topic
+# topic -> (STOMP destination, subscription id)
+DESTINATIONS = collections.OrderedDict([
+    (TCS_STATUS, ('/topic/TCS.TCSSharedVariables.TCSHighLevelStatusSV.TCSTcsStatusSV', 123)),
+    (TCS_TELEMETRY, ('/topic/tcs.loisTelemetry', 234)),
+    (AOS, ('/topic/AOS.AOSPubDataSV.AOSDataPacket', 345))])
+
+AGE_KEYWORDS = {TCS_STATUS: ('TCSSTAGE', 'TCSSTOK', 'TCS status'),
+                TCS_TELEMETRY: ('TCSTLAGE', 'TCSTELEM', 'TCSTelemetry'),
+                AOS: ('AOSAGE', 'AOSOK', 'AOS')}
+
+
+class TelemetrySnapshot(object):
+    """
+    One telemetry packet, reduced to what goes in the FITS header.
+
+    topic - one of TOPICS
+    version - increments with every packet received on any topic
+    received - time.time() when the packet arrived
+    cards - list of astropy.io.fits.Card, ready to be appended to a header
+    values - {keyword: float} for the cards listed in INTERPOLATED
+    """
+    __slots__ = ('topic', 'version', 'received', 'cards', 'values')
+
+    def __init__(self, topic, version, received, cards, values=None):
+        self.topic = topic
+        self.version = version
+        self.received = received
+        self.cards = cards
+        self.values = values if values is not None else {}
+
+
+class TelemetryStore():
+    """
+    Recent TelemetrySnapshots for each topic, with receive times, updated from the STOMP listener threads.
+
+    cards_at(t) gives the FITS cards describing the telescope at time t (e.g. mid-exposure):
+      - each topic's cards come from the last packet received at or before t (or the first one after
+        t if there is none before it)
+      - if there are packets on both sides of t, the pointing cards in INTERPOLATED are linearly
+        interpolated between them
+      - the age of each feed's packet relative to t is recorded, and the feed is marked not OK if it
+        is older than stale_sec[topic]
+
+    The lock is only held to append a snapshot or copy out a topic's history, so the acquisition loop
+    never waits on the listener threads for longer than that.
+
+    Each topic's assembled cards are cached by the versions of the packets either side of t, so a
+    header normally gets a copy of a cached list with only the interpolated pointing cards and the
+    packet age card made afresh.
+    """
+    def __init__(self, history=100, stale_sec=None):
+        self._lock = threading.Lock()
+        self._history = dict((topic, collections.deque(maxlen=history)) for topic in TOPICS)
+        self.stale_sec = dict((topic, 10.) for topic in TOPICS)
+        if stale_sec is not None:
+            self.stale_sec.update(stale_sec)
+        self.version = 0
+        # topic -> ((before.version, after.version or None), cards, [(index, keyword, a, delta, wrap)])
+        self._assembled = {}
+        self._ok_cards = {}
+        for topic in TOPICS:
+            age_keyword, ok_keyword, description = AGE_KEYWORDS[topic]
+            self._ok_cards[topic] = {
+                None: fits.Card(ok_keyword, False, '{} packet not OK'.format(description)),
+                False: fits.Card(ok_keyword, False, '{} packet not OK (stale)'.format(description)),
+                True: fits.Card(ok_keyword, True, '{} packet OK'.format(description))}
+
+    def update(self, topic, xml, received=None):
+        """
+        Build and store the snapshot for a parsed packet on `topic`.  A packet that can't be turned into
+        cards (missing element, unparseable number) is reported and otherwise ignored.
+        """
+        if received is None:
+            received = time.time()
+        try:
+            cards = [fits.Card(*card) for card in CARD_BUILDERS[topic](xml)]
+        except (KeyError, TypeError, ValueError) as e:
+            print("could not build FITS cards from {} packet: {!r}".format(topic, e))
+            return None
+        interpolated = [keyword.upper() for keyword, wrap in INTERPOLATED[topic]]
+        values = dict((card.keyword, card.value) for card in cards
+                      if card.keyword in interpolated and isinstance(card.value, float))
+        with self._lock:
+            self.version += 1
+            snapshot = TelemetrySnapshot(topic, self.version, received, cards, values)
+            self._history[topic].append(snapshot)
+        return snapshot
+
+    def latest(self, topic):
+        with self._lock:
+            history = self._history[topic]
+            return history[-1] if history else None
+
+    def history(self, topic):
+        with self._lock:
+            return list(self._history[topic])
+
+    def _bracket(self, topic, t):
+        history = self.history(topic)
+        if not history:
+            return None, None
+        i = bisect.bisect_right([snapshot.received for snapshot in history], t)
+        if i == 0:
+            return history[0], None
+        if i == len(history):
+            return history[-1], None
+        return history[i - 1], history[i]
+
+    def _assemble(self, topic, before, after):
+        """
+        (cards, interpolated) for t between packets before and after (after None if there is no later
+        one): the card list with the values of `before`, and for each card to be interpolated its
+        (index in cards, keyword, value at before, change to after, wrap).  Cached.
+        """
+        key = (before.version, None if after is None else after.version)
+        cached = self._assembled.get(topic)
+        if cached is not None and cached[0] == key:
+            return cached[1], cached[2]
+        interpolated = []
+        if after is not None and before.values:
+            index = dict((card.keyword, i) for i, card in enumerate(before.cards))
+            for keyword, wrap in INTERPOLATED[topic]:
+                keyword = keyword.upper()
+                if keyword not in before.values or keyword not in after.values:
+                    continue
+                a = before.values[keyword]
+                delta = after.values[keyword] - a
+                if wrap is not None:
+                    delta = (delta + wrap / 2.) % wrap - wrap / 2.
+                interpolated.append((index[keyword], keyword, a, delta, wrap))
+        self._assembled[topic] = (key, before.cards, interpolated)
+        return before.cards, interpolated
+
+    def cards_at(self, t):
+        """
+        FITS cards for all topics at time t (seconds since epoch).  See class docstring.
+        """
+        cards = []
+        for topic in TOPICS:
+            age_keyword, ok_keyword, description = AGE_KEYWORDS[topic]
+            before, after = self._bracket(topic, t)
+            if before is None:
+                cards.append(self._ok_cards[topic][None])
+                continue
+            topic_cards, interpolated = self._assemble(topic, before, after)
+            if interpolated:
+                start = len(cards)
+                cards.extend(topic_cards)
+                f = (t - before.received) / (after.received - before.received)
+                for i, keyword, a, delta, wrap in interpolated:
+                    value = a + f * delta
+                    if wrap is not None:
+                        value %= wrap
+                    cards[start + i] = fits.Card(keyword, value, topic_cards[i].comment)
+            else:
+                cards.extend(topic_cards)
+            age = t - before.received
+            cards.append(fits.Card(age_keyword, round(age, 3), '[s] {} packet age at mid-exposure'.format(description)))
+            cards.append(self._ok_cards[topic][abs(age) <= self.stale_sec[topic]])
+        return cards
+
+    def cards(self):
+        """
+        FITS cards from the latest packet on each topic, aged relative to now.
+        """
+        return self.cards_at(time.time())
+
+
+class _subscriber(ConnectionListener):
+    topic = None
+
+    def __init__(self, telemetry=None):
+        self.telemetry = telemetry
+
+    def on_message(self, headers, body):
+        # a malformed or truncated packet is reported and dropped, rather than raising in the
+        # connection's listener thread
+        try:
+            xml = parse_packet(body)
+        except ParseError as e:
+            print("could not parse {} packet: {!r}".format(self.topic, e))
+            return
+        if self.telemetry is not None:
+            self.telemetry.update(self.topic, xml)
+
+
+class tcsStatus_subscriber(_subscriber):
+    topic = TCS_STATUS
+
+
+class tcsTelemetry_subscriber(_subscriber):
+    topic = TCS_TELEMETRY
+
+
+class aos_subscriber(_subscriber):
+    topic = AOS
+
+
+class _dispatcher(ConnectionListener):
+    """
+    The one listener on a TelemetryClient connection: hands each message to the subscriber for its
+    destination and tells the client when the connection drops.
+    """
+    def __init__(self, client, subscribers):
+        self.client = client
+        self.subscribers = subscribers
+
+    def on_message(self, headers, body):
+        subscriber = self.subscribers.get(headers.get('destination'))
+        if subscriber is not None:
+            subscriber.on_message(headers, body)
+
+    def on_disconnected(self):
+        self.client._disconnected(self)
+
+
+class TelemetryClient():
+    """
+    A single STOMP connection carrying all the telemetry subscriptions (TCS status, TCS telemetry, AOS),
+    with messages routed to the per-topic subscribers by destination.
+
+    start() returns immediately; connecting happens in a daemon thread, so a slow or absent broker
+    doesn't hold up the camera.  If the connection can't be made, or drops later, a fresh connection is
+    tried after a delay that doubles from min_backoff_sec up to max_backoff_sec.
+
+        connection_factory - called with host_and_ports, returns a stomp.Connection-like object
+        host_and_ports - [(host, port)]
+    """
+    def __init__(self, telemetry, connection_factory, host_and_ports, min_backoff_sec=1., max_backoff_sec=60.):
+        self.telemetry = telemetry
+        self._connection_factory = connection_factory
+        self.host_and_ports = host_and_ports
+        self.min_backoff_sec = min_backoff_sec
+        self.max_backoff_sec = max_backoff_sec
+        self.subscribers = dict((DESTINATIONS[cls.topic][0], cls(telemetry))
+                                for cls in (tcsStatus_subscriber, tcsTelemetry_subscriber, aos_subscriber))
+        self.connection = None
+        self.connect_count = 0
+        self._listener = None
+        self._lost = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._lost.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._close()
+
+    def is_connected(self):
+        connection = self.connection
+        return connection is not None and connection.is_connected()
+
+    def _connect(self):
+        connection = self._connection_factory(self.host_and_ports)
+        listener = _dispatcher(self, self.subscribers)
+        connection.set_listener('telemetry', listener)
+        self._listener = listener
+        self._lost.clear()
+        connection.start()
+        connection.connect(wait=True)
+        for destination, id in DESTINATIONS.values():
+            connection.subscribe(destination, id)
+        self.connection = connection
+        self.connect_count += 1
+
+    def _close(self):
+        connection, self.connection = self.connection, None
+        self._listener = None
+        if connection is not None:
+            try:
+                connection.disconnect()
+            except Exception:
+                pass
+
+    def _disconnected(self, listener):
+        if listener is self._listener:
+            self._lost.set()
+
+    def _run(self):
+        backoff = self.min_backoff_sec
+        while not self._stop.is_set():
+            try:
+                self._connect()
+            except Exception as e:
+                self._close()
+                print("TelemetryClient: could not connect to {}: {}; retrying in {:.0f} sec".format(
+                      self.host_and_ports, e, backoff))
+                self._stop.wait(backoff)
+                backoff = min(2 * backoff, self.max_backoff_sec)
+                continue
+            backoff = self.min_backoff_sec
+            self._lost.wait()
+            if not self._stop.is_set():
+                print("TelemetryClient: lost connection to {}, reconnecting".format(self.host_and_ports))
+                self._close()
+
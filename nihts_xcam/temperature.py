@@ -0,0 +1,114 @@
+from __future__ import division
+import threading
+import time
+
+import numpy as np
+
+
+class TemperatureMonitor():
+    """
+    Samples the detector temperature registers in a background thread so that the acquisition loop
+    never has to talk to the camera for its TK_* header values.
+
+    Every cadence_sec one get_temperature_ADU and one get_temperature_ADCtype read are made and stored,
+    timestamped, in a ring buffer of nsamples entries along with the running median of the last
+    median_window reads (replacing the old median of 5 back-to-back reads).  lookup(t) returns the
+    running medians from the sample nearest in time to t.
+
+    read_adu, read_adctype - callables returning the raw register values (negative if the camera isn't
+                             open, in which case the sample is skipped)
+    lock - if given, held around each pair of register reads; XenicsCamera shares it with its other
+           register access and holds it for each frame read (one coadd at a time), so samples are
+           taken between frames, including within a long stack of coadds
+    """
+    def __init__(self, read_adu, read_adctype, cadence_sec=1., nsamples=3600, median_window=5, lock=None):
+        self._read_adu = read_adu
+        self._read_adctype = read_adctype
+        self.cadence_sec = cadence_sec
+        self.median_window = median_window
+        self._usb_lock = lock if lock is not None else threading.Lock()
+        self._lock = threading.Lock()
+        self._times = np.zeros(nsamples)
+        self._adu = np.zeros(nsamples)
+        self._adc = np.zeros(nsamples)
+        self._adu_median = np.zeros(nsamples)
+        self._adc_median = np.zeros(nsamples)
+        self._nsamples = nsamples
+        self._count = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.sample()
+            except Exception as e:
+                print("TemperatureMonitor: temperature read failed: {}".format(e))
+            self._stop.wait(self.cadence_sec)
+
+    def sample(self):
+        """
+        Take one pair of reads now and add it to the ring buffer.
+        """
+        with self._usb_lock:
+            adu = self._read_adu()
+            adc = self._read_adctype()
+        if adu < 0 or adc < 0:
+            raise IOError("camera is not open")
+        t = time.time()
+        with self._lock:
+            i = self._count % self._nsamples
+            self._times[i] = t
+            self._adu[i] = adu
+            self._adc[i] = adc
+            self._count += 1
+            n = min(self._count, self.median_window)
+            recent = (np.arange(i - n + 1, i + 1)) % self._nsamples
+            self._adu_median[i] = np.median(self._adu[recent])
+            self._adc_median[i] = np.median(self._adc[recent])
+
+    def __len__(self):
+        return min(self._count, self._nsamples)
+
+    def _ordered(self, *arrays):
+        # ring buffer contents, oldest first
+        n = len(self)
+        start = self._count % self._nsamples if self._count > self._nsamples else 0
+        return [np.concatenate([a[start:n], a[:start]]) for a in arrays]
+
+    def samples(self):
+        """
+        Returns (times, adu, adctype) for everything in the ring buffer, oldest first.
+        """
+        with self._lock:
+            return self._ordered(self._times, self._adu, self._adc)
+
+    def lookup(self, t):
+        """
+        Running median (adu, adctype) from the sample nearest in time to t (seconds since epoch), or
+        None if nothing has been sampled yet.  t may also be an array, in which case arrays are returned.
+        """
+        with self._lock:
+            if self._count == 0:
+                return None
+            times, adu_median, adc_median = self._ordered(self._times, self._adu_median, self._adc_median)
+        j = np.clip(np.searchsorted(times, t), 1, max(len(times) - 1, 1))
+        if len(times) > 1:
+            j = np.where(np.abs(times[j - 1] - t) <= np.abs(times[j] - t), j - 1, j)
+        else:
+            j = j * 0
+        return adu_median[j], adc_median[j]
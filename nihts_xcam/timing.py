@@ -0,0 +1,58 @@
+from __future__ import division
+import time
+import threading
+from contextlib import contextmanager
+
+
+class StageTimer():
+    """
+    Accumulates wall clock time spent in named stages of the acquisition loop.
+
+        with timer.stage('capture'):
+            ...
+
+    Cheap enough to leave on all the time (a couple of time.time() calls and a dict update per stage).
+    Safe to use from the pipelined acquisition threads.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._count = {}
+            self._total = {}
+            self._max = {}
+
+    def add(self, name, sec):
+        with self._lock:
+            self._count[name] = self._count.get(name, 0) + 1
+            self._total[name] = self._total.get(name, 0.) + sec
+            if sec > self._max.get(name, 0.):
+                self._max[name] = sec
+
+    @contextmanager
+    def stage(self, name, record=None):
+        """
+        Time the enclosed block as stage `name`.  If `record` (a dict) is given the elapsed time is also
+        added to record[name], which is how per-frame timings are collected.
+        """
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            sec = time.time() - t0
+            self.add(name, sec)
+            if record is not None:
+                record[name] = record.get(name, 0.) + sec
+
+    def summary(self):
+        """
+        Returns {stage: {'count', 'total_sec', 'mean_sec', 'max_sec'}}
+        """
+        with self._lock:
+            return dict((name, {'count': self._count[name],
+                                'total_sec': self._total[name],
+                                'mean_sec': self._total[name] / self._count[name],
+                                'max_sec': self._max.get(name, 0.)})
+                        for name in self._count)
@@ -177,7 +177,24 @@ typedef struct {
         usb_dev_handle	               *m_hDevice;
 } XCCHANDLE_I;
 
-XCCHANDLE_I *hnd;
+XCCHANDLE_I *hnd = NULL;
+
+// The USB accessors below return an error instead of touching the device if the camera isn't open
+// (never opened, or closed by close_camera()), e.g. a register read racing a reconnect.
+bool camera_is_open() { return hnd != NULL && (*hnd).m_hDevice != NULL; }
+
+// The cur* values in hnd mirror what was last written to the camera.  While register_cache_valid is
+// set they are trusted to be what the camera actually has, and setters skip writes that wouldn't
+// change anything.  It is set once open_camera has written everything, cleared on any failed write,
+// and cleared by invalidate_register_cache() (e.g. if the camera seems to have forgotten its PWM).
+int register_cache_valid = 0;
+int register_writes_skipped = 0;
+int dummy_frames_taken = 0;
+
+void invalidate_register_cache() { register_cache_valid = 0; }
+int get_register_cache_valid() { return register_cache_valid; }
+int get_register_writes_skipped() { return register_writes_skipped; }
+int get_dummy_frames_taken() { return dummy_frames_taken; }
 
 long FileLength(FILE *fp)
 {
@@ -191,9 +208,17 @@ long FileLength(FILE *fp)
 
 int get_max_width() { return(MAXWIDTH); }
 int get_max_height() { return(MAXHEIGHT); }
-int get_camera_found_on_usb() { return (*hnd).camera_found_on_usb; }
-int get_image_capture_timeout() { return (*hnd).image_capture_timeout; }
-int get_command_timeout() { return (*hnd).command_timeout; }
+
+// Size of the frames the camera is currently sending, set by set_window().  With an increment of n
+// only every n'th column/row of the window is read out.
+int frame_width = MAXWIDTH;
+int frame_height = MAXHEIGHT;
+
+int get_frame_width() { return(frame_width); }
+int get_frame_height() { return(frame_height); }
+int get_camera_found_on_usb() { return hnd != NULL ? (*hnd).camera_found_on_usb : 0; }
+int get_image_capture_timeout() { return camera_is_open() ? (*hnd).image_capture_timeout : -1; }
+int get_command_timeout() { return camera_is_open() ? (*hnd).command_timeout : -1; }
 
 // TODO 2014-01-10: examine how this timeout is actually used
 int calculate_timeout(int integrationTimeMillisec) { return 5000 + (integrationTimeMillisec); }
@@ -224,6 +249,8 @@ XCCERROR get_status(XCCHANDLE_I *hnd, unsigned short *value,
     char filler[54];		// Make sure the packet is 64 bytes.
   } USBSTATUS;
   USBSTATUS status;
+  if(!camera_is_open())
+    return(XCC_E);
   memset(&status,0,10);
   retUSB  = usb_control_msg((*hnd).m_hDevice, 
                  USB_ENDPOINT_IN | USB_TYPE_VENDOR | USB_RECIP_DEVICE, 
@@ -255,6 +282,8 @@ XCCERROR send_command_to_FPGA(unsigned short value)
   XCCERROR retXCC = XCC_I_OK;
   int bytes = 2;
   int retUSB = 0;
+  if(!camera_is_open())
+    return(XCC_E);
   retUSB = usb_control_msg((*hnd).m_hDevice,
                 USB_ENDPOINT_OUT | USB_TYPE_VENDOR | USB_RECIP_DEVICE,
                 X_CmdFPGA, 0, 0, (char*)(&value), bytes,
@@ -292,6 +321,8 @@ XCCERROR set_generic_short(unsigned short base, unsigned short value)
 XCCERROR get_register16(unsigned int reg, unsigned short *value)
 {
   XCCERROR ret = XCC_I_OK;
+  if(!camera_is_open())
+    return(XCC_E);
   ret |= send_command_to_FPGA(AUX_ADDRESS | 255);	
   ret |= send_command_to_FPGA(AUX_DATA | (reg & 0xff));
   get_status(hnd, value, NULL);
@@ -304,6 +335,8 @@ XCCERROR set_register16(unsigned int reg, unsigned short value)
 {
   XCCERROR ret = XCC_I_OK;
   unsigned short tempvalue;
+  if(!camera_is_open())
+    return(XCC_E);
   switch(reg)
     {
     case Reg16_ADC_Vin:	
@@ -365,6 +398,8 @@ XCCERROR set_register32(unsigned int reg, unsigned long value)
 {
   XCCERROR ret = XCC_I_OK;
   unsigned short tempvalue;
+  if(!camera_is_open())
+    return(XCC_E);
   switch(reg)
     {
     case Reg32_SensorWord:
@@ -386,6 +421,8 @@ XCCERROR set_register32(unsigned int reg, unsigned long value)
 int set_ADC_Vin(int ADC_Vin)
 {
   XCCERROR xcc_ret = XCC_I_OK;
+  if(!camera_is_open())
+    return(XCC_E);
   xcc_ret |= set_register16(Reg16_ADC_Vin, ADC_Vin);
   (*hnd).cur_ADC_Vin = ADC_Vin;
   return (int)xcc_ret;
@@ -394,6 +431,8 @@ int set_ADC_Vin(int ADC_Vin)
 int set_ADC_Vref(int ADC_Vref)
 {
   XCCERROR xcc_ret = XCC_I_OK;
+  if(!camera_is_open())
+    return(XCC_E);
   xcc_ret |= set_register16(Reg16_ADC_Vref, ADC_Vref);
   (*hnd).cur_ADC_Vref = ADC_Vref;
   return (int)xcc_ret;
@@ -402,6 +441,8 @@ int set_ADC_Vref(int ADC_Vref)
 int set_Vdet_comA(int Vdet_comA)
 {
   XCCERROR xcc_ret = XCC_I_OK;
+  if(!camera_is_open())
+    return(XCC_E);
   xcc_ret |= set_register16(Reg16_Vdet_com, Vdet_comA);
   (*hnd).cur_Vdet_comA = Vdet_comA;
   return (int)xcc_ret;
@@ -410,37 +451,63 @@ int set_Vdet_comA(int Vdet_comA)
 int set_Vdet_comB(int Vdet_comB)
 {
   XCCERROR xcc_ret = XCC_I_OK;
+  if(!camera_is_open())
+    return(XCC_E);
   xcc_ret |= set_register16(Reg16_Vdet_com2, Vdet_comB);
   (*hnd).cur_Vdet_comB = Vdet_comB;
   return (int)xcc_ret;
 }
 
-int get_ADC_Vin(){ return (*hnd).cur_ADC_Vin; }
-int get_ADC_Vref(){ return (*hnd).cur_ADC_Vref; }
-int get_Vdet_comA(){ return (*hnd).cur_Vdet_comA; }
-int get_Vdet_comB(){ return (*hnd).cur_Vdet_comB; }
+int get_ADC_Vin(){ return camera_is_open() ? (*hnd).cur_ADC_Vin : -1; }
+int get_ADC_Vref(){ return camera_is_open() ? (*hnd).cur_ADC_Vref : -1; }
+int get_Vdet_comA(){ return camera_is_open() ? (*hnd).cur_Vdet_comA : -1; }
+int get_Vdet_comB(){ return camera_is_open() ? (*hnd).cur_Vdet_comB : -1; }
 
-int set_fan(int FanState)
+int _set_fan(int FanState)
 { // FanState = 0 turns fan Off anything else turns fan On
   XCCERROR xcc_ret = XCC_I_OK;
   unsigned short tempvalue;
+  if(!camera_is_open())
+    return(XCC_E);
   tempvalue = ((Reg1_Cooling & 0xff) << 8) | (FanState ? 1:0);  
   xcc_ret |= send_command_to_FPGA(CC_CTRL | 
                              ( (tempvalue >> 7) | (tempvalue & 0x01) ) );
   (*hnd).curFan = (FanState ? 1:0);
+  if(xcc_ret != XCC_I_OK)
+    register_cache_valid = 0;
   return((int)xcc_ret);
 }
 
-int get_fan() { return (*hnd).curFan; }
+int set_fan(int FanState)
+{
+  if(!camera_is_open())
+    return(XCC_E);
+  if(register_cache_valid && (*hnd).curFan == (FanState ? 1:0))
+    {
+      register_writes_skipped++;
+      return XCC_I_OK;
+    }
+  return _set_fan(FanState);
+}
+
+int get_fan() { return camera_is_open() ? (*hnd).curFan : -1; }
 
-int set_pwm(int usPWM)
+int limit_pwm(int usPWM)
 {
-  XCCERROR xcc_ret = XCC_I_OK;
   int maxPWM = 4095;  
   int limitedPWM;
   limitedPWM = usPWM;
   if (usPWM < 0)  limitedPWM = 0;
   if (usPWM > maxPWM)  limitedPWM = maxPWM;  
+  return limitedPWM;
+}
+
+int _set_pwm(int usPWM)
+{
+  XCCERROR xcc_ret = XCC_I_OK;
+  int limitedPWM = limit_pwm(usPWM);
+  if(!camera_is_open())
+    return(XCC_E);
   (*hnd).curPWM = limitedPWM;
   xcc_ret |= send_command_to_FPGA(C_ANASEL | (255 & 0xff));  
   xcc_ret |= send_command_to_FPGA(0xffc9);
@@ -459,11 +526,25 @@ int set_pwm(int usPWM)
   xcc_ret |= set_generic_short(C_ANAVAL0, limitedPWM);
   xcc_ret |= send_command_to_FPGA(0xffc9);
   xcc_ret |= send_command_to_FPGA(0xffcb);
+  if(xcc_ret != XCC_I_OK)
+    register_cache_valid = 0;
   return (int)xcc_ret;
 }
 
 
-int get_pwm() { return (*hnd).curPWM; }
+int set_pwm(int usPWM)
+{
+  if(!camera_is_open())
+    return(XCC_E);
+  if(register_cache_valid && (*hnd).curPWM == limit_pwm(usPWM))
+    {
+      register_writes_skipped++;
+      return XCC_I_OK;
+    }
+  return _set_pwm(usPWM);
+}
+
+int get_pwm() { return camera_is_open() ? (*hnd).curPWM : -1; }
 
 
 // TODO 2014-01-10: figure out if get_temperature_ADCtype (formerly GetTemperature_ADCtype) is useful - we hadn't been using it in the old server
@@ -471,6 +552,8 @@ int get_temperature_ADCtype()
 {
   XCCERROR xcc_ret = XCC_I_OK;
   unsigned short ADCtype = 1;
+  if(!camera_is_open())
+    return -1;
   xcc_ret |= get_register16(Reg16_TempType, &ADCtype);
   return (int)(ADCtype);
 }
@@ -480,6 +563,8 @@ int get_temperature_ADU()
 {
   XCCERROR xcc_ret = XCC_I_OK;
   unsigned short adu = 0;
+  if(!camera_is_open())
+    return -1;
   xcc_ret |= get_register16(Reg16_Temperature, &adu);
   return (int)(adu);
 }
@@ -489,6 +574,8 @@ void load_buffer(const  char *buffer,unsigned long length)
 {
   int dest = 0; 
   unsigned int i;
+  if(!camera_is_open())
+    return;
   usb_control_msg((*hnd).m_hDevice, 
 		  USB_ENDPOINT_OUT | USB_TYPE_VENDOR | USB_RECIP_DEVICE, 
 		  X_StartTTB, dest, 0, 0, 0, (*hnd).command_timeout); //);
@@ -528,15 +615,15 @@ void load_buffer_file(const char *filename)
 }
 
 
-XCCERROR set_WOI(int xs, int ys, int xe, int ye)
+XCCERROR set_WOI(int xs, int ys, int xe, int ye, int xinc, int yinc)
 {
   XCCERROR ret = XCC_I_OK;
   ret |= send_command_to_FPGA(WOI_YSTART | (ys & 0x0fff));
   ret |= send_command_to_FPGA(WOI_YEND   | (ye & 0x0fff));
   ret |= send_command_to_FPGA(WOI_XSTART | (xs & 0x0fff));
   ret |= send_command_to_FPGA(WOI_XEND   | (xe & 0x0fff));
-  ret |= send_command_to_FPGA(WOI_YINC   | (1 & 0x0f));
-  ret |= send_command_to_FPGA(WOI_XINC   | (1 & 0x0f));	
+  ret |= send_command_to_FPGA(WOI_YINC   | (yinc & 0x0f));
+  ret |= send_command_to_FPGA(WOI_XINC   | (xinc & 0x0f));	
   return(ret);
 }
 
@@ -606,10 +693,52 @@ XCCERROR set_capture_mode()
 }
 
 
+// Running totals of the outcomes of the frame reads made by the capture functions, for monitoring.
+// Dummy frames and check_frame_read() polls (expected to fail while the camera starts up) are not
+// counted.  Only ever incremented from the capture thread; read from python with get_*_count().
+unsigned long capture_frames_ok_count = 0;
+unsigned long capture_timeout_count = 0;
+unsigned long capture_underrun_count = 0;
+unsigned long capture_error_count = 0;
+
+int get_frames_ok_count() { return (int)capture_frames_ok_count; }
+int get_usb_timeout_count() { return (int)capture_timeout_count; }
+int get_usb_underrun_count() { return (int)capture_underrun_count; }
+int get_usb_error_count() { return (int)capture_error_count; }
+void reset_capture_counts()
+{
+  capture_frames_ok_count = 0;
+  capture_timeout_count = 0;
+  capture_underrun_count = 0;
+  capture_error_count = 0;
+}
+
+void count_capture(int retXCC)
+{
+  switch(retXCC)
+    {
+    case XCC_I_OK:
+      capture_frames_ok_count++;
+      break;
+    case XCC_E_TimeOut:
+      capture_timeout_count++;
+      break;
+    case XCC_E_Underrun:
+      capture_underrun_count++;
+      break;
+    default:
+      capture_error_count++;
+      break;
+    }
+}
+
+
 int capture_data(char *buffer, int caplen)
 {
   int retUSB = 0;
   int retXCC = XCC_I_OK;
+  if(!camera_is_open())
+    return(XCC_E);
   retUSB = usb_bulk_read((*hnd).m_hDevice, 0x82, buffer, caplen, 
                          (*hnd).image_capture_timeout * 2);
   if(retUSB != caplen) 
@@ -645,38 +774,166 @@ int capture_data(char *buffer, int caplen)
 }
 
 
-//TODO 2014-01-10: looks like long exposure sequences are handled entirely within this.  
-//                 If so, need to monitor for some sort of abort signal?
-void capture_frames(unsigned short *FrameBuffer, int n_pix)
+// Set from python (any thread) to stop capture_frames_abortable between frames.
+// The flag is not cleared by the capture routines themselves, so that an abort requested
+// just before a capture starts is not lost; call clear_capture_abort() at sequence start.
+volatile int capture_abort_requested = 0;
+
+void request_capture_abort() { capture_abort_requested = 1; }
+void clear_capture_abort() { capture_abort_requested = 0; }
+int get_capture_abort() { return capture_abort_requested; }
+
+
+// Reads n_pix/(frame_width*frame_height) frames into FrameBuffer, checking the abort flag before
+// each frame.  Returns the number of frames actually read.  A frame whose read fails is zeroed.
+// The SWIG wrapper releases the GIL around this call (see xenics.i), so nothing in here
+// may touch python objects.
+int capture_frames_abortable(unsigned short *FrameBuffer, int n_pix)
 {
   XCCERROR xccerr;
-  unsigned int singleFrameSizeWords = MAXWIDTH*MAXHEIGHT;
-  unsigned int singleFrameSizeBytes;
-  unsigned int fullBufferSizeWords,fullBufferSizeBytes;
-  unsigned int i;
+  unsigned int singleFrameSizeWords = frame_width*frame_height;
+  unsigned int singleFrameSizeBytes = singleFrameSizeWords*2;
   unsigned int n_frames = ((unsigned int)n_pix) / singleFrameSizeWords;
-  singleFrameSizeBytes = singleFrameSizeWords*2;
-  fullBufferSizeWords = singleFrameSizeWords*n_frames;
-  fullBufferSizeBytes = fullBufferSizeWords*2;
-//   fprintf(stdout,"capture_frames:\n");
+  unsigned int i;
   for(i=0;i<n_frames;i++)
     {
+      if(capture_abort_requested)
+        break;
       xccerr = (XCCERRORs)capture_data((char*) (FrameBuffer + i*singleFrameSizeWords), singleFrameSizeBytes);
+      count_capture(xccerr);
+      if(xccerr != XCC_I_OK)
+        {
+          fprintf(stdout,"capture_data NOT OK with error = %i\n",xccerr);
+          // callers reuse FrameBuffer without clearing it, so don't leave a stale or partial frame behind
+          memset(FrameBuffer + i*singleFrameSizeWords, 0, singleFrameSizeBytes);
+        }
+    }
+  return (int)i;
+}
+
+
+void capture_frames(unsigned short *FrameBuffer, int n_pix)
+{
+  capture_frames_abortable(FrameBuffer, n_pix);
+}
+
+
+// Single frame buffer used by capture_coadd, allocated on first use and kept.
+unsigned short *coadd_frame_buffer = NULL;
+int coadd_frames_ok = 0;
+
+int get_coadd_frames_ok() { return coadd_frames_ok; }
+
+// Streaming coadd: reads n_frames frames one at a time into coadd_frame_buffer and adds each into
+// Sum as it arrives, so memory doesn't grow with the number of coadds.  SumSq (per-pixel sum of
+// squares), Min and Max are also accumulated if they have n_sum elements; pass zero length arrays
+// to skip them.  The accumulators (and get_coadd_frames_ok()) are reset at the start unless accumulate
+// is non-zero, in which case the frames are added to what is already there, so a coadd can be read
+// one frame per call.  Frames whose read fails are left out (get_coadd_frames_ok() gives the number added).
+// Checks the abort flag before each frame and returns the number of frames read, or -1 if the
+// arrays are not frame_width*frame_height long.  Like capture_frames_abortable, runs without the GIL.
+int capture_coadd(int *Sum, int n_sum, double *SumSq, int n_sumsq,
+                  unsigned short *Min, int n_min, unsigned short *Max, int n_max, int n_frames,
+                  int accumulate)
+{
+  XCCERROR xccerr;
+  int singleFrameSizeWords = frame_width*frame_height;
+  int singleFrameSizeBytes = singleFrameSizeWords*2;
+  bool do_sumsq = (n_sumsq == n_sum);
+  bool do_minmax = (n_min == n_sum) && (n_max == n_sum);
+  int i, j;
+  if(n_sum != singleFrameSizeWords)
+    return -1;
+  // sized for a full frame, so it serves any window
+  if(coadd_frame_buffer == NULL)
+    coadd_frame_buffer = (unsigned short *)malloc(MAXWIDTH*MAXHEIGHT*2);
+  if(!accumulate)
+    {
+      memset(Sum, 0, n_sum*sizeof(int));
+      if(do_sumsq)
+        memset(SumSq, 0, n_sum*sizeof(double));
+      if(do_minmax)
+        for(j=0;j<n_sum;j++)
+          {
+            Min[j] = 0xffff;
+            Max[j] = 0;
+          }
+      coadd_frames_ok = 0;
+    }
+  for(i=0;i<n_frames;i++)
+    {
+      if(capture_abort_requested)
+        break;
+      xccerr = (XCCERRORs)capture_data((char*) coadd_frame_buffer, singleFrameSizeBytes);
+      count_capture(xccerr);
       if(xccerr != XCC_I_OK)
-        fprintf(stdout,"capture_data NOT OK with error = %i\n",xccerr);
+        {
+          fprintf(stdout,"capture_data NOT OK with error = %i\n",xccerr);
+          continue;
+        }
+      coadd_frames_ok++;
+      for(j=0;j<n_sum;j++)
+        Sum[j] += coadd_frame_buffer[j];
+      if(do_sumsq)
+        for(j=0;j<n_sum;j++)
+          SumSq[j] += (double)coadd_frame_buffer[j] * (double)coadd_frame_buffer[j];
+      if(do_minmax)
+        for(j=0;j<n_sum;j++)
+          {
+            if(coadd_frame_buffer[j] < Min[j])
+              Min[j] = coadd_frame_buffer[j];
+            if(coadd_frame_buffer[j] > Max[j])
+              Max[j] = coadd_frame_buffer[j];
+          }
     }
+  return i;
 }
 
 
+// Throw-away frames are read into this, allocated (full frame) on first use and kept.
+unsigned short *dummy_frame_buffer = NULL;
+
 void take_dummy_frame()
 {
   unsigned int xBufSizWords,xBufSizBytes;
-  xBufSizWords = MAXWIDTH*MAXHEIGHT;
+  xBufSizWords = frame_width*frame_height;
   xBufSizBytes = xBufSizWords*2;
-  unsigned short *FrameBuffer = (unsigned short *)malloc(xBufSizBytes); 
+  if(dummy_frame_buffer == NULL)
+    dummy_frame_buffer = (unsigned short *)malloc(MAXWIDTH*MAXHEIGHT*2);
   //  2012-02-28: for reasons unclear to me (hroe) I am needing to take 2 dummy frames
-  capture_data((char*) FrameBuffer, xBufSizBytes);
-  capture_data((char*) FrameBuffer, xBufSizBytes);
+  capture_data((char*) dummy_frame_buffer, xBufSizBytes);
+  capture_data((char*) dummy_frame_buffer, xBufSizBytes);
+  dummy_frames_taken += 2;
+}
+
+
+// Read one frame and return the capture_data status (0 = OK), to check that the camera is delivering
+// frames after it has been opened.
+int check_frame_read()
+{
+  if(dummy_frame_buffer == NULL)
+    dummy_frame_buffer = (unsigned short *)malloc(MAXWIDTH*MAXHEIGHT*2);
+  return (int)capture_data((char*) dummy_frame_buffer, frame_width*frame_height*2);
+}
+
+
+// Window of interest: read out only columns x0..x0+width-1 and rows y0..y0+height-1, every xinc'th
+// column and yinc'th row of those (increments 1-15).  The frame rate limit is raised to suit the
+// smaller frame, and the dummy frames flush anything already in flight at the old size.
+// Returns 0, -1 (and changes nothing) if the window doesn't fit on the detector, or the XCC error bits
+// if the camera didn't take the window or frame rate.
+int set_window(int x0, int y0, int width, int height, int xinc, int yinc)
+{
+  XCCERROR xcc_ret = XCC_I_OK;
+  if(x0 < 0 || y0 < 0 || width < 1 || height < 1 || x0 + width > MAXWIDTH || y0 + height > MAXHEIGHT ||
+     xinc < 1 || xinc > 15 || yinc < 1 || yinc > 15)
+    return -1;
+  xcc_ret |= set_WOI(x0, y0, x0 + width - 1, y0 + height - 1, xinc, yinc);
+  frame_width = (width + xinc - 1) / xinc;
+  frame_height = (height + yinc - 1) / yinc;
+  xcc_ret |= set_frame_rate(350, frame_width, frame_height);
+  take_dummy_frame();
+  return (int)xcc_ret;
 }
 
 // TODO: 2014-01-13:  combine _set_commandword9808 & set_commandword9808 into single subroutine
@@ -741,7 +998,9 @@ XCCERROR _set_commandword9808(
 
 
 XCCERROR set_commandword9808()
-{ return _set_commandword9808((*hnd).cur_itr,(*hnd).cur_gain,
+{ if(!camera_is_open())
+    return(XCC_E);
+  return _set_commandword9808((*hnd).cur_itr,(*hnd).cur_gain,
          (*hnd).cur_multiplereadouts,(*hnd).cur_nondestructive,
          (*hnd).cur_xinv,(*hnd).cur_yinv,(*hnd).cur_linerepeat,
          (*hnd).cur_refout,(*hnd).cur_reset,(*hnd).cur_skim,
@@ -749,182 +1008,290 @@ XCCERROR set_commandword9808()
          (*hnd).cur_bandwidth,(*hnd).cur_outputfactor); }
 
 
-void _set_integration_time_millisec(unsigned long iTime)
+XCCERROR _set_integration_time_millisec(unsigned long iTime)
 {
   XCCERROR xcc_ret = XCC_I_OK;
+  if(!camera_is_open())
+    return(XCC_E);
   // expect iTime in millisec, but xenics requires microseconds  
   xcc_ret |= set_generic_long(C_LAG0,
                                   (unsigned long) (iTime * 1000 * 40));
   // I think the  * 40 relates to a 40mhz clock.
   (*hnd).image_capture_timeout = calculate_timeout((int)iTime);
   (*hnd).curIntegrationTimeMillisec = (int)(iTime);
+  if(xcc_ret != XCC_I_OK)
+    register_cache_valid = 0;
+  return xcc_ret;
 }
 
 void set_integration_time_millisec(unsigned long iTime)
 { // reason to have _Set... separately is so that one can call it withotu
 //having a dummy frame taken when in the midst of camera startup, otherwise
 // we see timeouts during startup
+  if(!camera_is_open())
+    return;
+  if(register_cache_valid && (*hnd).curIntegrationTimeMillisec == (int)iTime)
+    {
+      register_writes_skipped++;
+      return;
+    }
   _set_integration_time_millisec(iTime);
   take_dummy_frame();  
 }
 
 
 int get_integration_time_millisec()
-{ return (*hnd).curIntegrationTimeMillisec; }
+{ return camera_is_open() ? (*hnd).curIntegrationTimeMillisec : -1; }
 
-// HEREIAM adding to xenics.i
 
-XCCERROR set_gain(int gain)
+// Send the 9808 command word after one of its fields has changed.  Writing it has been seen to turn
+// the fan off (2015-06-19), so the fan state is sent again after it.  dummy_frames=false leaves
+// flushing the frames already in flight to the caller.
+XCCERROR write_commandword(bool dummy_frames)
 {
   XCCERROR xcc_ret;
-  (*hnd).cur_gain = (gain ? 1:0);
   xcc_ret = set_commandword9808();
-  take_dummy_frame();
+  xcc_ret |= _set_fan((*hnd).curFan);
+  if(dummy_frames)
+    take_dummy_frame();
+  if(xcc_ret != XCC_I_OK)
+    register_cache_valid = 0;
+  return (int)xcc_ret;
+}
+
+XCCERROR skip_commandword()
+{
+  register_writes_skipped++;
+  return XCC_I_OK;
+}
+
+
+// Apply the settings a sequence needs in one call: every write that would change something is sent,
+// then (only if the integration time or command word changed) a single pair of dummy frames flushes
+// frames taken with the old settings, instead of one pair per setting.  Returns the OR of the write
+// errors, or -1 if nothing needed writing.
+int apply_settings(unsigned long iTime, int gain, int fan, int pwm)
+{
+  XCCERROR xcc_ret = XCC_I_OK;
+  bool flush = false;
+  bool wrote = false;
+  if(!camera_is_open())
+    return(XCC_E);
+  if(!register_cache_valid || (*hnd).cur_gain != (gain ? 1:0))
+    {
+      (*hnd).cur_gain = (gain ? 1:0);
+      (*hnd).curFan = (fan ? 1:0);
+      xcc_ret |= write_commandword(false);  // also sends the fan
+      flush = wrote = true;
+    }
+  else if((*hnd).curFan != (fan ? 1:0))
+    {
+      xcc_ret |= _set_fan(fan);
+      wrote = true;
+    }
+  if(!register_cache_valid || (*hnd).curIntegrationTimeMillisec != (int)iTime)
+    {
+      xcc_ret |= _set_integration_time_millisec(iTime);
+      flush = wrote = true;
+    }
+  if(!register_cache_valid || (*hnd).curPWM != limit_pwm(pwm))
+    {
+      xcc_ret |= _set_pwm(pwm);
+      wrote = true;
+    }
+  if(flush)
+    take_dummy_frame();
+  if(!wrote)
+    {
+      register_writes_skipped++;
+      return -1;
+    }
+  register_cache_valid = (xcc_ret == XCC_I_OK);
+  return (int)xcc_ret;
+}
+
+// Start a new integration ramp in nondestructive mode, by pulsing the reset bit of the 9808 command
+// word.  No dummy frames: the next frame read is the first read of the new ramp.
+int reset_detector()
+{
+  XCCERROR xcc_ret;
+  if(!camera_is_open())
+    return(XCC_E);
+  (*hnd).cur_reset = 1;
+  xcc_ret = write_commandword(false);
+  (*hnd).cur_reset = 0;
+  xcc_ret |= write_commandword(false);
   return (int)xcc_ret;
+}
+
+// HEREIAM adding to xenics.i
+
+XCCERROR set_gain(int gain)
+{
+  if(!camera_is_open())
+    return(XCC_E);
+  if(register_cache_valid && (*hnd).cur_gain == (gain ? 1:0))
+    return skip_commandword();
+  (*hnd).cur_gain = (gain ? 1:0);
+  return write_commandword(true);
 } 
 
 
 XCCERROR set_nondestructive(int nondestructive)
 {
-  XCCERROR xcc_ret;
+  if(!camera_is_open())
+    return(XCC_E);
+  if(register_cache_valid && (*hnd).cur_nondestructive == (nondestructive ? 1:0))
+    return skip_commandword();
   (*hnd).cur_nondestructive = (nondestructive ? 1:0);
-  xcc_ret = set_commandword9808();
-  take_dummy_frame();
-  return (int)xcc_ret;
+  return write_commandword(true);
 } 
 
 XCCERROR set_xinv(int xinv)
 {
-  XCCERROR xcc_ret;
+  if(!camera_is_open())
+    return(XCC_E);
+  if(register_cache_valid && (*hnd).cur_xinv == (xinv ? 1:0))
+    return skip_commandword();
   (*hnd).cur_xinv = (xinv ? 1:0);
-  xcc_ret = set_commandword9808();
-  take_dummy_frame();
-  return (int)xcc_ret;
+  return write_commandword(true);
 } 
 
 XCCERROR set_yinv(int yinv)
 {
-  XCCERROR xcc_ret;
+  if(!camera_is_open())
+    return(XCC_E);
+  if(register_cache_valid && (*hnd).cur_yinv == (yinv ? 1:0))
+    return skip_commandword();
   (*hnd).cur_yinv = (yinv ? 1:0);
-  xcc_ret = set_commandword9808();
-  take_dummy_frame();
-  return (int)xcc_ret;
+  return write_commandword(true);
 } 
 
 XCCERROR set_linerepeat(int linerepeat)
 {
-  XCCERROR xcc_ret;
+  if(!camera_is_open())
+    return(XCC_E);
+  if(register_cache_valid && (*hnd).cur_linerepeat == (linerepeat ? 1:0))
+    return skip_commandword();
   (*hnd).cur_linerepeat = (linerepeat ? 1:0);
-  xcc_ret = set_commandword9808();
-  take_dummy_frame();
-  return (int)xcc_ret;
+  return write_commandword(true);
 } 
 
 XCCERROR set_refout(int refout)
 {
-  XCCERROR xcc_ret;
+  if(!camera_is_open())
+    return(XCC_E);
+  if(register_cache_valid && (*hnd).cur_refout == (refout ? 1:0))
+    return skip_commandword();
   (*hnd).cur_refout = (refout ? 1:0);
-  xcc_ret = set_commandword9808();
-  take_dummy_frame();
-  return (int)xcc_ret;
+  return write_commandword(true);
 } 
 
 XCCERROR set_reset(int reset)
 {
-  XCCERROR xcc_ret;
+  if(!camera_is_open())
+    return(XCC_E);
+  if(register_cache_valid && (*hnd).cur_reset == (reset ? 1:0))
+    return skip_commandword();
   (*hnd).cur_reset = (reset ? 1:0);
-  xcc_ret = set_commandword9808();
-  take_dummy_frame();
-  return (int)xcc_ret;
+  return write_commandword(true);
 } 
 
 XCCERROR set_skim(int skim)
 {
-  XCCERROR xcc_ret;
+  if(!camera_is_open())
+    return(XCC_E);
+  if(register_cache_valid && (*hnd).cur_skim == (skim ? 1:0))
+    return skip_commandword();
   (*hnd).cur_skim = (skim ? 1:0);
-  xcc_ret = set_commandword9808();
-  take_dummy_frame();
-  return (int)xcc_ret;
+  return write_commandword(true);
 } 
 
 XCCERROR set_power(int power)
 {
-  XCCERROR xcc_ret;
+  if(!camera_is_open())
+    return(XCC_E);
+  if(register_cache_valid && (*hnd).cur_power == (power ? 1:0))
+    return skip_commandword();
   (*hnd).cur_power = (power ? 1:0);
-  xcc_ret = set_commandword9808();
-  take_dummy_frame();
-  return (int)xcc_ret;
+  return write_commandword(true);
 } 
 
 XCCERROR set_current(int current)
 {
-  XCCERROR xcc_ret;
+  if(!camera_is_open())
+    return(XCC_E);
+  if(register_cache_valid && (*hnd).cur_current == (current ? 1:0))
+    return skip_commandword();
   (*hnd).cur_current = (current ? 1:0);
-  xcc_ret = set_commandword9808();
-  take_dummy_frame();
-  return (int)xcc_ret;
+  return write_commandword(true);
 } 
 
 XCCERROR set_bias(int bias)
 {
-  XCCERROR xcc_ret;
+  if(!camera_is_open())
+    return(XCC_E);
+  if(register_cache_valid && (*hnd).cur_bias == (bias ? 1:0))
+    return skip_commandword();
   (*hnd).cur_bias = (bias ? 1:0);
-  xcc_ret = set_commandword9808();
-  take_dummy_frame();
-  return (int)xcc_ret;
+  return write_commandword(true);
 } 
 
 XCCERROR set_bandwidth(int bandwidth)
 {
-  XCCERROR xcc_ret;
+  if(!camera_is_open())
+    return(XCC_E);
+  if(register_cache_valid && (*hnd).cur_bandwidth == (bandwidth ? 1:0))
+    return skip_commandword();
   (*hnd).cur_bandwidth = (bandwidth ? 1:0);
-  xcc_ret = set_commandword9808();
-  take_dummy_frame();
-  return (int)xcc_ret;
+  return write_commandword(true);
 } 
 
 XCCERROR set_outputfactor(int outputfactor)
 {
-  XCCERROR xcc_ret;
+  if(!camera_is_open())
+    return(XCC_E);
+  if(register_cache_valid && (*hnd).cur_outputfactor == (outputfactor ? 1:0))
+    return skip_commandword();
   (*hnd).cur_outputfactor = (outputfactor ? 1:0);
-  xcc_ret = set_commandword9808();
-  take_dummy_frame();
-  return (int)xcc_ret;
+  return write_commandword(true);
 } 
 
 XCCERROR set_itr(int itr)
 {
-  XCCERROR xcc_ret;
+  if(!camera_is_open())
+    return(XCC_E);
+  if(register_cache_valid && (*hnd).cur_itr == (itr ? 1:0))
+    return skip_commandword();
   (*hnd).cur_itr = (itr ? 1:0);
-  xcc_ret = set_commandword9808();
-  take_dummy_frame();
-  return (int)xcc_ret;
+  return write_commandword(true);
 } 
 
 XCCERROR set_multiplereadouts(int multiplereadouts)
 {
-  XCCERROR xcc_ret;
+  if(!camera_is_open())
+    return(XCC_E);
+  if(register_cache_valid && (*hnd).cur_multiplereadouts == (multiplereadouts ? 1:0))
+    return skip_commandword();
   (*hnd).cur_multiplereadouts = (multiplereadouts ? 1:0);
-  xcc_ret = set_commandword9808();
-  take_dummy_frame();
-  return (int)xcc_ret;
+  return write_commandword(true);
 } 
 
-int get_gain() { return (*hnd).cur_gain; }
-int get_nondestructive() { return (*hnd).cur_nondestructive; }
-int get_xinv() { return (*hnd).cur_xinv; }
-int get_yinv() { return (*hnd).cur_yinv; }
-int get_linerepeat() { return (*hnd).cur_linerepeat; }
-int get_refout() { return (*hnd).cur_refout; }
-int get_reset() { return (*hnd).cur_reset; }
-int get_skim() { return (*hnd).cur_skim; }
-int get_power() { return (*hnd).cur_power; }
-int get_current() { return (*hnd).cur_current; }
-int get_bias() { return (*hnd).cur_bias; }
-int get_bandwidth() { return (*hnd).cur_bandwidth; }
-int get_outputfactor() { return (*hnd).cur_outputfactor; }
-int get_itr() { return (*hnd).cur_itr; }
-int get_multiplereadouts() { return (*hnd).cur_multiplereadouts; }
+int get_gain() { return camera_is_open() ? (*hnd).cur_gain : -1; }
+int get_nondestructive() { return camera_is_open() ? (*hnd).cur_nondestructive : -1; }
+int get_xinv() { return camera_is_open() ? (*hnd).cur_xinv : -1; }
+int get_yinv() { return camera_is_open() ? (*hnd).cur_yinv : -1; }
+int get_linerepeat() { return camera_is_open() ? (*hnd).cur_linerepeat : -1; }
+int get_refout() { return camera_is_open() ? (*hnd).cur_refout : -1; }
+int get_reset() { return camera_is_open() ? (*hnd).cur_reset : -1; }
+int get_skim() { return camera_is_open() ? (*hnd).cur_skim : -1; }
+int get_power() { return camera_is_open() ? (*hnd).cur_power : -1; }
+int get_current() { return camera_is_open() ? (*hnd).cur_current : -1; }
+int get_bias() { return camera_is_open() ? (*hnd).cur_bias : -1; }
+int get_bandwidth() { return camera_is_open() ? (*hnd).cur_bandwidth : -1; }
+int get_outputfactor() { return camera_is_open() ? (*hnd).cur_outputfactor : -1; }
+int get_itr() { return camera_is_open() ? (*hnd).cur_itr : -1; }
+int get_multiplereadouts() { return camera_is_open() ? (*hnd).cur_multiplereadouts : -1; }
 
 void set_9808_params_to_default()
 {
@@ -947,8 +1314,11 @@ void set_9808_params_to_default()
 
 int open_camera()
 {
-  hnd = (XCCHANDLE_I *) malloc( sizeof(XCCHANDLE_I) );
+  // kept across failed attempts, so open_camera can be polled until the camera shows up on USB
+  if(hnd == NULL)
+    hnd = (XCCHANDLE_I *) calloc(1, sizeof(XCCHANDLE_I));  // m_hDevice NULL until found
   XCCERROR xcc_ret = XCC_I_OK;
+  register_cache_valid = 0;
   struct usb_bus *bus;
   int ret;
   struct usb_device *curdev,*camera_dev=NULL;
@@ -1012,7 +1382,9 @@ int open_camera()
   // TODO: need to do a lot of experimenting with SetCommandWord9808
   set_commandword9808();
   xcc_ret |= (XCCERRORs)set_fan(1);
-  xcc_ret |= set_WOI(0, 0, MAXWIDTH-1, MAXHEIGHT-1);
+  xcc_ret |= set_WOI(0, 0, MAXWIDTH-1, MAXHEIGHT-1, 1, 1);
+  frame_width = MAXWIDTH;
+  frame_height = MAXHEIGHT;
   // hroe:  only included case for our cameras
   // adjust the framerate if the window of interest is changed
   // consider 350 Hz as quickest frame rate
@@ -1021,13 +1393,21 @@ int open_camera()
   xcc_ret |= set_capture_mode();
   xcc_ret |= (XCCERRORs)set_pwm(0);
   take_dummy_frame();  
+  register_cache_valid = (xcc_ret == XCC_I_OK);
   return 0;
 }
 
 void close_camera()
 {
-  usb_release_interface((*hnd).m_hDevice, 0);
-  usb_close((*hnd).m_hDevice);
+  register_cache_valid = 0;
+  if(hnd == NULL)
+    return;
+  if((*hnd).m_hDevice != NULL)
+    {
+      usb_release_interface((*hnd).m_hDevice, 0);
+      usb_close((*hnd).m_hDevice);
+    }
   free(hnd);
+  hnd = NULL;
   return;
 }
@@ -1,8 +1,11 @@
-%module xenics
+%module(threads="1") xenics
 %{
 #define SWIG_FILE_WITH_INIT
 extern int get_max_width();
 extern int get_max_height();
+extern int get_frame_width();
+extern int get_frame_height();
+extern int set_window(int x0, int y0, int width, int height, int xinc, int yinc);
 extern int get_camera_found_on_usb();
 extern int get_image_capture_timeout();
 extern int get_command_timeout();
@@ -19,6 +22,19 @@ extern int get_pwm();
 extern int get_temperature_ADCtype();
 extern int get_temperature_ADU();
 extern void capture_frames(unsigned short *FrameBuffer, int n_pix);
+extern int capture_frames_abortable(unsigned short *FrameBuffer, int n_pix);
+extern int capture_coadd(int *Sum, int n_sum, double *SumSq, int n_sumsq,
+                         unsigned short *Min, int n_min, unsigned short *Max, int n_max, int n_frames,
+                         int accumulate);
+extern int get_coadd_frames_ok();
+extern void request_capture_abort();
+extern void clear_capture_abort();
+extern int get_capture_abort();
+extern int get_frames_ok_count();
+extern int get_usb_timeout_count();
+extern int get_usb_underrun_count();
+extern int get_usb_error_count();
+extern void reset_capture_counts();
 extern int open_camera();
 extern void close_camera();
 extern int get_fan();
@@ -56,6 +72,13 @@ extern int get_outputfactor();
 extern int get_itr();
 extern int get_multiplereadouts();
 extern void set_9808_params_to_default();
+extern int apply_settings(unsigned long iTime, int gain, int fan, int pwm);
+extern void invalidate_register_cache();
+extern int get_register_cache_valid();
+extern int get_register_writes_skipped();
+extern int get_dummy_frames_taken();
+extern int check_frame_read();
+extern int reset_detector();
 %}
 
 %include "numpy.i"
@@ -63,8 +86,18 @@ extern void set_9808_params_to_default();
     import_array();
 %}
 
+// Only the frame capture calls release the GIL; everything else is a short register access
+// and is left holding the GIL.
+%nothread;
+%thread capture_frames;
+%thread capture_frames_abortable;
+%thread capture_coadd;
+
 extern int get_max_width();
 extern int get_max_height();
+extern int get_frame_width();
+extern int get_frame_height();
+extern int set_window(int x0, int y0, int width, int height, int xinc, int yinc);
 extern int get_camera_found_on_usb();
 extern int get_image_capture_timeout();
 extern int get_command_timeout();
@@ -81,7 +114,24 @@ extern int get_pwm();
 extern int get_temperature_ADCtype();
 extern int get_temperature_ADU();
 %apply (unsigned short* INPLACE_ARRAY1, int DIM1) {(unsigned short* FrameBuffer, int n_pix)}
+%apply (int* INPLACE_ARRAY1, int DIM1) {(int* Sum, int n_sum)}
+%apply (double* INPLACE_ARRAY1, int DIM1) {(double* SumSq, int n_sumsq)}
+%apply (unsigned short* INPLACE_ARRAY1, int DIM1) {(unsigned short* Min, int n_min)}
+%apply (unsigned short* INPLACE_ARRAY1, int DIM1) {(unsigned short* Max, int n_max)}
 extern void capture_frames(unsigned short *FrameBuffer, int n_pix);
+extern int capture_frames_abortable(unsigned short *FrameBuffer, int n_pix);
+extern int capture_coadd(int *Sum, int n_sum, double *SumSq, int n_sumsq,
+                         unsigned short *Min, int n_min, unsigned short *Max, int n_max, int n_frames,
+                         int accumulate);
+extern int get_coadd_frames_ok();
+extern void request_capture_abort();
+extern void clear_capture_abort();
+extern int get_capture_abort();
+extern int get_frames_ok_count();
+extern int get_usb_timeout_count();
+extern int get_usb_underrun_count();
+extern int get_usb_error_count();
+extern void reset_capture_counts();
 extern int open_camera();
 extern void close_camera();
 extern int get_fan();
@@ -119,4 +169,11 @@ extern int get_outputfactor();
 extern int get_itr();
 extern int get_multiplereadouts();
 extern void set_9808_params_to_default();
+extern int apply_settings(unsigned long iTime, int gain, int fan, int pwm);
+extern void invalidate_register_cache();
+extern int get_register_cache_valid();
+extern int get_register_writes_skipped();
+extern int get_dummy_frames_taken();
+extern int check_frame_read();
+extern int reset_detector();
 
@@ -0,0 +1,22 @@
+import glob
+import os
+
+import pytest
+
+from nihts_xcam.simulated_xenics import simulated_camera
+
+
+@pytest.fixture
+def camera(tmp_path):
+    """A XenicsCamera on simulated hardware, producing frames as fast as it can, writing to tmp_path."""
+    camera = simulated_camera(obsdatadir=str(tmp_path), realtime=False, seed=1)
+    yield camera
+    camera.close_camera()
+
+
+@pytest.fixture
+def data_files():
+    """data_files(camera, pattern='*.fits') -> sorted paths of the files camera has written to today's data directory."""
+    def data_files(camera, pattern='*.fits'):
+        return sorted(glob.glob(os.path.join(camera._get_current_datadir(), pattern)))
+    return data_files
@@ -0,0 +1,122 @@
+import threading
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from nihts_xcam import cube_writer
+from nihts_xcam.simulated_xenics import simulated_camera
+
+
+def check_frames(camera, filenames, exptime, coadds, nexp):
+    assert len(filenames) == nexp
+    bias = camera._xenics.bias_adu
+    for cur_nexp, filename in enumerate(filenames, 1):
+        with fits.open(filename) as hdulist:
+            header = hdulist[0].header
+            data = hdulist[0].data
+            assert data.shape == (256, 320)
+            assert header['EXPTIME'] == exptime
+            assert header['COADDS'] == coadds
+            assert header['NEXP'] == nexp
+            assert header['CURNEXP'] == cur_nexp
+            assert header.get('COADDOK', coadds) == coadds
+            assert header['OBJECT'] == 'HD 12345'
+            # each coadd brings the bias, so the sum grows with coadds
+            assert abs(np.median(data) - coadds * bias) < 0.05 * coadds * bias
+
+
+@pytest.mark.parametrize('pipelined', [False, True])
+def test_go(camera, pipelined, data_files):
+    camera.target('HD 12345')
+    camera.go(0.01, 3, 4, pipelined=pipelined)
+    check_frames(camera, data_files(camera), 0.01, 3, 4)
+
+
+@pytest.mark.parametrize('coadd_mode', ['stack', 'stream'])
+def test_coadd_modes_agree(tmp_path, coadd_mode, data_files):
+    camera = simulated_camera(obsdatadir=str(tmp_path), realtime=False, seed=1, read_noise_adu=0.)
+    try:
+        camera.coadd_mode(coadd_mode)
+        camera.go(0.01, 5, 1)
+        with fits.open(data_files(camera)[0]) as hdulist:
+            data = hdulist[0].data
+    finally:
+        camera.close_camera()
+    # noiseless: 5 x (bias + dark + pattern), to within the uint16 rounding of each coadd
+    expected = 5 * (camera._xenics.bias_adu + 0.01 * (camera._xenics.dark_adu_per_sec +
+                                                       camera._xenics._pattern))
+    assert np.abs(data - expected).max() <= 5
+
+
+@pytest.mark.parametrize('pipelined', [False, True])
+def test_cube_output(camera, pipelined, data_files):
+    camera.target('HD 12345')
+    camera.output_mode('cube', chunk_frames=4)
+    camera.go(0.01, 2, 10, pipelined=pipelined)
+    filenames = data_files(camera)
+    assert len(filenames) == 3
+    curnexp = []
+    for filename, nframes in zip(filenames, [4, 4, 2]):
+        with fits.open(filename) as hdulist:
+            hdulist.verify('exception')
+            assert hdulist[0].header['NAXIS3'] == nframes
+            assert hdulist[0].data.shape == (nframes, 256, 320)
+            assert hdulist[0].header['COADDS'] == 2
+            assert hdulist[0].header['OBJECT'] == 'HD 12345'
+            frames = hdulist['FRAMES'].data
+            assert len(frames) == nframes
+            curnexp.extend(frames['CURNEXP'])
+    assert curnexp == list(range(1, 11))
+
+
+def test_cube_write_errors_raise(camera, monkeypatch):
+    def fail(*args, **kwargs):
+        raise IOError("disk full")
+    monkeypatch.setattr(cube_writer.fits, 'append', fail)
+    camera.output_mode('cube', chunk_frames=4)
+    with pytest.raises(IOError, match='could not finish 2 cube chunk'):
+        camera.go(0.01, 1, 5)
+
+
+def test_spool_output(camera, data_files):
+    camera.target('HD 12345')
+    camera.output_mode('spool')
+    camera.go(0.01, 3, 4)
+    camera._spool.wait()
+    check_frames(camera, data_files(camera), 0.01, 3, 4)
+    assert camera._spool.errors == []
+
+
+def test_abort_from_another_thread(camera, data_files):
+    timer = threading.Timer(0.2, camera.abort)
+    timer.start()
+    try:
+        camera.go(0.01, 1, -1, pipelined=True)
+    finally:
+        timer.cancel()
+    filenames = data_files(camera)
+    assert filenames
+    with fits.open(filenames[-1]) as hdulist:
+        assert hdulist[0].header['CURNEXP'] == len(filenames)
+
+
+@pytest.mark.parametrize('pipelined', [False, True])
+def test_capture_done_before_the_last_frame_is_written(camera, data_files, pipelined):
+    written = []
+    captured = threading.Event()
+    write_hdu = camera._write_hdu
+
+    def write_last_after_capture(hdulist, frame_info):
+        # the last frame's write can only finish once on_capture_done has been called
+        if frame_info['cur_nexp'] == 3:
+            assert captured.wait(5.)
+        write_hdu(hdulist, frame_info)
+
+    def capture_done():
+        written.append(len(data_files(camera)))
+        captured.set()
+    camera._write_hdu = write_last_after_capture
+    camera.go(0.01, 2, 3, pipelined=pipelined, on_capture_done=capture_done)
+    assert len(written) == 1 and written[0] < 3
+    assert len(data_files(camera)) == 3
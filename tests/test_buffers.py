@@ -0,0 +1,79 @@
+import mmap
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from nihts_xcam.buffers import FramePool, aligned_empty
+
+
+def test_aligned_empty():
+    for shape, dtype in [((3, 256, 320), np.uint16), ((256, 320), np.int32), ((7,), np.float64)]:
+        buf = aligned_empty(shape, dtype)
+        assert buf.shape == shape and buf.dtype == dtype
+        assert buf.ctypes.data % mmap.PAGESIZE == 0
+        assert buf.flags['C_CONTIGUOUS']
+
+
+def test_released_buffers_are_reused():
+    pool = FramePool()
+    a = pool.acquire((2, 4, 5), np.uint16)
+    b = pool.acquire((2, 4, 5), np.uint16)
+    assert a is not b
+    pool.release(a)
+    assert pool.acquire((2, 4, 5), np.uint16) is a
+    # a different geometry gets its own buffer
+    c = pool.acquire((4, 5), np.int32)
+    assert c.shape == (4, 5) and c.dtype == np.int32
+    assert pool.allocations == 3
+    assert pool.nbytes() == 2 * 2 * 4 * 5 * 2 + 4 * 5 * 4
+
+
+def test_limit_waits_for_a_release():
+    pool = FramePool()
+    a = pool.acquire((4, 5), np.int32, limit=1)
+    assert pool.acquire((4, 5), np.int32, limit=1, timeout=0.05) is None
+    threading.Timer(0.1, pool.release, [a]).start()
+    t0 = time.time()
+    assert pool.acquire((4, 5), np.int32, limit=1, timeout=5.) is a
+    assert time.time() - t0 >= 0.05
+    assert pool.allocations == 1
+
+
+def test_release_of_a_foreign_buffer():
+    pool = FramePool()
+    with pytest.raises(ValueError):
+        pool.release(np.zeros((4, 5), dtype=np.int32))
+
+
+def test_trim_frees_idle_buffers_of_other_geometries():
+    pool = FramePool()
+    kept = pool.acquire((4, 5), np.int32)
+    dropped = pool.acquire((2, 4, 5), np.uint16)
+    in_use = pool.acquire((2, 4, 5), np.uint16)
+    pool.release(kept)
+    pool.release(dropped)
+    pool.trim(keep=[((4, 5), np.int32)])
+    assert pool.nbytes() == 4 * 5 * 4 + 2 * 4 * 5 * 2
+    assert pool.acquire((4, 5), np.int32) is kept
+    assert pool.acquire((2, 4, 5), np.uint16) is not dropped
+    # a buffer handed out before the trim can still be released
+    pool.release(in_use)
+
+
+def test_go_reuses_buffers_between_sequences(camera):
+    camera.go(0.01, 3, 2)
+    pool = camera._frame_pool
+    # one stack and one sum image
+    assert pool.allocations == 2
+    camera.go(0.01, 3, 4)
+    assert pool.allocations == 2
+    camera.pipelined(True, depth=2)
+    camera.go(0.01, 3, 10)
+    # at most `depth` of each kind in flight
+    assert pool.allocations <= 4
+    assert pool.nbytes() <= 2 * (3 * 256 * 320 * 2 + 256 * 320 * 4)
+    # a different number of coadds needs new stacks, and the old ones are let go
+    camera.go(0.01, 5, 2)
+    assert pool.nbytes() <= 2 * (5 * 256 * 320 * 2 + 256 * 320 * 4)
@@ -0,0 +1,55 @@
+import calendar
+import os
+
+from nihts_xcam.filenames import FileNumberAllocator
+
+# 2026-03-04 23:59:58 UT
+BEFORE_MIDNIGHT = calendar.timegm((2026, 3, 4, 23, 59, 58, 0, 0, 0))
+
+
+def touch(path):
+    open(path, 'w').close()
+
+
+def test_numbers_continue_from_the_directory(tmp_path):
+    night = tmp_path / '2026-03-04'
+    night.mkdir()
+    for name in ['2026-03-04_0001.fits', '2026-03-04_0007.fits', '2026-03-04_0009.fits.fz', 'notes.txt',
+                 '2026-03-03_0050.fits']:
+        touch(str(night / name))
+    allocator = FileNumberAllocator(str(tmp_path))
+    filename = allocator.next_filename(now=BEFORE_MIDNIGHT)
+    assert filename == str(night / '2026-03-04_0010.fits')
+    # claimed, empty, for the caller to overwrite
+    assert os.path.getsize(filename) == 0
+    assert allocator.next_filename(now=BEFORE_MIDNIGHT) == str(night / '2026-03-04_0011.fits')
+
+
+def test_exclusive_create_skips_taken_numbers(tmp_path):
+    first = FileNumberAllocator(str(tmp_path))
+    second = FileNumberAllocator(str(tmp_path))
+    names = [first.next_filename(now=BEFORE_MIDNIGHT), second.next_filename(now=BEFORE_MIDNIGHT),
+             first.next_filename(now=BEFORE_MIDNIGHT), second.next_filename(now=BEFORE_MIDNIGHT)]
+    # the two allocators scanned the same empty directory, but never hand out the same name
+    assert len(set(names)) == 4
+    assert sorted(os.path.basename(name) for name in names) == [
+        '2026-03-04_{:04d}.fits'.format(n) for n in range(1, 5)]
+
+
+def test_compressed_chunk_numbers_are_skipped(tmp_path):
+    allocator = FileNumberAllocator(str(tmp_path))
+    first = allocator.next_filename(now=BEFORE_MIDNIGHT)
+    # e.g. another process compresses its chunk 0002 after this allocator scanned the directory
+    touch(first.replace('_0001.fits', '_0002.fits.fz'))
+    second = allocator.next_filename(now=BEFORE_MIDNIGHT)
+    assert os.path.basename(second) == '2026-03-04_0003.fits'
+    assert not os.path.exists(first.replace('_0001.fits', '_0002.fits'))
+
+
+def test_ut_date_rollover(tmp_path):
+    allocator = FileNumberAllocator(str(tmp_path))
+    assert os.path.basename(allocator.next_filename(now=BEFORE_MIDNIGHT)) == '2026-03-04_0001.fits'
+    assert os.path.basename(allocator.next_filename(now=BEFORE_MIDNIGHT + 1.9)) == '2026-03-04_0002.fits'
+    assert allocator.datadir(now=BEFORE_MIDNIGHT + 2.) == str(tmp_path / '2026-03-05')
+    assert os.path.isdir(str(tmp_path / '2026-03-05'))
+    assert os.path.basename(allocator.next_filename(now=BEFORE_MIDNIGHT + 3.)) == '2026-03-05_0001.fits'
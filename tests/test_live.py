@@ -0,0 +1,125 @@
+import os
+import threading
+import uuid
+
+import numpy as np
+import pytest
+
+from nihts_xcam.live import LiveFrameClient, LiveFramePublisher, default_directory
+from nihts_xcam.simulated_xenics import simulated_camera
+
+
+@pytest.fixture
+def publisher(tmp_path):
+    publisher = LiveFramePublisher((8, 10), np.int32, name='live', directory=str(tmp_path), nslots=3)
+    yield publisher
+    publisher.close()
+
+
+@pytest.fixture
+def client(publisher, tmp_path):
+    client = LiveFrameClient(name='live', directory=str(tmp_path))
+    yield client
+    client.close()
+
+
+def test_publish_and_read(publisher, client):
+    assert client.latest() is None
+    image = np.arange(80, dtype=np.int32).reshape(8, 10)
+    assert publisher.publish(image, {'CURNEXP': np.int64(3), 'OBJECT': 'HD 12345', 'NOT-LIVE': 1}) == 1
+    frame = client.latest()
+    assert frame.sequence == 1
+    np.testing.assert_array_equal(frame.data, image)
+    assert frame.header == {'CURNEXP': 3, 'OBJECT': 'HD 12345'}
+    # a copy, so not changed by later frames
+    for i in range(3):
+        publisher.publish(image + 1)
+    np.testing.assert_array_equal(frame.data, image)
+
+
+def test_wait_for_the_next_frame(publisher, client):
+    assert client.wait(timeout=0.01) is None
+    publisher.publish(np.zeros((8, 10)))
+    assert client.wait(timeout=1.).sequence == 1
+    assert client.wait(timeout=0.01) is None
+    threading.Timer(0.05, publisher.publish, [np.ones((8, 10))]).start()
+    frame = client.wait(timeout=5.)
+    assert frame.sequence == 2 and frame.data[0, 0] == 1
+
+
+def test_view_is_invalidated_when_its_slot_is_reused(publisher, client):
+    publisher.publish(np.zeros((8, 10)))
+    view = client.view()
+    assert view.is_valid()
+    # nslots - 1 more frames leave it alone, the next one overwrites it
+    publisher.publish(np.ones((8, 10)))
+    publisher.publish(np.ones((8, 10)))
+    assert view.is_valid() and view.data[0, 0] == 0
+    publisher.publish(np.ones((8, 10)))
+    assert not view.is_valid()
+
+
+def test_slot_being_written_is_not_read(publisher, client):
+    publisher.publish(np.zeros((8, 10)))
+    seq = publisher._mapped.slot_seq[1]
+    seq[0] = 1  # odd: the publisher is part way through writing it
+    assert client.latest() is None
+    seq[0] = 2
+    assert client.latest().sequence == 1
+
+
+def test_reader_never_sees_a_torn_frame(publisher, client):
+    nframes = 3000
+    done = threading.Event()
+
+    def write():
+        for sequence in range(1, nframes + 1):
+            publisher.publish(np.full((8, 10), sequence, dtype=np.int32), {'CURNEXP': sequence})
+        done.set()
+    writer = threading.Thread(target=write)
+    writer.start()
+    seen = 0
+    while not done.is_set():
+        frame = client.latest()
+        if frame is not None:
+            assert np.all(frame.data == frame.sequence)
+            assert frame.header['CURNEXP'] == frame.sequence
+            seen += 1
+    writer.join()
+    assert seen > 0
+    assert client.latest().sequence == nframes
+
+
+def test_file_is_reused_across_publishers(publisher, tmp_path):
+    publisher.publish(np.zeros((8, 10)))
+    publisher.publish(np.zeros((8, 10)))
+    again = LiveFramePublisher((8, 10), np.int32, name='live', directory=str(tmp_path), nslots=3)
+    try:
+        assert again.publish(np.zeros((8, 10))) == 3
+    finally:
+        again.close()
+    # a different layout starts afresh
+    other = LiveFramePublisher((4, 10), np.int32, name='live', directory=str(tmp_path), nslots=3)
+    try:
+        assert other.publish(np.zeros((4, 10))) == 1
+    finally:
+        other.close()
+
+
+def test_camera_publishes_each_frame(tmp_path):
+    name = 'xcam-live-test-{}'.format(uuid.uuid4().hex)
+    camera = simulated_camera(obsdatadir=str(tmp_path), realtime=False, seed=1, live_name=name)
+    try:
+        camera.target('HD 12345')
+        camera.go(0.01, 2, 3)
+        client = LiveFrameClient(name=name)
+        try:
+            frame = client.latest()
+        finally:
+            client.close()
+    finally:
+        camera.close_camera()
+        os.remove(os.path.join(default_directory(), name))
+    assert frame.sequence == 3
+    assert frame.data.shape == (256, 320)
+    assert frame.header['CURNEXP'] == 3 and frame.header['COADDS'] == 2 and frame.header['OBJECT'] == 'HD 12345'
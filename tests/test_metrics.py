@@ -0,0 +1,81 @@
+import json
+import os
+
+from nihts_xcam.metrics import AcquisitionMetrics, MetricsFileSink, MetricsHTTPServer
+from nihts_xcam.simulated_xenics import simulated_camera
+
+try:
+    from urllib.request import urlopen
+except ImportError:  # python 2
+    from urllib2 import urlopen
+
+
+def test_counters_gauges_and_frames():
+    metrics = AcquisitionMetrics(nframes_kept=3)
+    metrics.increment('frames_aborted')
+    metrics.increment('frames_aborted', 2)
+    metrics.set_counter('usb_timeouts', 7)
+    metrics.set_counter('usb_timeouts', 9)
+    metrics.set_gauge('queue_depth', 2)
+    for cur_nexp in range(1, 6):
+        metrics.record_frame({'cur_nexp': cur_nexp, 'timings': {'capture': 0.5, 'write': 0.25}})
+    snapshot = metrics.snapshot()
+    assert snapshot['counters'] == {'frames_aborted': 3, 'usb_timeouts': 9, 'frames_written': 5}
+    assert snapshot['gauges']['queue_depth'] == 2
+    assert 'last_frame_time' in snapshot['gauges']
+    # only the most recent frames are kept
+    assert [frame['cur_nexp'] for frame in metrics.frames()] == [3, 4, 5]
+
+
+def test_prometheus_text():
+    metrics = AcquisitionMetrics()
+    metrics.set_counter('usb_errors', 4)
+    metrics.set_gauge('spool_pending', 12)
+    metrics.set_gauge('note', 'not a number')
+    metrics.set_gauge('fan', True)
+    metrics.record_frame({'timings': {'capture': 0.5, 'write': 0.25}})
+    lines = metrics.to_prometheus().splitlines()
+    assert '# TYPE xcam_usb_errors counter' in lines
+    assert 'xcam_usb_errors 4' in lines
+    assert 'xcam_spool_pending 12' in lines
+    assert 'xcam_frames_written 1' in lines
+    assert 'xcam_last_frame_seconds{stage="capture"} 0.5' in lines
+    # only numeric gauges are exported
+    assert not [line for line in lines if 'note' in line or 'fan' in line]
+
+
+def test_file_sink_and_http_server(tmp_path):
+    metrics = AcquisitionMetrics()
+    metrics.set_counter('usb_timeouts', 2)
+    path = str(tmp_path / 'metrics.json')
+    sink = MetricsFileSink(metrics, path, interval_sec=60.)
+    try:
+        sink.write()
+    finally:
+        sink.stop()
+    with open(path) as f:
+        assert json.load(f)['counters'] == {'usb_timeouts': 2}
+    assert not os.path.exists(path + '.tmp')
+    server = MetricsHTTPServer(metrics, port=0)
+    try:
+        url = 'http://127.0.0.1:{}'.format(server.port)
+        assert json.loads(urlopen(url + '/metrics.json').read().decode('utf-8'))['counters'] == {'usb_timeouts': 2}
+        assert 'xcam_usb_timeouts 2' in urlopen(url + '/metrics').read().decode('utf-8')
+    finally:
+        server.stop()
+
+
+def test_go_counts_capture_reads(tmp_path):
+    camera = simulated_camera(obsdatadir=str(tmp_path), realtime=False, seed=3, drop_probability=0.3)
+    try:
+        camera.go(0.01, 4, 5)
+        counters = camera.metrics.snapshot()['counters']
+    finally:
+        camera.close_camera()
+    assert counters['frames_written'] == 5
+    # 20 coadd reads, each either read or dropped; start-up and dummy frames aren't counted
+    assert counters['frames_read'] + counters['frames_dropped'] == 20
+    assert counters['frames_dropped'] == counters['usb_timeouts'] > 0
+    frames = camera.metrics.frames()
+    assert len(frames) == 5
+    assert set(['capture', 'coadd', 'header', 'write']) <= set(frames[-1]['timings'])
@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from nihts_xcam.quicklook import CalibrationLibrary, QuickLook, Region, header_cards, FWHM_PER_SIGMA
+
+
+def star_frame(y, x, sigma=1.5, flux=20000., background=100., shape=(64, 80)):
+    yy, xx = np.mgrid[0:shape[0], 0:shape[1]]
+    star = np.exp(-((yy - y) ** 2 + (xx - x) ** 2) / (2. * sigma ** 2))
+    return (background + flux * star / star.sum()).astype(np.float32)
+
+
+def test_star_centroid_fwhm_and_flux():
+    ql = QuickLook(regions=[Region.around('star', 30, 40, half_size=12), Region.around('sky', 10, 10, half_size=5)])
+    results = ql.measure(star_frame(30.3, 39.6), 1., False, 1, cur_nexp=4, end_time=0.)
+    assert results['cur_nexp'] == 4 and not results['calibrated']
+    star = results['regions']['star']
+    assert star['background'] == pytest.approx(100., abs=0.1)
+    assert star['x'] == pytest.approx(39.6, abs=0.05)
+    assert star['y'] == pytest.approx(30.3, abs=0.05)
+    assert star['fwhm'] == pytest.approx(1.5 * FWHM_PER_SIGMA, rel=0.1)
+    assert star['flux'] == pytest.approx(20000., rel=0.02)
+    # nothing above the noise of a flat patch of sky
+    assert results['regions']['sky']['x'] is None
+    assert list(results['regions']) == ['star', 'sky']
+
+
+def test_calibration():
+    calibrations = CalibrationLibrary()
+    dark = np.full((64, 80), 30., dtype=np.float32)
+    flat = np.full((64, 80), 2., dtype=np.float32)
+    bad = np.zeros((64, 80), dtype=bool)
+    bad[30, 45] = True
+    calibrations.add(0.5, True, dark=dark)
+    # a flat and bad pixel mask for every exptime at this gain
+    calibrations.add(None, True, flat=flat, bad_pixels=bad)
+    ql = QuickLook(calibrations, regions=[Region.around('star', 30, 40, half_size=12)])
+    image = 2. * star_frame(30., 40.) + 4 * dark
+    image[30, 45] = 60000.  # a hot pixel, masked
+    results = ql.measure(image, 0.5, True, 4)
+    assert results['calibrated']
+    star = results['regions']['star']
+    assert star['background'] == pytest.approx(100., abs=0.1)
+    assert star['x'] == pytest.approx(40., abs=0.05)
+    assert star['flux'] == pytest.approx(20000., rel=0.02)
+    # no dark at other exptimes, and nothing at all at the other gain
+    assert ql.measure(image, 1., True, 4)['regions']['star']['background'] == pytest.approx(160., abs=0.1)
+    assert not ql.measure(image, 0.5, False, 4)['calibrated']
+    dark_sum, inv_flat, calibrated = calibrations.get(0.5, True, 4, (64, 80))
+    assert calibrations.get(0.5, True, 4, (64, 80))[0] is dark_sum
+    assert inv_flat[30, 45] == 0. and inv_flat[0, 0] == 0.5
+
+
+def test_windowed_positions_stay_full_frame():
+    full = star_frame(30.3, 39.6)
+    region = Region.around('star', 30, 40, half_size=12)
+    window = (20, 10, 40, 40, 1, 1)
+    cut = full[10:50, 20:60]
+    star = QuickLook(regions=[region]).measure(cut, 1., False, 1, window=window)['regions']['star']
+    assert star['x'] == pytest.approx(39.6, abs=0.05) and star['y'] == pytest.approx(30.3, abs=0.05)
+    # with every 2nd column read out the centroid is still in full-frame pixels
+    window = (20, 10, 40, 40, 2, 1)
+    star = QuickLook(regions=[region]).measure(full[10:50, 20:60:2], 1., False, 1,
+                                               window=window)['regions']['star']
+    assert star['x'] == pytest.approx(39.6, abs=0.3)
+    # a region outside the window isn't measured
+    results = QuickLook(regions=[Region.around('off', 5, 5, half_size=4)]).measure(cut, 1., False, 1, window=window)
+    assert results['regions']['off'] is None
+
+
+def test_results_queue_drops_the_oldest():
+    ql = QuickLook(regions=[Region.around('star', 30, 40)], maxsize=2)
+    for cur_nexp in range(1, 5):
+        ql.measure(star_frame(30., 40.), 1., False, 1, cur_nexp=cur_nexp)
+    assert [ql.results.get_nowait()['cur_nexp'] for i in range(2)] == [3, 4]
+
+
+def test_header_cards_make_a_valid_header():
+    ql = QuickLook(regions=[Region.around('star', 30, 40), Region.around('sky', 10, 10, half_size=5)])
+    header = fits.Header()
+    header.extend([fits.Card(*card) for card in header_cards(ql.measure(star_frame(30., 40.), 1., False, 1))])
+    fits.PrimaryHDU(header=header).verify('exception')
+    assert header['QL1NAME'] == 'star' and header['QL1X'] == pytest.approx(40., abs=0.05)
+    assert header['QL2NAME'] == 'sky' and 'QL2X' not in header
+
+
+def test_camera_quicklook_headers(camera, data_files):
+    camera.quicklook(True, regions=[('star', 128, 160, 10)])
+    camera.go(0.1, 2, 2)
+    header = fits.getheader(data_files(camera)[-1])
+    # the simulated star is a 5x5 box centred on (128, 160)
+    assert header['QL1X'] == pytest.approx(160., abs=0.1)
+    assert header['QL1Y'] == pytest.approx(128., abs=0.1)
+    assert [camera.quicklook_results.get_nowait()['cur_nexp'] for i in range(2)] == [1, 2]
@@ -0,0 +1,145 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+import nihts_xcam.nihts_xcam
+import nihts_xcam.simulated_xenics
+from nihts_xcam.ramp import RampAccumulator, SATURATED, JUMP, NO_FIT, READ_FAILED
+from nihts_xcam.simulated_xenics import simulated_camera
+
+
+def ramp_reads(rate, nreads, dt_sec, bias=1000., read_noise=0., seed=1):
+    """Reads of a ramp: bias + rate * t, t = dt_sec, 2 dt_sec, ..., with gaussian read noise."""
+    rng = np.random.RandomState(seed)
+    rate = np.asarray(rate, dtype=float)
+    for j in range(1, nreads + 1):
+        read = bias + rate * j * dt_sec
+        if read_noise:
+            read += rng.normal(0., read_noise, rate.shape)
+        yield read
+
+
+def fit(reads, shape, dt_sec, **kwargs):
+    ramp = RampAccumulator(shape, dt_sec, **kwargs)
+    for read in reads:
+        ramp.add(read)
+    return ramp.finish()
+
+
+def test_noiseless_slope():
+    rate = np.linspace(0., 500., 20).reshape(4, 5)
+    r, v, dq = fit(ramp_reads(rate, 20, 0.5), rate.shape, 0.5)
+    assert r.dtype == np.float32 and v.dtype == np.float32 and dq.dtype == np.uint8
+    np.testing.assert_allclose(r, rate, atol=1e-3)
+    assert np.all(v > 0)
+    assert not dq.any()
+
+
+def test_noisy_slope_and_variance():
+    rate = np.full((100, 100), 200.)
+    # large e_per_adu: no poisson noise in the reads, so none in the predicted variance either
+    r, v, dq = fit(ramp_reads(rate, 30, 0.2, read_noise=15.), rate.shape, 0.2, read_noise_adu=15.,
+                   e_per_adu=1e6)
+    assert abs(r.mean() - 200.) < 3 * r.std() / 100.
+    assert r.std() == pytest.approx(np.sqrt(np.median(v)), rel=0.05)
+    # with a 6 sigma threshold, hardly any false jumps
+    assert ((dq & JUMP) > 0).sum() < 5
+
+
+def test_jump_is_flagged_and_excluded():
+    rate = np.full((10, 10), 100.)
+    reads = list(ramp_reads(rate, 20, 0.5, read_noise=5., seed=2))
+    for read in reads[10:]:
+        read[3, 4] += 3000.  # a cosmic ray hit before read 11
+    r, v, dq = fit(reads, rate.shape, 0.5, read_noise_adu=5.)
+    assert dq[3, 4] & JUMP
+    assert ((dq & JUMP) > 0).sum() == 1
+    assert r[3, 4] == pytest.approx(100., abs=5 * np.sqrt(v[3, 4]))
+
+
+def test_saturated_reads_are_dropped():
+    rate = np.full((4, 4), 100.)
+    rate[1, 2] = 10000.  # reaches 60000 ADU at read 12 of 20
+    r, v, dq = fit(ramp_reads(rate, 20, 0.5), rate.shape, 0.5, saturation_adu=60000.)
+    assert dq[1, 2] & SATURATED
+    assert ((dq & SATURATED) > 0).sum() == 1
+    assert r[1, 2] == pytest.approx(10000., rel=1e-4)
+    np.testing.assert_allclose(np.delete(r.ravel(), 1 * 4 + 2), 100., atol=1e-3)
+
+
+def test_failed_read_splits_the_ramp():
+    rate = np.full((4, 4), 100.)
+    ramp = RampAccumulator(rate.shape, 0.5)
+    for j, read in enumerate(ramp_reads(rate, 20, 0.5)):
+        ramp.add(np.zeros_like(read) if j == 7 else read, ok=j != 7)
+    r, v, dq = ramp.finish()
+    assert ramp.nreads == 20 and ramp.nreads_ok == 19
+    assert np.all(dq & READ_FAILED)
+    np.testing.assert_allclose(r, 100., atol=1e-3)
+
+
+def test_too_few_reads():
+    ramp = RampAccumulator((2, 2), 0.5)
+    ramp.add(np.full((2, 2), 1000.))
+    r, v, dq = ramp.finish()
+    assert np.all(np.isnan(r)) and np.all(np.isnan(v))
+    assert np.all(dq & NO_FIT)
+
+
+def test_finish_with_measured_dt():
+    rate = np.full((4, 4), 100.)
+    ramp = RampAccumulator(rate.shape, 0.5)
+    for read in ramp_reads(rate, 10, 0.5):
+        ramp.add(read)
+    r, v, dq = ramp.finish(dt_sec=1.)
+    r2, v2, dq2 = fit(ramp_reads(rate, 10, 0.5), rate.shape, 0.5)
+    np.testing.assert_allclose(r, r2 / 2., rtol=1e-6)
+    np.testing.assert_allclose(v, v2 / 4., rtol=1e-6)
+
+
+class ModelledClock(object):
+    """
+    Stands in for the time module: time() only moves on when something sleep()s, so the simulator's
+    frame periods (and so the ramp's read times) are exact instead of at the mercy of the wall clock.
+    """
+    def __init__(self):
+        self._now = time.time()
+        self._lock = threading.Lock()
+
+    def time(self):
+        with self._lock:
+            return self._now
+
+    def sleep(self, sec):
+        with self._lock:
+            self._now += max(sec, 0.)
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+def test_ramp_go_measures_read_spacing(tmp_path, data_files, monkeypatch):
+    # no register latency, so the temperature monitor's reads don't move the clock between frames
+    camera = simulated_camera(obsdatadir=str(tmp_path), seed=1, readout_sec=0.005, register_read_sec=0.)
+    try:
+        clock = ModelledClock()
+        monkeypatch.setattr(nihts_xcam.nihts_xcam, 'time', clock)
+        monkeypatch.setattr(nihts_xcam.simulated_xenics, 'time', clock)
+        camera.coadd_mode('ramp')
+        camera.go(0.02, 10, 1)
+        with fits.open(data_files(camera)[0]) as hdulist:
+            header = hdulist[0].header
+            rate = hdulist[0].data
+            assert [hdu.name for hdu in hdulist] == ['PRIMARY', 'VARIANCE', 'DQ']
+    finally:
+        monkeypatch.undo()
+        camera.close_camera()
+    assert header['RAMPREAD'] == 10
+    # one frame period (integration plus readout) between reads, not the integration time
+    assert header['RAMPDT'] == pytest.approx(0.025, rel=1e-5)
+    assert header['RAMPTIME'] == pytest.approx(10 * 0.025, rel=1e-5)
+    # the simulated star adds 2000 ADU/s to a 5x5 box on top of the dark current
+    assert rate[126:131, 158:163].mean() - np.median(rate) == pytest.approx(2000., rel=0.01)
@@ -0,0 +1,116 @@
+import time
+
+import pytest
+from astropy.io import fits
+
+from nihts_xcam.scheduler import SequenceScheduler
+
+command_server = pytest.importorskip('nihts_xcam.command_server')  # python 3 only
+CommandServer = command_server.CommandServer
+send_command = command_server.send_command
+
+
+@pytest.fixture
+def server(camera):
+    scheduler = SequenceScheduler(camera)
+    server = CommandServer(scheduler, port=0)
+    yield server
+    server.stop()
+    scheduler.stop()
+
+
+def command(server, cmd, **fields):
+    fields['cmd'] = cmd
+    return send_command(fields, port=server.port)
+
+
+def wait_for(condition, timeout=20.):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def finished_states(server):
+    return [(spec['id'], spec['state']) for spec in command(server, 'status')['finished']]
+
+
+def test_submit_runs_sequences_in_order(server, camera, data_files):
+    response = command(server, 'submit', sequences=[{'exptime': 0.01, 'nexp': 2, 'target': 'first'},
+                                                    {'exptime': 0.02, 'coadds': 2, 'nexp': 3, 'target': 'second'}])
+    assert response['ok'] and response['ids'] == [1, 2]
+    assert command(server, 'submit', exptime=0.01, nexp=1, output='cube')['ids'] == [3]
+    assert server.scheduler.wait(30.)
+    assert finished_states(server) == [(1, 'done'), (2, 'done'), (3, 'done')]
+    headers = []
+    for filename in data_files(camera):
+        with fits.open(filename) as hdulist:
+            headers.append(hdulist[0].header)
+    assert [(h['OBJECT'], h['EXPTIME'], h['COADDS'], h['CURNEXP']) for h in headers] == [
+        ('first', 0.01, 1, 1), ('first', 0.01, 1, 2),
+        ('second', 0.02, 2, 1), ('second', 0.02, 2, 2), ('second', 0.02, 2, 3),
+        ('second', 0.01, 1, 1)]
+    assert headers[-1]['NAXIS'] == 3
+
+
+def test_pause_resume_and_remove(server, camera, data_files):
+    assert command(server, 'pause')['ok']
+    ids = command(server, 'submit', sequences=[{'exptime': 0.01}, {'exptime': 0.01}, {'exptime': 0.01}])['ids']
+    time.sleep(0.2)
+    status = command(server, 'status')
+    assert status['state'] == 'paused'
+    assert [spec['state'] for spec in status['queue']] == ['queued'] * 3
+    assert data_files(camera) == []
+    assert command(server, 'remove', id=ids[1])['removed'] is True
+    assert command(server, 'remove', id=ids[1])['removed'] is False
+    assert command(server, 'resume')['ok']
+    assert server.scheduler.wait(30.)
+    assert finished_states(server) == [(ids[1], 'dropped'), (ids[0], 'done'), (ids[2], 'done')]
+    assert len(data_files(camera)) == 2
+
+
+def test_abort_and_clear(server, camera, data_files):
+    ids = command(server, 'submit', sequences=[{'exptime': 0.01, 'nexp': -1}, {'exptime': 0.01}])['ids']
+    wait_for(lambda: len(data_files(camera)) >= 2)
+    response = command(server, 'abort', clear=True)
+    assert response['ok'] and response['ids'] == ids
+    assert server.scheduler.wait(30.)
+    assert sorted(finished_states(server)) == [(ids[0], 'aborted'), (ids[1], 'dropped')]
+    assert command(server, 'status')['state'] == 'idle'
+
+
+def test_abort_before_go_starts_is_not_lost(server, camera, data_files):
+    scheduler = server.scheduler
+    configure = camera.configure
+
+    def abort_while_configuring(*args, **kwargs):
+        # lands after the scheduler's own check for an abort, just before go()
+        result = configure(*args, **kwargs)
+        if not getattr(camera, 'aborted_once', False):
+            camera.aborted_once = True
+            scheduler.abort()
+        return result
+    camera.configure = abort_while_configuring
+    ids = command(server, 'submit', sequences=[{'exptime': 0.01, 'nexp': 5}, {'exptime': 0.01, 'nexp': 2}])['ids']
+    assert scheduler.wait(30.)
+    assert finished_states(server) == [(ids[0], 'aborted'), (ids[1], 'done')]
+    assert len(data_files(camera)) == 2
+
+
+def test_failed_sequence_pauses_the_queue(server, camera):
+    camera.coadd_mode('stream', stats=['variance'])
+    ids = command(server, 'submit', sequences=[{'exptime': 0.01, 'output': 'cube'}, {'exptime': 0.01}])['ids']
+    wait_for(lambda: finished_states(server))
+    status = command(server, 'status')
+    assert status['finished'][0]['state'] == 'failed'
+    assert 'ValueError' in status['finished'][0]['error']
+    assert status['paused'] and [spec['id'] for spec in status['queue']] == [ids[1]]
+
+
+def test_bad_requests(server):
+    assert command(server, 'launch') == {'ok': False, 'error': "unknown command 'launch'"}
+    response = command(server, 'submit', exptime=-1.)
+    assert not response['ok'] and 'exptime' in response['error']
+    response = command(server, 'submit', exptime=1., colour='red')
+    assert not response['ok'] and 'colour' in response['error']
+    assert command(server, 'status')['queue'] == []
@@ -0,0 +1,58 @@
+import pytest
+
+XCC_E = -2 ** 31  # the driver's error bit (1 << 31), as the C int python sees
+XCC_E_TIMEOUT = 1 << 0
+
+
+def writes(camera):
+    backend = camera._xenics
+    return backend.register_writes, backend.dummy_frames_taken
+
+
+def test_unchanged_settings_write_nothing(camera):
+    camera.go(0.01, 1, 1)
+    before = writes(camera)
+    camera.go(0.01, 1, 2)
+    camera.configure(0.01, camera.get_gain())
+    camera.set_pwm(camera.get_pwm())
+    assert writes(camera) == before
+    assert camera.metrics.snapshot()['counters']['settings_unchanged'] >= 3
+
+
+def test_only_changed_settings_are_written(camera):
+    camera.go(0.01, 1, 1)
+    registers, dummies = writes(camera)
+    # the integration time needs flushing with a pair of dummy frames
+    assert camera.exptime(0.02) == 0.02
+    assert writes(camera) == (registers + 1, dummies + 2)
+    # the PWM doesn't
+    camera.set_pwm(2000)
+    assert writes(camera) == (registers + 2, dummies + 2)
+    # gain is sent with the fan state after it
+    camera.set_gain(not camera.get_gain())
+    assert writes(camera) == (registers + 4, dummies + 4)
+    assert camera._xenics.pwm == 2000 and camera._xenics.integration_time_millisec == 20
+
+
+def test_resync_writes_everything(camera):
+    registers, dummies = writes(camera)
+    camera.resync()
+    assert writes(camera)[0] == registers + 4
+    assert camera._xenics.get_register_cache_valid()
+
+
+def test_driver_error_raises_and_settings_are_sent_again(camera):
+    backend = camera._xenics
+    apply_settings = backend.apply_settings
+    backend.apply_settings = lambda *args: XCC_E | XCC_E_TIMEOUT
+    with pytest.raises(IOError, match='error -2147483647 writing camera settings'):
+        camera.exptime(0.5)
+    with pytest.raises(IOError):
+        camera.go(0.5, 1, 1)
+    calls = []
+    backend.apply_settings = lambda *args: calls.append(args) or apply_settings(*args)
+    camera.go(0.5, 1, 1)
+    camera.go(0.5, 1, 1)
+    # sent once more after the failure, then known to be set
+    assert calls == [(500, camera.get_gain(), True, camera.get_pwm())]
+    assert backend.integration_time_millisec == 500
@@ -0,0 +1,103 @@
+import threading
+
+import pytest
+from astropy.io import fits
+
+from nihts_xcam.nihts_xcam import XenicsCamera
+from nihts_xcam.simulated_xenics import (SimulatedXenics, SimulatedPowerSwitch, SimulatedStompBroker,
+                                         simulated_camera)
+
+XCC_E = -2 ** 31  # the driver's error bit (1 << 31), as the C int python sees
+XCC_E_TIMEOUT = 1 << 0
+
+
+def make_camera(tmp_path, backend, **kwargs):
+    return XenicsCamera(backend=backend, power_switch=SimulatedPowerSwitch(backend),
+                        stomp_connection_factory=SimulatedStompBroker().connection_factory,
+                        obsdatadir=str(tmp_path), live_name=None, **kwargs)
+
+
+def test_startup_polls_until_the_camera_is_ready(tmp_path):
+    backend = SimulatedXenics(realtime=False, usb_enumerate_sec=0.6, settle_sec=0.2)
+    camera = make_camera(tmp_path, backend)
+    try:
+        timings = camera.startup_timings
+        assert list(timings) == ['power_on', 'usb', 'ready', 'settings', 'total']
+        # open_camera() is retried (every 0.25 sec) until the camera enumerates
+        assert backend.open_calls > 1
+        assert 0.5 < timings['usb'] < 5.
+        assert 0.1 < timings['ready'] < 5.
+        assert timings['total'] == pytest.approx(sum(sec for phase, sec in timings.items() if phase != 'total'),
+                                                 abs=0.01)
+        gauges = camera.metrics.snapshot()['gauges']
+        assert gauges['startup_usb_sec'] == timings['usb'] and gauges['startup_total_sec'] == timings['total']
+    finally:
+        camera.close_camera()
+
+
+@pytest.mark.parametrize('failure', ['usb', 'ready', 'settings'])
+def test_startup_failure_cleans_up(tmp_path, failure):
+    backend = SimulatedXenics(realtime=False)
+    if failure == 'usb':
+        backend.open_camera = lambda: 1
+    elif failure == 'ready':
+        backend.check_frame_read = lambda: 1
+    else:
+        backend.apply_settings = lambda *args: XCC_E | XCC_E_TIMEOUT
+    threads = set(threading.enumerate())
+    with pytest.raises(IOError, match='camera did not start up'):
+        make_camera(tmp_path, backend, power_on_timeout_sec=0.3, ready_timeout_sec=0.3)
+    assert backend._powered_at is None
+    assert set(threading.enumerate()) <= threads
+
+
+@pytest.fixture
+def windowed_camera(tmp_path):
+    camera = simulated_camera(obsdatadir=str(tmp_path), realtime=False, seed=1)
+    camera.window((0, 0, 64, 32))
+    yield camera
+    camera.close_camera()
+
+
+def test_warm_reconnect_restores_the_window(windowed_camera, capsys, data_files):
+    camera = windowed_camera
+    backend = camera._xenics
+    power = camera._power_switch
+    capsys.readouterr()
+    assert camera.reconnect()
+    timings = camera.startup_timings
+    assert list(timings) == ['usb', 'ready', 'settings', 'window', 'total']
+    assert timings['total'] == pytest.approx(sum(sec for phase, sec in timings.items() if phase != 'total'),
+                                             abs=0.01)
+    # the printed total includes the window
+    assert 'camera ready in {:.2f} sec'.format(timings['total']) in capsys.readouterr().out
+    assert (power.on_calls, power.off_calls) == (1, 0)
+    assert backend.window == (0, 0, 64, 32, 1, 1)
+    assert camera._temperature_monitor._thread.is_alive()
+    camera.go(0.01, 1, 1)
+    assert fits.getdata(data_files(camera)[0]).shape == (32, 64)
+
+
+def test_reconnect_with_power_cycle(windowed_camera):
+    camera = windowed_camera
+    assert camera.reconnect(power_cycle=True)
+    assert (camera._power_switch.on_calls, camera._power_switch.off_calls) == (2, 1)
+    assert 'power_on' in camera.startup_timings
+    assert camera._xenics.window == (0, 0, 64, 32, 1, 1)
+
+
+def test_failed_reconnect_leaves_temperature_sampling_stopped(windowed_camera):
+    camera = windowed_camera
+    camera._power_on_timeout_sec = 0.3
+    camera._xenics.open_camera = lambda: 1
+    assert not camera.reconnect()
+    assert camera._temperature_monitor._thread is None
+
+
+def test_reconnect_window_error(windowed_camera):
+    camera = windowed_camera
+    camera._xenics.set_window = lambda *args: XCC_E | XCC_E_TIMEOUT
+    with pytest.raises(IOError, match='restoring window'):
+        camera.reconnect()
+    # the camera is open, so its temperature is still sampled
+    assert camera._temperature_monitor._thread.is_alive()
@@ -0,0 +1,81 @@
+import time
+
+import pytest
+from astropy.io import fits
+
+from nihts_xcam.telemetry import TelemetryStore, TCS_TELEMETRY, DESTINATIONS
+from nihts_xcam.telemetry_parser import parse_packet, TCS_TELEMETRY_SAMPLE
+
+
+def telemetry_packet(az, el):
+    body = TCS_TELEMETRY_SAMPLE.replace('<TCSCurrentAzimuth>238.096861<', '<TCSCurrentAzimuth>{}<'.format(az))
+    return body.replace('<TCSCurrentElev>39.162611<', '<TCSCurrentElev>{}<'.format(el))
+
+
+def card_values(cards):
+    return dict((card.keyword, card.value) for card in cards)
+
+
+@pytest.fixture
+def store():
+    store = TelemetryStore(stale_sec={TCS_TELEMETRY: 5.})
+    store.update(TCS_TELEMETRY, parse_packet(telemetry_packet(350., 39.)), received=100.)
+    store.update(TCS_TELEMETRY, parse_packet(telemetry_packet(10., 41.)), received=110.)
+    return store
+
+
+def test_cards_at_interpolates_between_packets(store):
+    values = card_values(store.cards_at(105.))
+    # the short way round through north
+    assert values['TCSCURAZ'] == pytest.approx(0.)
+    assert values['TCSCUREL'] == pytest.approx(40.)
+    assert values['TCSTLAGE'] == pytest.approx(5.)
+    assert values['TCSTELEM'] is True
+    values = card_values(store.cards_at(102.5))
+    assert values['TCSCURAZ'] == pytest.approx(355.)
+    assert values['TCSCUREL'] == pytest.approx(39.5)
+    # the cached cards aren't changed by interpolating
+    assert card_values(store.cards_at(105.))['TCSCUREL'] == pytest.approx(40.)
+    assert card_values(store.cards_at(100.))['TCSCURAZ'] == pytest.approx(350.)
+
+
+def test_cards_at_stale_flags(store):
+    values = card_values(store.cards_at(114.))
+    assert values['TCSCURAZ'] == pytest.approx(10.)
+    assert values['TCSTLAGE'] == pytest.approx(4.)
+    assert values['TCSTELEM'] is True
+    values = card_values(store.cards_at(120.))
+    assert values['TCSCURAZ'] == pytest.approx(10.)
+    assert values['TCSTLAGE'] == pytest.approx(10.)
+    assert values['TCSTELEM'] is False
+    # before the first packet, its values are used, but it is marked stale if too far off
+    values = card_values(store.cards_at(90.))
+    assert values['TCSCURAZ'] == pytest.approx(350.)
+    assert values['TCSTLAGE'] == pytest.approx(-10.)
+    assert values['TCSTELEM'] is False
+    # no packets at all on the other topics
+    assert values['TCSSTOK'] is False
+    assert values['AOSOK'] is False
+    assert 'AZ' not in values
+
+
+def test_cards_make_a_valid_header(store):
+    header = fits.Header()
+    header.extend(store.cards_at(105.))
+    fits.PrimaryHDU(header=header).verify('exception')
+
+
+def test_broker_telemetry_reaches_headers(camera, data_files):
+    broker = camera.telemetry_client.broker
+    deadline = time.time() + 10.
+    while not camera.telemetry_client.is_connected():
+        assert time.time() < deadline, "telemetry client didn't connect to the simulated broker"
+        time.sleep(0.01)
+    broker.publish(DESTINATIONS[TCS_TELEMETRY][0], telemetry_packet(123.5, 45.))
+    assert camera.telemetry.latest(TCS_TELEMETRY) is not None
+    camera.go(0.01, 1, 1)
+    with fits.open(data_files(camera)[0]) as hdulist:
+        header = hdulist[0].header
+        assert header['TCSCURAZ'] == pytest.approx(123.5)
+        assert header['TCSCUREL'] == pytest.approx(45.)
+        assert header['TCSTELEM'] is True
@@ -0,0 +1,91 @@
+import threading
+import time
+
+from nihts_xcam.simulated_xenics import SimulatedStompBroker
+from nihts_xcam.telemetry import TelemetryClient, TelemetryStore, DESTINATIONS, TCS_TELEMETRY, AOS
+from nihts_xcam.telemetry_parser import TCS_TELEMETRY_SAMPLE, AOS_SAMPLE
+
+
+def wait_for(condition, timeout=10.):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+class RecordingEvent(threading.Event):
+    """A stop event that records the timeouts it is waited on with, and doesn't actually wait them out."""
+    def __init__(self):
+        threading.Event.__init__(self)
+        self.waits = []
+
+    def wait(self, timeout=None):
+        self.waits.append(timeout)
+        return threading.Event.wait(self, 0.001)
+
+
+def make_client(broker, **kwargs):
+    store = TelemetryStore()
+    return store, TelemetryClient(store, broker.connection_factory, [('localhost', 61613)], **kwargs)
+
+
+def test_one_connection_for_all_topics():
+    broker = SimulatedStompBroker()
+    store, client = make_client(broker)
+    client.start()
+    try:
+        wait_for(client.is_connected)
+        assert len(broker.connections) == 1
+        assert sorted(broker.connections[0].subscriptions.values()) == sorted(
+            destination for destination, id in DESTINATIONS.values())
+        broker.publish(DESTINATIONS[TCS_TELEMETRY][0], TCS_TELEMETRY_SAMPLE)
+        broker.publish(DESTINATIONS[AOS][0], AOS_SAMPLE)
+        assert store.latest(TCS_TELEMETRY) is not None
+        assert store.latest(AOS) is not None
+    finally:
+        client.stop()
+    assert broker.connections == []
+    assert not client.is_connected()
+
+
+def test_backoff_doubles_up_to_the_limit():
+    broker = SimulatedStompBroker()
+    broker.available = False
+    store, client = make_client(broker, min_backoff_sec=1., max_backoff_sec=6.)
+    client._stop = RecordingEvent()
+    t0 = time.time()
+    client.start()
+    # start() doesn't wait for the broker
+    assert time.time() - t0 < 0.5
+    try:
+        wait_for(lambda: len(client._stop.waits) >= 6)
+        assert client._stop.waits[:6] == [1., 2., 4., 6., 6., 6.]
+        broker.available = True
+        wait_for(client.is_connected)
+    finally:
+        client.stop()
+    assert client.connect_count == 1
+
+
+def test_reconnects_after_the_connection_drops():
+    broker = SimulatedStompBroker()
+    store, client = make_client(broker, min_backoff_sec=0.01)
+    client.start()
+    try:
+        wait_for(client.is_connected)
+        first = client.connection
+        broker.available = False
+        broker.drop_connections()
+        wait_for(lambda: client.connection is not first and not client.is_connected())
+        broker.available = True
+        wait_for(client.is_connected)
+        assert client.connect_count == 2
+        assert len(broker.connections) == 1
+        broker.publish(DESTINATIONS[TCS_TELEMETRY][0], TCS_TELEMETRY_SAMPLE)
+        assert store.latest(TCS_TELEMETRY) is not None
+        # a disconnect reported by the old connection's listener is ignored
+        first.listeners['telemetry'].on_disconnected()
+        time.sleep(0.05)
+        assert client.connect_count == 2 and client.is_connected()
+    finally:
+        client.stop()
@@ -0,0 +1,62 @@
+import pytest
+import xmltodict
+
+from nihts_xcam.telemetry import CARD_BUILDERS, TCS_STATUS, TCS_TELEMETRY, AOS, TelemetryStore, tcsTelemetry_subscriber
+from nihts_xcam.telemetry_parser import (parse_packet, SCHEMAS, TCS_STATUS_SAMPLE, TCS_TELEMETRY_SAMPLE,
+                                         AOS_SAMPLE)
+
+SAMPLES = [(TCS_STATUS, TCS_STATUS_SAMPLE), (TCS_TELEMETRY, TCS_TELEMETRY_SAMPLE), (AOS, AOS_SAMPLE)]
+
+
+def leaves(schema, prefix=()):
+    for tag, branch in schema.items():
+        if branch is None:
+            yield prefix + (tag,)
+        else:
+            for path in leaves(branch, prefix + (tag,)):
+                yield path
+
+
+def lookup(xml, path):
+    for tag in path:
+        xml = xml[tag]
+    return xml
+
+
+@pytest.mark.parametrize('topic, body', SAMPLES)
+def test_same_values_as_xmltodict(topic, body):
+    fast = parse_packet(body)
+    full = xmltodict.parse(body)
+    root, = fast
+    assert list(full) == [root]
+    paths = list(leaves(SCHEMAS[root], (root,)))
+    assert paths
+    for path in paths:
+        assert lookup(fast, path) == lookup(full, path), path
+    assert CARD_BUILDERS[topic](fast) == CARD_BUILDERS[topic](full)
+
+
+def test_bytes_and_str_bodies():
+    assert parse_packet(TCS_TELEMETRY_SAMPLE.encode('utf-8')) == parse_packet(TCS_TELEMETRY_SAMPLE)
+
+
+def test_unknown_packets_fall_back_to_xmltodict():
+    body = '<otherPacket><a>1</a><b><c>2</c></b></otherPacket>'
+    assert parse_packet(body) == xmltodict.parse(body)
+
+
+def test_missing_elements_are_left_out():
+    xml = parse_packet('<AOSDataPacket><timestamp>now</timestamp><extra>x</extra></AOSDataPacket>')
+    assert xml == {'AOSDataPacket': {'timestamp': 'now'}}
+
+
+def test_malformed_packets_are_dropped(capsys):
+    store = TelemetryStore()
+    subscriber = tcsTelemetry_subscriber(store)
+    subscriber.on_message({}, TCS_TELEMETRY_SAMPLE[:len(TCS_TELEMETRY_SAMPLE) // 2])
+    subscriber.on_message({}, '')
+    assert store.latest(TCS_TELEMETRY) is None
+    assert capsys.readouterr().out.count('could not parse tcsTelemetry packet') == 2
+    # and the subscriber carries on with the next good one
+    subscriber.on_message({}, TCS_TELEMETRY_SAMPLE)
+    assert store.latest(TCS_TELEMETRY) is not None
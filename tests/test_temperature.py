@@ -0,0 +1,90 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from nihts_xcam.simulated_xenics import simulated_camera
+from nihts_xcam.temperature import TemperatureMonitor
+
+
+class Reads():
+    """Register reads that return the given values in turn."""
+    def __init__(self, values):
+        self.values = list(values)
+
+    def __call__(self):
+        return self.values.pop(0)
+
+
+def monitor_with_samples(adu, times, **kwargs):
+    monitor = TemperatureMonitor(Reads(adu), Reads([1] * len(adu)), **kwargs)
+    for t in times:
+        monitor.sample()
+        monitor._times[(monitor._count - 1) % monitor._nsamples] = t
+    return monitor
+
+
+def test_ring_buffer_keeps_the_latest_samples():
+    monitor = monitor_with_samples(range(10), np.arange(10.), nsamples=4, median_window=1)
+    assert len(monitor) == 4
+    times, adu, adc = monitor.samples()
+    np.testing.assert_array_equal(times, [6., 7., 8., 9.])
+    np.testing.assert_array_equal(adu, [6, 7, 8, 9])
+    np.testing.assert_array_equal(adc, [1, 1, 1, 1])
+
+
+def test_running_median():
+    monitor = monitor_with_samples([100, 100, 5000, 100, 200, 200, 200], np.arange(7.), median_window=3)
+    # a single wild read doesn't get through the median of the last 3
+    assert monitor.lookup(2.)[0] == 100
+    assert monitor.lookup(3.)[0] == 100
+    assert monitor.lookup(4.)[0] == 200
+    assert monitor.lookup(6.)[0] == 200
+    # over fewer reads at the start
+    assert monitor.lookup(0.)[0] == 100
+
+
+def test_lookup_nearest_sample():
+    monitor = monitor_with_samples([10, 20, 30], [100., 101., 102.], median_window=1)
+    assert monitor.lookup(100.4) == (10, 1)
+    assert monitor.lookup(100.6) == (20, 1)
+    assert monitor.lookup(50.) == (10, 1)
+    assert monitor.lookup(200.) == (30, 1)
+    adu, adc = monitor.lookup(np.array([99., 101.9, 101.2]))
+    np.testing.assert_array_equal(adu, [10, 30, 20])
+    np.testing.assert_array_equal(adc, [1, 1, 1])
+    assert TemperatureMonitor(Reads([]), Reads([])).lookup(0.) is None
+
+
+def test_closed_camera_reads_are_skipped():
+    monitor = TemperatureMonitor(Reads([-1, 24000]), Reads([-1, 1]))
+    with pytest.raises(IOError):
+        monitor.sample()
+    assert len(monitor) == 0
+    monitor.sample()
+    assert monitor.lookup(0.) == (24000, 1)
+
+
+@pytest.mark.parametrize('coadd_mode', ['stack', 'stream'])
+def test_sampled_between_coadds(tmp_path, data_files, coadd_mode):
+    camera = simulated_camera(obsdatadir=str(tmp_path), seed=1, temperature_noise_adu=0.)
+    backend = camera._xenics
+    capture = getattr(backend, 'capture_frames_abortable' if coadd_mode == 'stack' else 'capture_coadd')
+    ncaptured = []
+
+    def capture_and_warm_up(*args):
+        # the detector warms up a third of the way through the stack
+        ncaptured.append(1)
+        if len(ncaptured) == 10:
+            backend.temperature_adu = 25000
+        return capture(*args)
+    setattr(backend, capture.__name__, capture_and_warm_up)
+    try:
+        camera.temperature_cadence(0.02)
+        camera.coadd_mode(coadd_mode)
+        camera.go(0.02, 30, 1)
+        header = fits.getheader(data_files(camera)[0])
+    finally:
+        camera.close_camera()
+    assert len(ncaptured) == 30
+    assert header['TK_ADU1'] == 24000
+    assert header['TK_ADU2'] == 25000
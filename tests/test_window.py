@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+
+XCC_E = -2 ** 31  # the driver's error bit (1 << 31), as the C int python sees
+XCC_E_UNDERRUN = 1 << 1
+
+
+def test_window_headers_map_back_to_the_detector(camera, data_files):
+    assert camera.window((100, 50, 64, 40), increment=(2, 1)) == (100, 50, 64, 40, 2, 1)
+    camera.go(0.01, 1, 1)
+    with fits.open(data_files(camera)[0]) as hdulist:
+        header = hdulist[0].header
+        data = hdulist[0].data
+    assert data.shape == (40, 32)
+    assert header['DETSEC'] == '[101:164,51:90]'
+    assert header['LTM1_1'] == 0.5 and header['LTM2_2'] == 1.
+    # frame pixel (1-based) = LTM * detector pixel (1-based) + LTV
+    for detector_x, frame_x in [(101, 1), (103, 2), (163, 32)]:
+        assert header['LTM1_1'] * detector_x + header['LTV1'] == frame_x
+    for detector_y, frame_y in [(51, 1), (90, 40)]:
+        assert header['LTM2_2'] * detector_y + header['LTV2'] == frame_y
+    # the frame is the window's pixels of what the full frame would be
+    pattern = camera._xenics._pattern[50:90, 100:164:2]
+    expected = camera._xenics.bias_adu + 0.01 * (camera._xenics.dark_adu_per_sec + pattern)
+    assert np.abs(data - expected).max() < 100.
+
+
+def test_full_frame_headers(camera, data_files):
+    camera.go(0.01, 1, 1)
+    header = fits.getheader(data_files(camera)[0])
+    assert header['DETSEC'] == '[1:320,1:256]'
+    assert (header['LTV1'], header['LTV2'], header['LTM1_1'], header['LTM2_2']) == (0., 0., 1., 1.)
+
+
+def test_window_back_to_full_frame(camera, data_files):
+    camera.window((0, 0, 32, 32))
+    assert camera.window('full') == (0, 0, 320, 256, 1, 1)
+    camera.go(0.01, 1, 1)
+    assert fits.getdata(data_files(camera)[0]).shape == (256, 320)
+
+
+def test_window_that_does_not_fit(camera):
+    with pytest.raises(ValueError):
+        camera.window((300, 0, 64, 64))
+    with pytest.raises(ValueError):
+        camera.window('half')
+    # left as it was
+    assert camera.window() == (0, 0, 320, 256, 1, 1)
+
+
+def test_driver_error_setting_window(camera):
+    # negative, but not the -1 that means the window doesn't fit
+    camera._xenics.set_window = lambda *args: XCC_E | XCC_E_UNDERRUN
+    with pytest.raises(IOError, match='error -2147483646 setting window'):
+        camera.window((0, 0, 32, 32))
+
+
+def test_cube_and_window(camera, data_files):
+    camera.window((10, 20, 48, 24))
+    camera.go(0.01, 1, 3, output='cube')
+    assert fits.getdata(data_files(camera)[0]).shape == (3, 24, 48)